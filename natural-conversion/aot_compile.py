@@ -0,0 +1,36 @@
+"""
+Ahead-of-time compile the kernels that have fixed signatures into an extension
+module (kernels_aot), using numba.pycc. This is kept out of kernels and
+parallel_functions so that importing them doesn't load numba.pycc.
+
+Example:
+
+    python aot_compile.py --output-dir build
+"""
+import argparse
+
+import kernels
+from numba.pycc import CC
+
+EXPORTS = {
+    "slice_area": "f8(f8)",
+    "calc_cell_area": "f8[:](f8[:], f8, f8)",
+    "calc_natural_conversion": "i1[:,:](i4[:,:], i4[:,:], f4[:,:], f4[:,:], f8)",
+    "calc_lc_trans": "i4[:,:](u1[:,:], u1[:,:], i4)",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AOT compile the numba kernels")
+    parser.add_argument("--output-dir", default=".")
+    args = parser.parse_args()
+
+    cc = CC("kernels_aot")
+    cc.output_dir = args.output_dir
+    for name, signature in EXPORTS.items():
+        cc.export(name, signature)(getattr(kernels, name).py_func)
+    cc.compile()
+
+
+if __name__ == "__main__":
+    main()
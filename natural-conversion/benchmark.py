@@ -0,0 +1,665 @@
+"""
+Benchmarks for the natural conversion pipeline, run on synthetic inputs.
+
+Examples:
+
+    python benchmark.py executors --size 8192 --block-size 512 --n-threads 8
+    python benchmark.py executors --scheduler-address tcp://127.0.0.1:8786 --n-workers 3
+    python benchmark.py reader --size 16384 --n-threads 1 4 16
+    python benchmark.py prefetch --n-threads 16 --io-threads 2 4
+    python benchmark.py startup
+    python benchmark.py calibrate --out calibration.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+logging.getLogger("distributed").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+# ESA CCI legend codes (0 is no data)
+ESA_CCI_CLASSES = [
+    0, 10, 11, 12, 20, 30, 40, 50, 60, 61, 62, 70, 71, 72, 80, 81, 82, 90, 100, 110,
+    120, 121, 122, 130, 140, 150, 151, 152, 153, 160, 170, 180, 190, 200, 201, 202,
+    210, 220,
+]  # fmt: skip
+
+X_RES = 1 / 360.0
+
+# Lowest prefetch hit rate accepted by the prefetch benchmark. The first block of each
+# thread is requested before any read finishes, so it is always a miss.
+MIN_PREFETCH_HIT_RATE = 0.85
+
+# Modules whose import time is measured by the startup benchmark
+STARTUP_MODULES = [
+    "kernels",
+    "reductions",
+    "threaded_executor",
+    "parallel_functions",
+    "natural_conversion",
+    "esa_cci_transitions",
+]
+
+
+def synthetic_legend(seed=0):
+    """Return ESA CCI codes and a random recode (0-5) for each, as in the Legend sheet"""
+    rng = np.random.default_rng(seed)
+    recodes = rng.integers(1, 6, len(ESA_CCI_CLASSES))
+    recodes[0] = 0
+
+    return list(ESA_CCI_CLASSES), [int(r) for r in recodes]
+
+
+def make_inputs(out_dir, size, seed=0):
+    """Write synthetic transitions, initial cover and cropland rasters of size x size"""
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    out_dir = Path(out_dir)
+    profile = dict(
+        driver="GTiff",
+        height=size,
+        width=size,
+        crs="EPSG:4326",
+        transform=from_origin(-60, 10, X_RES, X_RES),
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="LZW",
+    )
+
+    lc_initial = rng.choice(np.array(ESA_CCI_CLASSES, dtype=np.uint8), (size, size))
+    trans_meaning = (rng.random((size, size)) < 0.02).astype(np.int32)
+    crops_initial = rng.random((size, size), dtype=np.float32)
+    crops_final = np.clip(
+        crops_initial + rng.normal(0, 0.1, (size, size)).astype(np.float32), 0, 1
+    )
+
+    paths = {
+        "trans": out_dir / "transitions.tif",
+        "lc_initial": out_dir / "lc_initial.tif",
+        "crops_initial": out_dir / "crops_initial.tif",
+        "crops_final": out_dir / "crops_final.tif",
+    }
+    with rasterio.open(paths["trans"], "w", count=2, dtype="int32", **profile) as ds:
+        ds.write(lc_initial.astype(np.int32) * 1000, 1)
+        ds.write(trans_meaning, 2)
+    with rasterio.open(
+        paths["lc_initial"], "w", count=1, dtype="uint8", **profile
+    ) as ds:
+        ds.write(lc_initial, 1)
+    for name, crops in [("crops_initial", crops_initial), ("crops_final", crops_final)]:
+        with rasterio.open(paths[name], "w", count=1, dtype="float32", **profile) as ds:
+            ds.write(crops, 1)
+
+    return paths
+
+
+def run_dask(paths, out_dir, rules, block_size, cluster_args):
+    import dask_cluster
+    import parallel_functions
+    import raster_reader
+    import xarray as xr
+
+    with dask_cluster.start_client(cluster_args) as client:
+        dask_cluster.register_rule_tables(client, rules)
+        layers = []
+        for name, band in [
+            ("trans", 2),
+            ("lc_initial", 1),
+            ("crops_initial", 1),
+            ("crops_final", 1),
+        ]:
+            layers.append(
+                raster_reader.open_band(
+                    paths[name],
+                    band,
+                    name,
+                    reader=cluster_args.reader,
+                    cache_bytes=int(cluster_args.reader_cache_mb * raster_reader.MB),
+                )
+            )
+        in_data = xr.merge(layers, join="override", combine_attrs="drop").chunk(
+            dict(x=block_size, y=block_size)
+        )
+        out = xr.map_blocks(
+            parallel_functions.compute_natural_conversion,
+            in_data,
+            kwargs={
+                "rule_table": rules.name,
+                "x_res": float((in_data.x[1] - in_data.x[0]).values),
+                "y_res": float((in_data.y[0] - in_data.y[1]).values),
+            },
+        )
+        out_file = Path(out_dir) / "dask.nc"
+        encoding = {key: {"zlib": True, "complevel": 6} for key in out.data_vars}
+        out.to_netcdf(out_file, encoding=encoding)
+
+    with xr.open_dataset(out_file) as ds:
+        return float(ds.area_natural_conversion.sum())
+
+
+def run_threads(paths, out_dir, rules, block_size, n_threads, kernel_threads=1):
+    import rasterio
+    import threaded_executor
+
+    out_files = {
+        name: Path(out_dir) / f"threads_{name}.tif"
+        for name in threaded_executor.NATURAL_CONVERSION_OUTPUTS
+    }
+    threaded_executor.run_natural_conversion(
+        paths["trans"],
+        paths["lc_initial"],
+        paths["crops_initial"],
+        paths["crops_final"],
+        out_files,
+        rules,
+        staging_path=Path(out_dir) / "staging",
+        block_size=block_size,
+        n_threads=n_threads,
+        kernel_threads=kernel_threads,
+    )
+
+    with rasterio.open(out_files["area_natural_conversion"]) as ds:
+        return float(ds.read(1).sum())
+
+
+def bench_executors(args):
+    import rule_tables
+
+    rules = rule_tables.RuleTable("initial_natural", *synthetic_legend())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_inputs(tmp, args.size)
+        results = {}
+        for name, func, n in [
+            ("dask", run_dask, args),
+            ("threads", run_threads, args.n_threads),
+        ]:
+            start = time.perf_counter()
+            total = func(paths, tmp, rules, args.block_size, n)
+            results[name] = (time.perf_counter() - start, total)
+        if args.kernel_threads > 1:
+            start = time.perf_counter()
+            total = run_threads(
+                paths,
+                tmp,
+                rules,
+                args.block_size,
+                None,
+                args.kernel_threads,
+            )
+            results["prange"] = (time.perf_counter() - start, total)
+
+    n_pixels = args.size ** 2
+    for name, (elapsed, total) in results.items():
+        logger.info(
+            "%-8s %8.2f s  %8.1f Mpixel/s  area_natural_conversion=%.2f ha",
+            name,
+            elapsed,
+            n_pixels / elapsed / 1e6,
+            total,
+        )
+    for name, (_, total) in results.items():
+        if not np.isclose(results["dask"][1], total):
+            raise RuntimeError(f"dask and {name} executors produced different totals")
+    logger.info(
+        "threads speedup over dask: %.2fx", results["dask"][0] / results["threads"][0]
+    )
+
+
+def import_time(module):
+    """Seconds taken to import module in a fresh interpreter"""
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(__file__).parent,
+    )
+
+    return float(result.stdout.split()[-1])
+
+
+def first_task(size, seed=0):
+    """Run the natural conversion kernels on one synthetic block"""
+    import kernels
+
+    rng = np.random.default_rng(seed)
+    lc_initial = rng.choice(np.array(ESA_CCI_CLASSES, dtype=np.uint8), (size, size))
+    meaning, _, area = kernels.natural_conversion_block(
+        (rng.random((size, size)) < 0.02).astype(np.int32),
+        lc_initial,
+        rng.random((size, size), dtype=np.float32),
+        rng.random((size, size), dtype=np.float32),
+        np.linspace(10, 10 - size * X_RES, size),
+        kernels.rule_lookup(*synthetic_legend()),
+        X_RES,
+        X_RES,
+    )
+
+    return float(area.sum())
+
+
+def bench_startup(args):
+    for module in STARTUP_MODULES:
+        times = [import_time(module) for _ in range(args.repeats)]
+        logger.info(
+            "import %-20s %6.3f s (median of %d)",
+            module,
+            statistics.median(times),
+            args.repeats,
+        )
+
+    from dask.distributed import Client
+    from dask.distributed import LocalCluster
+
+    # The first spawn compiles the kernels into an empty cache, later spawns load them
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["NUMBA_CACHE_DIR"] = cache_dir
+        for run in ["empty cache", "warm cache"]:
+            start = time.perf_counter()
+            with LocalCluster(
+                n_workers=1, threads_per_worker=1, dashboard_address=None
+            ) as cluster, Client(cluster) as client:
+                client.wait_for_workers(1)
+                spawned = time.perf_counter()
+                client.submit(first_task, args.block_size, pure=False).result()
+                first = time.perf_counter()
+                client.submit(first_task, args.block_size, pure=False).result()
+                second = time.perf_counter()
+            logger.info(
+                "%-12s worker spawn %6.2f s  first task %6.2f s  next task %6.3f s",
+                run,
+                spawned - start,
+                first - spawned,
+                second - first,
+            )
+
+
+def _esa_cci_block(size, rng):
+    import kernels
+    import rule_tables
+
+    classes = np.array(ESA_CCI_CLASSES, dtype=np.uint8)
+    lc_initial = rng.choice(classes, (size, size))
+    lc_final = rng.choice(classes, (size, size))
+    # As in the Recoding sheet, a meaning for every pair of classes
+    trans_codes = [int(i) * 1000 + int(f) for i in classes for f in classes]
+    rules = rule_tables.RuleTable(
+        "transition_meaning", trans_codes, rng.integers(0, 2, len(trans_codes))
+    )
+
+    def run():
+        trans = kernels.calc_lc_trans(lc_initial, lc_final, 1000)
+        rules.apply(trans)
+
+    return run
+
+
+def _natural_conversion_block(size, rng):
+    import kernels
+
+    initial_lut = kernels.rule_lookup(*synthetic_legend())
+    trans = (rng.random((size, size), dtype=np.float32) < 0.02).astype(np.int32)
+    lc_initial = rng.choice(np.array(ESA_CCI_CLASSES, dtype=np.uint8), (size, size))
+    crops_initial = rng.random((size, size), dtype=np.float32)
+    crops_final = rng.random((size, size), dtype=np.float32)
+    y = np.linspace(10, 10 - size * X_RES, size)
+
+    def run():
+        kernels.natural_conversion_block(
+            trans,
+            lc_initial,
+            crops_initial,
+            crops_final,
+            y,
+            initial_lut,
+            X_RES,
+            X_RES,
+        )
+
+    return run
+
+
+def _initial_cover_block(size, rng):
+    import parallel_functions
+    import rule_tables
+    import xarray as xr
+
+    rules = rule_tables.RuleTable("initial_cover_recode", *synthetic_legend())
+    lc_initial = xr.DataArray(
+        rng.choice(np.array(ESA_CCI_CLASSES, dtype=np.uint8), (size, size)),
+        coords={"y": np.arange(size), "x": np.arange(size)},
+        dims=("y", "x"),
+    )
+
+    def run():
+        parallel_functions.recode_cover(lc_initial, rules)
+
+    return run
+
+
+# Per-block work of each stage, as run by its tasks
+CALIBRATION_STAGES = {
+    "esa_cci": _esa_cci_block,
+    "natural_conversion": _natural_conversion_block,
+    "initial_cover": _initial_cover_block,
+}
+
+
+def _rss_bytes(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+
+
+def calibrate_stage(stage, size, repeats):
+    """
+    Measure the single thread throughput of one stage, and its peak memory (inputs,
+    outputs and temporaries) per pixel of a block. Run in a fresh process, as it
+    resets the peak resident set size (Linux only).
+    """
+    rng = np.random.default_rng(0)
+    # Compile the kernels first
+    CALIBRATION_STAGES[stage](64, rng)()
+
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    baseline = _rss_bytes("VmRSS")
+    run = CALIBRATION_STAGES[stage](size, rng)
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        elapsed.append(time.perf_counter() - start)
+    peak = _rss_bytes("VmHWM")
+
+    return {
+        "mpixels_per_second": size ** 2 / min(elapsed) / 1e6,
+        "bytes_per_pixel": (peak - baseline) / size ** 2,
+    }
+
+
+def calibrate_io(size):
+    """
+    Measure the single thread rates of reading (and decoding) the LZW inputs and of
+    writing (and encoding) a LZW output, both in MB of uncompressed pixels per second
+    """
+    import threaded_executor
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(0)
+    # Mostly zero, as the areas written by the stages
+    areas = np.where(rng.random((size, size)) < 0.02, rng.random((size, size)), 0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_inputs(tmp, size)["crops_initial"]
+        read_seconds, _ = read_throughput(path, "threadlocal", 1024, 1, 0)
+
+        start = time.perf_counter()
+        with threaded_executor.open_output(
+            Path(tmp) / "areas.tif",
+            "float64",
+            from_origin(-60, 10, X_RES, X_RES),
+            size,
+            size,
+            threaded_executor.DEFAULT_BLOCK_SIZE,
+        ) as ds:
+            ds.write(areas, 1)
+        write_seconds = time.perf_counter() - start
+
+    return {
+        "read_mb_per_second": size ** 2 * 4 / read_seconds / 1024 ** 2,
+        "encode_mb_per_second": areas.nbytes / write_seconds / 1024 ** 2,
+    }
+
+
+def bench_calibrate(args):
+    io_rates = calibrate_io(args.size)
+    logger.info(
+        "Read %.1f MB/s, write %.1f MB/s of uncompressed pixels per thread",
+        io_rates["read_mb_per_second"],
+        io_rates["encode_mb_per_second"],
+    )
+    calibration = {}
+    for stage in args.stages:
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            calibration[stage] = pool.submit(
+                calibrate_stage, stage, args.size, args.repeats
+            ).result()
+        calibration[stage].update(io_rates)
+        logger.info(
+            "%-20s %8.1f Mpixel/s per thread  %6.1f bytes per pixel",
+            stage,
+            calibration[stage]["mpixels_per_second"],
+            calibration[stage]["bytes_per_pixel"],
+        )
+
+    with open(args.out, "w") as f:
+        json.dump(calibration, f, indent=2)
+    logger.info(f"Wrote {args.out}, for use with resource_planner.py --calibration")
+
+
+def read_throughput(path, reader, chunk_size, n_threads, cache_mb):
+    """Seconds taken to read (and sum) band 1 of path in chunks, and the sum"""
+    import dask
+    import raster_reader
+
+    data = raster_reader.open_band(
+        path,
+        1,
+        chunks=chunk_size,
+        reader=reader,
+        cache_bytes=int(cache_mb * raster_reader.MB),
+    )
+    start = time.perf_counter()
+    with dask.config.set(scheduler="threads", num_workers=n_threads):
+        total = float(data.sum(dtype=np.float64).compute())
+
+    return time.perf_counter() - start, total
+
+
+def bench_reader(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_inputs(tmp, args.size)["crops_initial"]
+        results = {}
+        for n_threads in args.n_threads:
+            for reader in args.readers:
+                results[reader, n_threads] = read_throughput(
+                    path, reader, args.chunk_size, n_threads, args.cache_mb
+                )
+
+    n_pixels = args.size ** 2
+    for (reader, n_threads), (elapsed, total) in results.items():
+        logger.info(
+            "%-12s %3d threads %8.2f s  %8.1f Mpixel/s",
+            reader,
+            n_threads,
+            elapsed,
+            n_pixels / elapsed / 1e6,
+        )
+    totals = [total for _, total in results.values()]
+    if not np.allclose(totals, totals[0]):
+        raise RuntimeError("Readers read different values")
+    if "rioxarray" in args.readers and "threadlocal" in args.readers:
+        for n_threads in args.n_threads:
+            logger.info(
+                "threadlocal speedup over rioxarray with %d threads: %.2fx",
+                n_threads,
+                results["rioxarray", n_threads][0]
+                / results["threadlocal", n_threads][0],
+            )
+
+
+def prefetch_stats(paths, size, block_size, n_threads, io_threads, compute_seconds):
+    """
+    Run n_threads block threads, each block taking compute_seconds, over the inputs
+    read ahead by a PrefetchReader with io_threads threads, and return its counters
+    """
+    import threaded_executor
+
+    inputs = threaded_executor.open_inputs(
+        {name: (path, 2 if name == "trans" else 1) for name, path in paths.items()},
+        None,
+        (0, 0, size, size),
+        input_mode="prefetch",
+        io_threads=io_threads,
+        n_threads=n_threads,
+    )
+
+    def block_func(arrays, window):
+        time.sleep(compute_seconds)
+
+    windows = list(threaded_executor.block_windows(size, size, block_size))
+    threaded_executor.run_prefetched(
+        block_func, inputs, windows, None, n_threads=n_threads, total=len(windows)
+    )
+
+    return inputs.stats()
+
+
+def bench_prefetch(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_inputs(tmp, args.size)
+        results = {
+            io_threads: prefetch_stats(
+                paths,
+                args.size,
+                args.block_size,
+                args.n_threads,
+                io_threads,
+                args.compute_ms / 1000,
+            )
+            for io_threads in args.io_threads
+        }
+
+    for io_threads, stats in results.items():
+        logger.info(
+            "%3d block threads %3d I/O threads  %5.1f%% hit rate  %6.2f s stalled",
+            args.n_threads,
+            io_threads,
+            100 * stats["hit_rate"],
+            stats["stall_seconds"],
+        )
+    for io_threads, stats in results.items():
+        if stats["hit_rate"] < MIN_PREFETCH_HIT_RATE:
+            raise RuntimeError(
+                f"Prefetch hit rate with {io_threads} I/O threads is "
+                f"{100 * stats['hit_rate']:.1f}%, below "
+                f"{100 * MIN_PREFETCH_HIT_RATE:.0f}%"
+            )
+
+
+def main():
+    import dask_cluster
+    import raster_reader
+
+    parser = argparse.ArgumentParser(description="Benchmark natural conversion")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    executors = subparsers.add_parser(
+        "executors", help="Compare the dask and threads executors end to end"
+    )
+    executors.add_argument("--size", type=int, default=8192)
+    executors.add_argument("--block-size", type=int, default=512)
+    executors.add_argument("--n-threads", type=int, default=None)
+    executors.add_argument(
+        "--kernel-threads",
+        type=int,
+        default=1,
+        help="Also time the threads executor with row-parallel kernels",
+    )
+    # With --scheduler-address the dask run uses the workers of that scheduler, which
+    # must share this machine's temporary directory
+    dask_cluster.add_cluster_arguments(executors)
+    raster_reader.add_reader_arguments(executors)
+    executors.set_defaults(func=bench_executors)
+
+    reader = subparsers.add_parser(
+        "reader",
+        help="Compare the read throughput of the raster readers of the dask pipeline",
+    )
+    reader.add_argument("--size", type=int, default=8192)
+    # Not a multiple of the 256 pixel tiles of the inputs, so chunks share tiles
+    reader.add_argument("--chunk-size", type=int, default=1000)
+    reader.add_argument("--n-threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    reader.add_argument(
+        "--readers",
+        nargs="+",
+        default=raster_reader.READERS,
+        choices=raster_reader.READERS,
+    )
+    reader.add_argument(
+        "--cache-mb", type=float, default=raster_reader.DEFAULT_CACHE_MB
+    )
+    reader.set_defaults(func=bench_reader)
+
+    prefetch = subparsers.add_parser(
+        "prefetch",
+        help="Check the hit rate of the threads executor prefetching with more block "
+        "threads than I/O threads",
+    )
+    prefetch.add_argument("--size", type=int, default=8192)
+    prefetch.add_argument("--block-size", type=int, default=512)
+    prefetch.add_argument("--n-threads", type=int, default=16)
+    prefetch.add_argument("--io-threads", type=int, nargs="+", default=[2, 4])
+    prefetch.add_argument(
+        "--compute-ms",
+        type=float,
+        default=300,
+        help="Time spent computing each block (about that of natural conversion on a "
+        "512 x 512 block)",
+    )
+    prefetch.set_defaults(func=bench_prefetch)
+
+    startup = subparsers.add_parser(
+        "startup",
+        help="Time module imports, worker spawn and first-task latency",
+    )
+    startup.add_argument("--block-size", type=int, default=512)
+    startup.add_argument("--repeats", type=int, default=3)
+    startup.set_defaults(func=bench_startup)
+
+    calibrate = subparsers.add_parser(
+        "calibrate",
+        help="Measure throughput and memory per pixel of each stage for the planner",
+    )
+    calibrate.add_argument("--size", type=int, default=4096)
+    calibrate.add_argument("--repeats", type=int, default=3)
+    calibrate.add_argument(
+        "--stages",
+        nargs="+",
+        default=list(CALIBRATION_STAGES.keys()),
+        choices=list(CALIBRATION_STAGES.keys()),
+    )
+    calibrate.add_argument("--out", default="calibration.json")
+    calibrate.set_defaults(func=bench_calibrate)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
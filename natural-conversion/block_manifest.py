@@ -0,0 +1,155 @@
+"""
+Per-block fingerprints of pipeline inputs and outputs, used for incremental reruns.
+
+The manifest is a JSON file stored next to the outputs it describes. It records a
+fingerprint of the parameters of the run (rule tables, block size, etc.) and, for each
+block, a fingerprint of the input and output arrays (the outputs as written to the
+output files). When a new input version is released the threaded executor only
+recomputes blocks whose inputs changed, and patches those into the existing outputs.
+Before that, the outputs of every recorded block are read back and checked against
+their fingerprints (see BlockManifest.verify), so blocks whose outputs are stale or
+were only partly written (by an interrupted run, or in an output fetched from an
+earlier run) are recomputed too.
+"""
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+
+
+def fingerprint(arrays):
+    """Return a hex digest of a dict of arrays (names, dtypes, shapes and data)"""
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(arrays, key=str):
+        array = np.ascontiguousarray(arrays[name])
+        h.update(f"{name}:{array.dtype.str}:{array.shape}".encode())
+        h.update(array.data)
+
+    return h.hexdigest()
+
+
+def params_fingerprint(params):
+    """Return a hex digest of JSON-serializable run parameters"""
+    return hashlib.blake2b(
+        json.dumps(params, sort_keys=True, default=str).encode(), digest_size=16
+    ).hexdigest()
+
+
+def _window_key(window):
+    return "_".join(str(n) for n in window)
+
+
+def _key_window(key):
+    return tuple(int(n) for n in key.split("_"))
+
+
+class BlockManifest:
+    """Input and output fingerprints for each block of a run"""
+
+    def __init__(self, path, params):
+        self.path = Path(path)
+        self.params = params_fingerprint(params)
+        self.blocks = {}
+        self._lock = threading.Lock()
+
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+            if (
+                manifest.get("version") == MANIFEST_VERSION
+                and manifest.get("params") == self.params
+            ):
+                self.blocks = manifest["blocks"]
+            else:
+                logger.warning(
+                    f"Parameters have changed since {self.path} was written - all "
+                    "blocks will be recomputed"
+                )
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def is_current(self, window, input_fingerprint):
+        entry = self.blocks.get(_window_key(window))
+
+        return entry is not None and entry["inputs"] == input_fingerprint
+
+    def update(self, window, input_fingerprint, output_fingerprint):
+        with self._lock:
+            self.blocks[_window_key(window)] = {
+                "inputs": input_fingerprint,
+                "outputs": output_fingerprint,
+            }
+
+    def verify(self, read_outputs, n_threads=None):
+        """
+        Read the outputs of each recorded block with read_outputs(window) (returning
+        them as written, as passed to update) and forget the blocks whose outputs do
+        not match their fingerprint or cannot be read, so that they are recomputed.
+        Returns the number of blocks forgotten.
+        """
+
+        def matches(key):
+            try:
+                outputs = read_outputs(_key_window(key))
+            except Exception as e:
+                logger.warning(f"Could not read the outputs of block {key}: {e}")
+                return False
+
+            return fingerprint(outputs) == self.blocks[key]["outputs"]
+
+        keys = list(self.blocks)
+        with ThreadPoolExecutor(n_threads) as pool:
+            stale = [key for key, ok in zip(keys, pool.map(matches, keys)) if not ok]
+        with self._lock:
+            for key in stale:
+                del self.blocks[key]
+        if stale:
+            logger.warning(
+                f"The outputs of {len(stale)} of {len(keys)} blocks in {self.path} do "
+                "not match their fingerprints - they will be recomputed"
+            )
+
+        return len(stale)
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "params": self.params,
+                    "blocks": self.blocks,
+                },
+                f,
+            )
+        tmp_path.replace(self.path)
+        logger.info(f"Saved fingerprints of {len(self.blocks)} blocks to {self.path}")
+
+
+def incremental(block_func, manifest, stored):
+    """
+    Wrap a run_blocks block_func so that blocks whose inputs match the manifest return
+    None (and so are not rewritten), and recomputed blocks are recorded in it.
+    stored(outputs) returns the outputs of a block as they are written (the arrays
+    read back by BlockManifest.verify).
+    """
+
+    def wrapped(arrays, window):
+        input_fingerprint = fingerprint(arrays)
+        if manifest.is_current(window, input_fingerprint):
+            return None
+        outputs = block_func(arrays, window)
+        manifest.update(window, input_fingerprint, fingerprint(stored(outputs)))
+
+        return outputs
+
+    return wrapped
@@ -0,0 +1,552 @@
+"""
+Extract contiguous patches of natural conversion (codes 1-3 of the transition layer
+written by natural_conversion.py) as a table of patches, and optionally as polygons.
+
+The transition raster is read one block at a time by a pool of threads. Each block is
+labelled with a union-find over its pixels, and only the per-label statistics and the
+labels along the four edges of the block are kept. Labels are then stitched across
+block edges with a second union-find, so patches are followed across the whole grid
+without holding it in memory.
+
+Example:
+
+    python conversion_patches.py --in-file /data/natural-conversion_300m_2011-2019_transition.tif --polygons
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+from pathlib import Path
+
+import kernels
+import numba
+import numpy as np
+import raster_reader
+import threaded_executor
+import uploads
+
+DATA_PATH = Path("/data")
+OUT_S3_BUCKET = "trends.earth-private"
+OUT_S3_PREFIX = "esa-cci/transitions"
+
+INITIAL_YEAR = 2011
+FINAL_YEAR = 2019
+
+# Transition codes counted as natural conversion
+CONVERSION_CODES = [1, 2, 3]
+
+DEFAULT_BLOCK_SIZE = 2048
+
+PATCH_COLUMNS = [
+    "patch_id",
+    "n_pixels",
+    "area_ha",
+    "area_code_1",
+    "area_code_2",
+    "area_code_3",
+    "dominant_code",
+    "centroid_lon",
+    "centroid_lat",
+    "west",
+    "south",
+    "east",
+    "north",
+]
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+
+logging.getLogger("botocore").setLevel(logging.WARNING)
+logging.getLogger("s3transfer").setLevel(logging.WARNING)
+logging.getLogger("boto3").setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _find(parent, x):
+    root = x
+    while parent[root] != root:
+        root = parent[root]
+    while parent[x] != root:
+        parent[x], x = root, parent[x]
+
+    return root
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _union(parent, a, b):
+    """Merge the sets of a and b, keeping the smaller root"""
+    a = _find(parent, a)
+    b = _find(parent, b)
+    if a < b:
+        parent[b] = a
+    elif b < a:
+        parent[a] = b
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def label_block(codes, eight_connected):
+    """
+    Label connected regions of natural conversion (codes 1-3) in a block, returning
+    labels numbered from 1 (0 elsewhere) and the number of labels
+    """
+    rows, cols = codes.shape
+    labels = np.zeros((rows, cols), dtype=np.int32)
+    # A pixel only starts a label if its left neighbour has none
+    parent = np.zeros(rows * ((cols + 1) // 2) + 1, dtype=np.int32)
+    n = 0
+    for i in range(rows):
+        for j in range(cols):
+            if codes[i, j] < 1 or codes[i, j] > 3:
+                continue
+            label = 0
+            for di, dj in ((0, -1), (-1, 0), (-1, -1), (-1, 1)):
+                if not eight_connected and di != 0 and dj != 0:
+                    continue
+                ii = i + di
+                jj = j + dj
+                if ii < 0 or jj < 0 or jj >= cols or labels[ii, jj] == 0:
+                    continue
+                if label == 0:
+                    label = labels[ii, jj]
+                else:
+                    _union(parent, label, labels[ii, jj])
+            if label == 0:
+                n += 1
+                parent[n] = n
+                label = n
+            labels[i, j] = label
+
+    # Number the merged labels 1..m. Roots are the smallest label of their set, so
+    # each root is numbered before the labels that point to it.
+    relabel = np.zeros(n + 1, dtype=np.int32)
+    m = 0
+    for k in range(1, n + 1):
+        root = _find(parent, k)
+        if relabel[root] == 0:
+            m += 1
+            relabel[root] = m
+        relabel[k] = relabel[root]
+    for i in range(rows):
+        for j in range(cols):
+            labels[i, j] = relabel[labels[i, j]]
+
+    return labels, m
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def label_stats(codes, labels, n_labels, row_areas):
+    """
+    Pixel count, area of each conversion code, area-weighted sums of row and column,
+    and row and column bounds of each label of a block
+    """
+    n_pixels = np.zeros(n_labels, dtype=np.int64)
+    areas = np.zeros((n_labels, 3), dtype=np.float64)
+    sum_row = np.zeros(n_labels, dtype=np.float64)
+    sum_col = np.zeros(n_labels, dtype=np.float64)
+    bounds = np.empty((n_labels, 4), dtype=np.int64)
+    bounds[:, 0] = labels.shape[0]
+    bounds[:, 1] = labels.shape[1]
+    bounds[:, 2] = -1
+    bounds[:, 3] = -1
+    for i in range(labels.shape[0]):
+        area = row_areas[i]
+        for j in range(labels.shape[1]):
+            label = labels[i, j] - 1
+            if label < 0:
+                continue
+            n_pixels[label] += 1
+            areas[label, codes[i, j] - 1] += area
+            sum_row[label] += area * i
+            sum_col[label] += area * j
+            bounds[label, 0] = min(bounds[label, 0], i)
+            bounds[label, 1] = min(bounds[label, 1], j)
+            bounds[label, 2] = max(bounds[label, 2], i)
+            bounds[label, 3] = max(bounds[label, 3], j)
+
+    return n_pixels, areas, sum_row, sum_col, bounds
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def union_edges(parent, a, b, eight_connected):
+    """Merge the labels of two facing block edges (0 where there is no patch)"""
+    for k in range(a.size):
+        if a[k] == 0:
+            continue
+        if b[k] != 0:
+            _union(parent, a[k], b[k])
+        if eight_connected:
+            if k > 0 and b[k - 1] != 0:
+                _union(parent, a[k], b[k - 1])
+            if k + 1 < b.size and b[k + 1] != 0:
+                _union(parent, a[k], b[k + 1])
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def resolve_roots(parent):
+    roots = np.empty(parent.size, dtype=parent.dtype)
+    for k in range(parent.size):
+        roots[k] = _find(parent, k)
+
+    return roots
+
+
+def _block_labels(reader, window, eight_connected):
+    codes = reader.read(window)
+    labels, n = label_block(codes, eight_connected)
+    return codes, labels, n
+
+
+def _label_one_block(reader, window, y, x_res, y_res, eight_connected):
+    """Label one block, returning its label statistics and edge labels"""
+    row_off, col_off, nrows, _ = window
+    codes, labels, n = _block_labels(reader, window, eight_connected)
+    row_areas = kernels.calc_cell_area(y[row_off : row_off + nrows], x_res, y_res)
+    n_pixels, areas, sum_row, sum_col, bounds = label_stats(
+        codes, labels, n, row_areas
+    )
+    total_areas = areas.sum(axis=1)
+    bounds[:, [0, 2]] += row_off
+    bounds[:, [1, 3]] += col_off
+
+    return {
+        "n": n,
+        "n_pixels": n_pixels,
+        "areas": areas,
+        # Area-weighted sums of global pixel indices
+        "sum_row": sum_row + row_off * total_areas,
+        "sum_col": sum_col + col_off * total_areas,
+        "bounds": bounds,
+        "edges": {
+            "top": labels[0].copy(),
+            "bottom": labels[-1].copy(),
+            "left": labels[:, 0].copy(),
+            "right": labels[:, -1].copy(),
+        },
+    }
+
+
+def _global_edge(result, offset, side):
+    edge = result["edges"][side].astype(np.int64)
+    return np.where(edge > 0, edge + offset, 0)
+
+
+def stitch_blocks(results, n_block_rows, n_block_cols, eight_connected):
+    """
+    Merge the labels of all blocks (in row-major order) across their edges, returning
+    the offset of each block's labels and the root of every global label (label 0 is
+    no patch)
+    """
+    offsets = np.concatenate([[0], np.cumsum([r["n"] for r in results])])
+    parent = np.arange(offsets[-1] + 1, dtype=np.int64)
+
+    def block(i, j):
+        k = i * n_block_cols + j
+        return results[k], offsets[k]
+
+    for i in range(n_block_rows):
+        for j in range(n_block_cols):
+            result, offset = block(i, j)
+            if j + 1 < n_block_cols:
+                right, right_offset = block(i, j + 1)
+                union_edges(
+                    parent,
+                    _global_edge(result, offset, "right"),
+                    _global_edge(right, right_offset, "left"),
+                    eight_connected,
+                )
+            if i + 1 < n_block_rows:
+                below, below_offset = block(i + 1, j)
+                bottom = _global_edge(result, offset, "bottom")
+                union_edges(
+                    parent,
+                    bottom,
+                    _global_edge(below, below_offset, "top"),
+                    eight_connected,
+                )
+                # Corners touching the blocks diagonally below
+                if eight_connected and j + 1 < n_block_cols:
+                    diagonal, diagonal_offset = block(i + 1, j + 1)
+                    top = _global_edge(diagonal, diagonal_offset, "top")
+                    if bottom[-1] and top[0]:
+                        union_edges(parent, bottom[-1:], top[:1], False)
+                if eight_connected and j > 0:
+                    diagonal, diagonal_offset = block(i + 1, j - 1)
+                    top = _global_edge(diagonal, diagonal_offset, "top")
+                    if bottom[0] and top[-1]:
+                        union_edges(parent, bottom[:1], top[-1:], False)
+
+    return offsets, resolve_roots(parent)
+
+
+def merge_patches(results, roots):
+    """
+    Combine the statistics of the labels of every block into one row per patch.
+    Returns the patch table (as a dict of columns, in pixel units), the patch number of
+    every global label, and the number of blocks each patch spans.
+    """
+    patch_of, inverse = np.unique(roots[1:], return_inverse=True)
+    n_patches = patch_of.size
+    patch_ids = np.zeros(roots.size, dtype=np.int64)
+    patch_ids[1:] = inverse + 1
+
+    def concat(key):
+        return np.concatenate([r[key] for r in results])
+
+    areas = np.zeros((n_patches, 3), dtype=np.float64)
+    np.add.at(areas, inverse, concat("areas"))
+    bounds = concat("bounds")
+    table = {
+        "n_pixels": np.bincount(inverse, concat("n_pixels"), n_patches).astype(
+            np.int64
+        ),
+        "areas": areas,
+        "sum_row": np.bincount(inverse, concat("sum_row"), n_patches),
+        "sum_col": np.bincount(inverse, concat("sum_col"), n_patches),
+        "bounds": np.stack(
+            [
+                np.full(n_patches, np.iinfo(np.int64).max),
+                np.full(n_patches, np.iinfo(np.int64).max),
+                np.full(n_patches, -1),
+                np.full(n_patches, -1),
+            ],
+            axis=1,
+        ),
+    }
+    for k, func in enumerate([np.minimum, np.minimum, np.maximum, np.maximum]):
+        func.at(table["bounds"][:, k], inverse, bounds[:, k])
+
+    return table, patch_ids, np.bincount(inverse, minlength=n_patches)
+
+
+def write_patch_table(table, transform, out_file, min_area=0):
+    """Write one CSV row per patch of at least min_area hectares"""
+    x0, x_res, y0, y_res = transform.c, transform.a, transform.f, -transform.e
+    area = table["areas"].sum(axis=1)
+    n_written = 0
+    with open(out_file, "w") as f:
+        f.write(",".join(PATCH_COLUMNS) + "\n")
+        for k in np.nonzero(area >= min_area)[0]:
+            min_row, min_col, max_row, max_col = table["bounds"][k]
+            f.write(
+                f"{k + 1},{table['n_pixels'][k]},{area[k]:.4f},"
+                + ",".join(f"{a:.4f}" for a in table["areas"][k])
+                + f",{CONVERSION_CODES[int(np.argmax(table['areas'][k]))]},"
+                f"{x0 + (table['sum_col'][k] / area[k] + 0.5) * x_res:.6f},"
+                f"{y0 - (table['sum_row'][k] / area[k] + 0.5) * y_res:.6f},"
+                f"{x0 + min_col * x_res:.6f},{y0 - (max_row + 1) * y_res:.6f},"
+                f"{x0 + (max_col + 1) * x_res:.6f},{y0 - min_row * y_res:.6f}\n"
+            )
+            n_written += 1
+    logger.info(f"Wrote {n_written} patches to {out_file}")
+
+
+def write_patch_polygons(
+    reader,
+    windows,
+    offsets,
+    patch_ids,
+    n_blocks_per_patch,
+    table,
+    transform,
+    eight_connected,
+    out_file,
+    n_threads,
+    min_area=0,
+):
+    """
+    Write patches of at least min_area hectares as GeoJSON features (one per line).
+    Blocks are labelled again and polygonized in parallel. Patches within one block are
+    written as they are found, and the pieces of patches spanning several blocks are
+    dissolved at the end.
+    """
+    from rasterio.features import shapes
+    from rasterio.windows import Window
+    from rasterio.windows import transform as window_transform
+    from shapely.geometry import mapping
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    area = table["areas"].sum(axis=1)
+    keep = area >= min_area
+
+    def polygonize(k):
+        row_off, col_off, nrows, ncols = windows[k]
+        _, labels, _ = _block_labels(reader, windows[k], eight_connected)
+        ids = np.where(labels > 0, patch_ids[offsets[k] + labels], 0).astype(np.int32)
+        pieces = {}
+        for geometry, patch in shapes(
+            ids,
+            mask=ids > 0,
+            connectivity=8 if eight_connected else 4,
+            transform=window_transform(Window(col_off, row_off, ncols, nrows), transform),
+        ):
+            patch = int(patch)
+            if keep[patch - 1]:
+                pieces.setdefault(patch, []).append(shape(geometry))
+        return pieces
+
+    def feature(patch, geometry):
+        return {
+            "type": "Feature",
+            "properties": {
+                "patch_id": patch,
+                "area_ha": round(float(area[patch - 1]), 4),
+                "dominant_code": CONVERSION_CODES[
+                    int(np.argmax(table["areas"][patch - 1]))
+                ],
+            },
+            "geometry": mapping(geometry),
+        }
+
+    spanning = {}
+    n_written = 0
+    with open(out_file, "w") as f, concurrent.futures.ThreadPoolExecutor(
+        n_threads
+    ) as executor:
+        for pieces in executor.map(polygonize, range(len(windows))):
+            for patch, geometries in pieces.items():
+                if n_blocks_per_patch[patch - 1] > 1:
+                    spanning.setdefault(patch, []).extend(geometries)
+                else:
+                    f.write(json.dumps(feature(patch, unary_union(geometries))) + "\n")
+                    n_written += 1
+        logger.info(f"Dissolving {len(spanning)} patches that span blocks")
+        for patch, geometries in sorted(spanning.items()):
+            f.write(json.dumps(feature(patch, unary_union(geometries))) + "\n")
+            n_written += 1
+    logger.info(f"Wrote {n_written} patch polygons to {out_file}")
+
+
+def extract_patches(
+    in_file,
+    out_table,
+    out_polygons=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    n_threads=None,
+    eight_connected=True,
+    min_area=0,
+):
+    """Label, stitch and write the conversion patches of a transition raster"""
+    import rasterio
+
+    with rasterio.open(in_file) as ds:
+        height, width = ds.height, ds.width
+        transform = ds.transform
+    x_res = transform.a
+    y_res = -transform.e
+    # Latitude of the center of each row
+    y = transform.f - (np.arange(height) + 0.5) * y_res
+
+    windows = list(threaded_executor.block_windows(height, width, block_size))
+    n_block_rows = -(-height // block_size)
+    n_block_cols = -(-width // block_size)
+    # Blocks are read once per pass, too far apart for a tile cache to help
+    reader = raster_reader.ThreadLocalRasterReader(in_file, cache_bytes=0)
+    logger.info(f"Labelling {len(windows)} blocks of {in_file}")
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        results = list(
+            executor.map(
+                lambda window: _label_one_block(
+                    reader, window, y, x_res, y_res, eight_connected
+                ),
+                windows,
+            )
+        )
+
+    offsets, roots = stitch_blocks(
+        results, n_block_rows, n_block_cols, eight_connected
+    )
+    table, patch_ids, n_blocks_per_patch = merge_patches(results, roots)
+    del results
+    logger.info(
+        f"Found {table['n_pixels'].size} patches, "
+        f"{int((n_blocks_per_patch > 1).sum())} of them spanning blocks"
+    )
+    write_patch_table(table, transform, out_table, min_area)
+
+    if out_polygons is not None:
+        write_patch_polygons(
+            reader,
+            windows,
+            offsets,
+            patch_ids,
+            n_blocks_per_patch,
+            table,
+            transform,
+            eight_connected,
+            out_polygons,
+            n_threads,
+            min_area,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract contiguous natural conversion patches"
+    )
+    parser.add_argument(
+        "--in-file",
+        default=str(
+            DATA_PATH
+            / f"natural-conversion_300m_{INITIAL_YEAR}-{FINAL_YEAR}_transition.tif"
+        ),
+        help="Transition raster (codes 0-6), for example the transition output of "
+        "natural_conversion.py --executor threads, or NETCDF:<file>.nc:transition",
+    )
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--n-threads", type=int, default=None)
+    parser.add_argument(
+        "--connectivity",
+        type=int,
+        choices=[4, 8],
+        default=8,
+        help="Pixels touching only at corners are in the same patch with 8",
+    )
+    parser.add_argument(
+        "--min-area",
+        type=float,
+        default=0,
+        help="Only write patches of at least this many hectares",
+    )
+    parser.add_argument(
+        "--polygons",
+        action="store_true",
+        help="Also write the patches as polygons, as newline-delimited GeoJSON",
+    )
+    parser.add_argument("--no-upload", action="store_true")
+    args = parser.parse_args()
+
+    in_file = args.in_file
+    if not Path(in_file).exists() and not in_file.startswith(("/vsi", "NETCDF:")):
+        logger.info(f"Downloading {Path(in_file).name} from s3")
+        Path(in_file).parent.mkdir(parents=True, exist_ok=True)
+        uploads.s3_client().download_file(
+            OUT_S3_BUCKET, f"{OUT_S3_PREFIX}/{Path(in_file).name}", in_file
+        )
+
+    stem = f"natural-conversion_patches_{INITIAL_YEAR}-{FINAL_YEAR}"
+    in_path = Path(in_file.split(":")[1] if in_file.startswith("NETCDF:") else in_file)
+    out_table = in_path.parent / f"{stem}.csv"
+    out_polygons = in_path.parent / f"{stem}.geojsonl" if args.polygons else None
+    extract_patches(
+        in_file,
+        out_table,
+        out_polygons,
+        block_size=args.block_size,
+        n_threads=args.n_threads,
+        eight_connected=args.connectivity == 8,
+        min_area=args.min_area,
+    )
+
+    if not args.no_upload:
+        with uploads.UploadPipeline(OUT_S3_BUCKET, OUT_S3_PREFIX) as uploader:
+            for out_file in [out_table, out_polygons]:
+                if out_file is not None:
+                    uploader.submit(out_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,637 @@
+"""
+Area-weighted fractions of the values of categorical raster bands within zones (for
+example the SDG 15.3.1 bands within ecoregions, as in
+thresholds-maps/thresholds_vs_degradation.R), using the exact coverage of each cell
+by each zone, as exactextractr::exact_extract(coverage_area = TRUE) does.
+
+The coverage of each zone is computed once and cached. It is exact: by Green's theorem,
+the area of a zone within a cell is an integral along the zone boundary, so each edge
+of the zone adds its part of the area of the cells it crosses, and of the cells to its
+left in the same row as a running sum. Interior and boundary cells are found in one
+pass over the edges, without intersecting the zone with each cell. Coverage is stored
+as runs of cells fully inside the zone plus the list of boundary cells with their
+fractions, so it stays small for large zones.
+
+The raster is then read in one pass, block by block, by a pool of threads. For each
+block, and each zone overlapping it, the area of each value of each band is summed,
+weighting cells by their coverage and their area (kernels.calc_cell_area, in
+hectares). Cells with the no data value of a band are skipped.
+
+Example:
+
+    python coverage_fractions.py --in-file /data/TrendsEarth_SDG15.3.1_2000-2023.tif \
+        --zones /data/Ecoregions2017.shp --filter REALM=Neotropic \
+        --bands 1 2 5 6 9 10 11 14 --soc-bands 4 8 13
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import logging
+from pathlib import Path
+
+import kernels
+import numba
+import numpy as np
+import raster_reader
+import threaded_executor
+
+DATA_PATH = Path("/data")
+
+DEFAULT_BLOCK_SIZE = 1024
+
+# Cells of a zone whose coverage is computed at once
+STRIP_CELLS = 1 << 22
+
+# Cells covered by less than this fraction are outside of a zone, and by more than one
+# minus this fraction inside it. Sums of the coverage are exact to about 1e-12.
+COVERAGE_TOLERANCE = 1e-9
+
+COVERAGE_VERSION = 1
+
+# Names of the bands of the Trends.Earth SDG 15.3.1 raster, used when the raster has
+# 14 bands without descriptions
+SDG_BAND_NAMES = [
+    "sdg_2000_15",
+    "prod_deg_2001_15",
+    "lc_deg_2000_15",
+    "soc_deg_2000_15",
+    "sdg_2004_19",
+    "prod_deg_2004_19",
+    "lc_deg_2015_19",
+    "soc_deg_2015_19",
+    "sdg_status_19",
+    "sdg_2008_23",
+    "prod_deg_2008_23",
+    "lc_deg_2015_23",
+    "soc_deg_2015_23",
+    "sdg_status_23",
+]
+
+# Percent change in soil organic carbon counted as degradation (at or below
+# -SOC_THRESHOLD) or improvement (at or above SOC_THRESHOLD)
+SOC_THRESHOLD = 10
+
+FRACTION_COLUMNS = ["band", "value", "area", "fraction"]
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+
+logger = logging.getLogger(__name__)
+
+
+def recode_soc(values):
+    """
+    Recode percent changes in soil organic carbon to -1 (degradation), 0 (stable) and
+    1 (improvement). Values at or below -32768 (the no data value of the SDG raster)
+    are kept.
+    """
+    return np.select(
+        [values <= -32768, values <= -SOC_THRESHOLD, values < SOC_THRESHOLD],
+        [values, -1, 0],
+        1,
+    )
+
+
+class ZoneCoverage:
+    """
+    Coverage of the cells of a raster by a zone: runs of cells fully inside the zone
+    (row, start and end column) and boundary cells (row, column and fraction covered),
+    both sorted by row
+    """
+
+    def __init__(
+        self, span_rows, span_starts, span_ends, cell_rows, cell_cols, cell_fractions
+    ):
+        self.span_rows = np.asarray(span_rows, dtype=np.int64)
+        self.span_starts = np.asarray(span_starts, dtype=np.int64)
+        self.span_ends = np.asarray(span_ends, dtype=np.int64)
+        self.cell_rows = np.asarray(cell_rows, dtype=np.int64)
+        self.cell_cols = np.asarray(cell_cols, dtype=np.int64)
+        self.cell_fractions = np.asarray(cell_fractions, dtype=np.float64)
+        rows = np.concatenate([self.span_rows, self.cell_rows])
+        cols = np.concatenate([self.span_starts, self.span_ends - 1, self.cell_cols])
+        if rows.size:
+            self.bounds = (rows.min(), cols.min(), rows.max() + 1, cols.max() + 1)
+        else:
+            self.bounds = None
+
+    @property
+    def n_cells(self):
+        """Coverage in cells"""
+        spans = (self.span_ends - self.span_starts).sum()
+
+        return float(spans + self.cell_fractions.sum())
+
+    def overlaps(self, window):
+        if self.bounds is None:
+            return False
+        row_off, col_off, nrows, ncols = window
+        min_row, min_col, max_row, max_col = self.bounds
+
+        return (
+            min_row < row_off + nrows
+            and row_off < max_row
+            and min_col < col_off + ncols
+            and col_off < max_col
+        )
+
+    def weights(self, window):
+        """
+        Return the indexes (into the flattened window) of the cells of window covered
+        by the zone, and the fraction of each covered
+        """
+        row_off, col_off, nrows, ncols = window
+
+        first, last = np.searchsorted(self.span_rows, [row_off, row_off + nrows])
+        starts = np.maximum(self.span_starts[first:last], col_off)
+        ends = np.minimum(self.span_ends[first:last], col_off + ncols)
+        keep = ends > starts
+        starts = starts[keep]
+        lengths = ends[keep] - starts
+        base = (self.span_rows[first:last][keep] - row_off) * ncols + starts - col_off
+        # Index of each cell of the runs: the start of its run plus its position in it
+        span_index = np.repeat(base - (np.cumsum(lengths) - lengths), lengths)
+        span_index += np.arange(span_index.size)
+
+        first, last = np.searchsorted(self.cell_rows, [row_off, row_off + nrows])
+        rows = self.cell_rows[first:last]
+        cols = self.cell_cols[first:last]
+        inside = (cols >= col_off) & (cols < col_off + ncols)
+        cell_index = (rows[inside] - row_off) * ncols + cols[inside] - col_off
+
+        return (
+            np.concatenate([span_index, cell_index]),
+            np.concatenate(
+                [np.ones(span_index.size), self.cell_fractions[first:last][inside]]
+            ),
+        )
+
+    def save(self, path):
+        path = Path(path)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                version=COVERAGE_VERSION,
+                span_rows=self.span_rows,
+                span_starts=self.span_starts,
+                span_ends=self.span_ends,
+                cell_rows=self.cell_rows,
+                cell_cols=self.cell_cols,
+                cell_fractions=self.cell_fractions,
+            )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != COVERAGE_VERSION:
+                raise ValueError(
+                    f"{path} has coverage version {int(data['version'])}, expected "
+                    f"{COVERAGE_VERSION}"
+                )
+            return cls(
+                data["span_rows"],
+                data["span_starts"],
+                data["span_ends"],
+                data["cell_rows"],
+                data["cell_cols"],
+                data["cell_fractions"],
+            )
+
+
+def _runs(mask):
+    """Rows, start and end columns of the runs of True in a 2D boolean array"""
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    rows, starts = np.nonzero(np.diff(padded, axis=1) == 1)
+    _, ends = np.nonzero(np.diff(padded, axis=1) == -1)
+
+    return rows, starts, ends
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _add_piece(full, partial, row, p, q, dv, ncols):
+    # A piece of an edge between p and q, within one column (or left or right of the
+    # window)
+    col = int(np.floor(p))
+    if col < 0:
+        return
+    full[row, 0] += dv
+    if col < ncols:
+        full[row, col] -= dv
+        partial[row, col] += ((p + q) / 2 - col) * dv
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def edge_coverage(u0, v0, u1, v1, row_start, nrows, ncols):
+    """
+    Signed area of polygon edges (from u0, v0 to u1, v1, in pixels of a window, with v
+    down) within each cell of rows row_start to row_start + nrows of the window.
+
+    By Green's theorem the area of a polygon within a cell is the integral, along its
+    boundary, of the horizontal extent of the cell to the left of the boundary. So each
+    piece of an edge within a cell adds its dv times the part of the cell left of it,
+    and its dv times the whole cell to each cell to its left in the same row. The
+    latter are added to full as differences along the row, to be summed with cumsum.
+    """
+    full = np.zeros((nrows, ncols + 1), dtype=np.float64)
+    partial = np.zeros((nrows, ncols), dtype=np.float64)
+    for k in range(u0.size):
+        if v0[k] == v1[k]:
+            continue
+        v_min = min(v0[k], v1[k]) - row_start
+        v_max = max(v0[k], v1[k]) - row_start
+        slope = (u1[k] - u0[k]) / (v1[k] - v0[k])
+        direction = 1.0 if v1[k] > v0[k] else -1.0
+        for row in range(max(int(np.floor(v_min)), 0), min(int(np.ceil(v_max)), nrows)):
+            low = max(v_min, row)
+            high = min(v_max, row + 1)
+            if high <= low:
+                continue
+            dv = direction * (high - low)
+            ua = u0[k] + (low + row_start - v0[k]) * slope
+            ub = u0[k] + (high + row_start - v0[k]) * slope
+            u_min = min(ua, ub)
+            u_max = max(ua, ub)
+            if u_max == u_min:
+                _add_piece(full, partial, row, u_min, u_min, dv, ncols)
+                continue
+            # Split the piece at the column edges within the window
+            p = u_min
+            edge = max(int(np.floor(u_min)) + 1, 0)
+            while p < u_max:
+                q = min(float(edge), u_max) if edge <= ncols else u_max
+                if q > p:
+                    _add_piece(
+                        full, partial, row, p, q, dv * (q - p) / (u_max - u_min), ncols
+                    )
+                p = q
+                edge += 1
+
+    return full, partial
+
+
+def _polygon_edges(geom, transform, col_start, row_start):
+    """
+    Edges of the rings of a polygonal geometry, with exteriors counterclockwise, as
+    arrays of u0, v0, u1, v1 in pixels from col_start, row_start
+    """
+    import shapely
+    from shapely.geometry.polygon import orient
+
+    polygons = [
+        orient(part)
+        # make_valid can return collections of multipolygons
+        for part in shapely.get_parts(shapely.get_parts(geom))
+        if part.geom_type == "Polygon" and not part.is_empty
+    ]
+    rings = [
+        np.asarray(ring.coords)
+        for polygon in polygons
+        for ring in [polygon.exterior, *polygon.interiors]
+    ]
+    if not rings:
+        return tuple(np.zeros(0) for _ in range(4))
+    u = [(ring[:, 0] - transform.c) / transform.a - col_start for ring in rings]
+    v = [(ring[:, 1] - transform.f) / transform.e - row_start for ring in rings]
+
+    return (
+        np.concatenate([ring[:-1] for ring in u]),
+        np.concatenate([ring[:-1] for ring in v]),
+        np.concatenate([ring[1:] for ring in u]),
+        np.concatenate([ring[1:] for ring in v]),
+    )
+
+
+def zone_coverage(geom, transform, height, width):
+    """
+    Exact coverage of the cells of a raster (with height, width and transform) by a
+    polygon or multipolygon in the coordinates of the raster
+    """
+    import shapely
+
+    if not geom.is_valid:
+        geom = shapely.make_valid(geom)
+    min_x, min_y, max_x, max_y = geom.bounds
+    col_start = max(int(np.floor((min_x - transform.c) / transform.a)), 0)
+    col_end = min(int(np.ceil((max_x - transform.c) / transform.a)), width)
+    row_start = max(int(np.floor((max_y - transform.f) / transform.e)), 0)
+    row_end = min(int(np.ceil((min_y - transform.f) / transform.e)), height)
+    if col_end <= col_start or row_end <= row_start:
+        return ZoneCoverage([], [], [], [], [], [])
+
+    u0, v0, u1, v1 = _polygon_edges(geom, transform, col_start, row_start)
+    edge_min = np.minimum(v0, v1)
+    edge_max = np.maximum(v0, v1)
+    ncols = col_end - col_start
+    parts = {name: [] for name in ["span_rows", "span_starts", "span_ends"]}
+    cells = {name: [] for name in ["rows", "cols", "fractions"]}
+    strip_rows = max(STRIP_CELLS // ncols, 1)
+    for strip_start in range(0, row_end - row_start, strip_rows):
+        nrows = min(strip_rows, row_end - row_start - strip_start)
+        crossing = (edge_min < strip_start + nrows) & (edge_max > strip_start)
+        full, partial = edge_coverage(
+            u0[crossing],
+            v0[crossing],
+            u1[crossing],
+            v1[crossing],
+            strip_start,
+            nrows,
+            ncols,
+        )
+        # Rings are counterclockwise in x, y, so clockwise in columns and rows
+        fractions = -(np.cumsum(full[:, :-1], axis=1) + partial)
+
+        rows, starts, ends = _runs(fractions >= 1 - COVERAGE_TOLERANCE)
+        parts["span_rows"].append(rows + row_start + strip_start)
+        parts["span_starts"].append(starts + col_start)
+        parts["span_ends"].append(ends + col_start)
+
+        rows, cols = np.nonzero(
+            (fractions > COVERAGE_TOLERANCE) & (fractions < 1 - COVERAGE_TOLERANCE)
+        )
+        cells["rows"].append(rows + row_start + strip_start)
+        cells["cols"].append(cols + col_start)
+        cells["fractions"].append(fractions[rows, cols])
+
+    return ZoneCoverage(
+        *(np.concatenate(arrays) for arrays in parts.values()),
+        *(np.concatenate(arrays) for arrays in cells.values()),
+    )
+
+
+def cached_zone_coverage(geom, transform, height, width, cache_dir=None):
+    """
+    zone_coverage, read from cache_dir if it was computed before for the same zone
+    geometry and raster grid
+    """
+    if cache_dir is None:
+        return zone_coverage(geom, transform, height, width)
+
+    key = hashlib.blake2b(digest_size=16)
+    key.update(geom.wkb)
+    key.update(repr((tuple(transform)[:6], height, width)).encode())
+    path = Path(cache_dir) / f"coverage_{key.hexdigest()}.npz"
+    if path.exists():
+        return ZoneCoverage.load(path)
+    coverage = zone_coverage(geom, transform, height, width)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    coverage.save(path)
+
+    return coverage
+
+
+def _histogram(values, areas):
+    """Distinct values and the sum of areas of each"""
+    if values.dtype.kind in "iub" and values.dtype.itemsize <= 2:
+        # Small integer types: one bin per possible value
+        offset = int(np.iinfo(values.dtype).min) if values.dtype.kind == "i" else 0
+        sums = np.bincount(
+            values.astype(np.int64) - offset,
+            weights=areas,
+            minlength=1 << (8 * values.dtype.itemsize),
+        )
+        present = np.nonzero(sums)[0]
+
+        return present + offset, sums[present]
+
+    distinct, inverse = np.unique(values, return_inverse=True)
+
+    return distinct, np.bincount(inverse, weights=areas, minlength=distinct.size)
+
+
+def _block_histograms(readers, bands, window, zones, row_areas):
+    """
+    Histograms of the areas of the values of each band (a list of (band index, no data
+    value, recode)) for each zone (a list of (zone id, ZoneCoverage)) overlapping
+    window
+    """
+    row_off, _, _, ncols = window
+    overlapping = [
+        (zone_id, coverage)
+        for zone_id, coverage in zones
+        if coverage.overlaps(window)
+    ]
+    if not overlapping:
+        return []
+    data = [readers[band].read(window).ravel() for band, _, _ in bands]
+
+    results = []
+    for zone_id, coverage in overlapping:
+        index, fractions = coverage.weights(window)
+        if not index.size:
+            continue
+        areas = fractions * row_areas[row_off + index // ncols]
+        for values, (band, nodata, recode) in zip(data, bands):
+            values = values[index]
+            valid = values == values
+            if nodata is not None:
+                valid &= values != nodata
+            zone_values = values[valid]
+            if recode is not None:
+                zone_values = recode(zone_values)
+            results.append((zone_id, band, *_histogram(zone_values, areas[valid])))
+
+    return results
+
+
+def band_names(ds):
+    """Names of the bands of a raster: descriptions, else the SDG 15.3.1 names"""
+    if all(ds.descriptions):
+        return list(ds.descriptions)
+    if ds.count == len(SDG_BAND_NAMES):
+        return list(SDG_BAND_NAMES)
+
+    return [f"band_{band}" for band in range(1, ds.count + 1)]
+
+
+def fraction_table(
+    in_file,
+    zones,
+    bands=None,
+    soc_bands=(),
+    block_size=DEFAULT_BLOCK_SIZE,
+    n_threads=None,
+    cache_dir=None,
+):
+    """
+    Area (in hectares) of each value of each of bands (1-based band numbers, all by
+    default) within each zone of zones, a list of (zone id, geometry) in the
+    coordinates of in_file. Values of soc_bands are recoded with recode_soc. Returns a
+    dict of {(zone id, band name): {value: area}}.
+    """
+    import rasterio
+
+    with rasterio.open(in_file) as ds:
+        height, width = ds.height, ds.width
+        transform = ds.transform
+        is_geographic = ds.crs is None or ds.crs.is_geographic
+        names = band_names(ds)
+        nodatas = ds.nodatavals
+        count = ds.count
+    bands = sorted(set(bands or range(1, count + 1)) | set(soc_bands))
+    band_specs = [
+        (band, nodatas[band - 1], recode_soc if band in soc_bands else None)
+        for band in bands
+    ]
+
+    if is_geographic:
+        y = transform.f + (np.arange(height) + 0.5) * transform.e
+        row_areas = kernels.calc_cell_area(y, transform.a, -transform.e)
+    else:
+        row_areas = np.full(height, abs(transform.a * transform.e) / 1e4)
+
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        logger.info(f"Computing the coverage of {len(zones)} zones")
+        coverages = list(
+            executor.map(
+                lambda zone: cached_zone_coverage(
+                    zone[1], transform, height, width, cache_dir
+                ),
+                zones,
+            )
+        )
+        covered = [
+            (zone_id, coverage)
+            for (zone_id, _), coverage in zip(zones, coverages)
+            if coverage.bounds is not None
+        ]
+        windows = [
+            window
+            for window in threaded_executor.block_windows(height, width, block_size)
+            if any(coverage.overlaps(window) for _, coverage in covered)
+        ]
+        logger.info(
+            f"Summing {len(bands)} bands of {in_file} over {len(covered)} zones, in "
+            f"{len(windows)} blocks"
+        )
+        # Blocks are read once, too far apart for a tile cache to help
+        readers = {
+            band: raster_reader.ThreadLocalRasterReader(in_file, band, cache_bytes=0)
+            for band in bands
+        }
+        table = {}
+        try:
+            for results in executor.map(
+                lambda window: _block_histograms(
+                    readers, band_specs, window, covered, row_areas
+                ),
+                windows,
+            ):
+                for zone_id, band, values, areas in results:
+                    histogram = table.setdefault((zone_id, names[band - 1]), {})
+                    for value, area in zip(values.tolist(), areas.tolist()):
+                        histogram[value] = histogram.get(value, 0.0) + area
+        finally:
+            for reader in readers.values():
+                reader.close()
+
+    return table
+
+
+def write_fraction_table(table, out_file, id_column="ECO_ID"):
+    """
+    Write one CSV row per zone, band and value, with its area (in hectares) and its
+    fraction of the area of the zone with data in that band
+    """
+    n_written = 0
+    with open(out_file, "w") as f:
+        f.write(",".join([id_column] + FRACTION_COLUMNS) + "\n")
+        for zone_id, band in sorted(table):
+            histogram = table[(zone_id, band)]
+            total = sum(histogram.values())
+            for value in sorted(histogram):
+                area = histogram[value]
+                if area > 0:
+                    f.write(f"{zone_id},{band},{value},{area:.4f},{area / total:.6f}\n")
+                    n_written += 1
+    logger.info(f"Wrote {n_written} rows to {out_file}")
+
+
+def read_zones(path, id_column, filters=(), crs=None):
+    """
+    Read the zones of a vector file as a list of (zone id, geometry), keeping features
+    whose columns match filters (a list of "COLUMN=VALUE") and reprojecting to crs (a
+    rasterio CRS). geopandas is installed in the image with geocube.
+    """
+    import geopandas
+
+    zones = geopandas.read_file(path)
+    for column_filter in filters:
+        column, value = column_filter.split("=", 1)
+        zones = zones[zones[column].astype(str) == value]
+    if crs is not None and zones.crs is not None:
+        zones = zones.to_crs(crs.to_wkt())
+    zones = zones[~zones.geometry.is_empty & zones.geometry.notna()]
+
+    return list(zip(zones[id_column].tolist(), zones.geometry.tolist()))
+
+
+def main():
+    import rasterio
+
+    parser = argparse.ArgumentParser(
+        description="Area-weighted fractions of raster values within zones"
+    )
+    parser.add_argument("--in-file", type=Path, required=True)
+    parser.add_argument(
+        "--zones", type=Path, required=True, help="Vector file of the zones"
+    )
+    parser.add_argument("--id-column", default="ECO_ID")
+    parser.add_argument(
+        "--filter",
+        action="append",
+        default=[],
+        help="Only use zones where COLUMN=VALUE, for example REALM=Neotropic",
+    )
+    parser.add_argument(
+        "--bands", type=int, nargs="+", default=None, help="1-based, all by default"
+    )
+    parser.add_argument(
+        "--soc-bands",
+        type=int,
+        nargs="+",
+        default=[],
+        help="Bands of percent change in soil organic carbon, recoded to -1, 0 and 1",
+    )
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--n-threads", type=int, default=None)
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=DATA_PATH / "coverage_cache",
+        help="Where the coverage of each zone is cached",
+    )
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=None,
+        help="Defaults to the input file name ending in _fractions.csv",
+    )
+    args = parser.parse_args()
+
+    with rasterio.open(args.in_file) as ds:
+        crs = ds.crs
+        count = ds.count
+    for band in (args.bands or []) + args.soc_bands:
+        if not 1 <= band <= count:
+            parser.error(f"{args.in_file} has no band {band}")
+
+    zones = read_zones(args.zones, args.id_column, args.filter, crs)
+    table = fraction_table(
+        args.in_file,
+        zones,
+        bands=args.bands,
+        soc_bands=args.soc_bands,
+        block_size=args.block_size,
+        n_threads=args.n_threads,
+        cache_dir=None if args.no_cache else args.cache_dir,
+    )
+    out = args.out or args.in_file.with_name(f"{args.in_file.stem}_fractions.csv")
+    write_fraction_table(table, out, args.id_column)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,19 @@
 import argparse
-import json
 import logging
 import os
 import tempfile
 from pathlib import Path
-from pathlib import PurePath
 
 import boto3
 import botocore
+import kernels
 import requests
 from osgeo import gdal
 
 OUT_S3_BUCKET = "trends.earth-private"
 OUT_S3_PREFIX = "cropland/300m"
+# Tiles quantized to uint8 (see kernels.quantize_cropland)
+OUT_S3_PREFIX_UINT8 = "cropland/300m-uint8"
 
 OUT_TILE_WIDTH_DEG = 10
 OUT_TILE_HEIGHT_DEG = 10
@@ -46,10 +47,6 @@ def log_progress(fraction, message=None, data=None):
     logger.info("%s - %.2f%%", message, 100 * fraction)
 
 
-with open(PurePath("/data/aws_credentials.json"), "r") as f:
-    aws_creds = json.load(f)
-
-
 def put_to_s3(filename: Path, bucket: str, prefix: str):
     client = boto3.client("s3")
     key = f"{prefix}/{filename.name}"
@@ -97,6 +94,38 @@ def warp_croplands(in_file, out_file, x_res, y_res, bounds):
     )
 
 
+def quantize_croplands(in_file, out_file):
+    """
+    Write a float cropland fraction raster as a uint8 COG, with the scale and no data
+    value needed to read the fractions back
+    """
+    in_ds = gdal.Open(in_file)
+    mem_ds = gdal.GetDriverByName("MEM").Create(
+        "", in_ds.RasterXSize, in_ds.RasterYSize, 1, gdal.GDT_Byte
+    )
+    mem_ds.SetGeoTransform(in_ds.GetGeoTransform())
+    mem_ds.SetProjection(in_ds.GetProjection())
+    band = mem_ds.GetRasterBand(1)
+    band.WriteArray(
+        kernels.quantize_cropland(in_ds.GetRasterBand(1).ReadAsArray())
+    )
+    band.SetNoDataValue(kernels.CROPLAND_UINT8_NODATA)
+    band.SetScale(kernels.CROPLAND_UINT8_SCALE)
+    band.SetOffset(0)
+    in_ds = None
+
+    gdal.Translate(
+        out_file,
+        mem_ds,
+        format="COG",
+        creationOptions=[
+            "COMPRESS=LZW",
+            "BIGTIFF=YES",
+            "NUM_THREADS=ALL_CPUS",
+        ],
+    )
+
+
 def get_tile_info(n):
     tile_uls = []
     for ul_x in range(MIN_TILE_X, MAX_TILE_X, OUT_TILE_WIDTH_DEG):
@@ -151,8 +180,19 @@ def main():
         required=True,
         help="Year(s) to process",
     )
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "uint8"],
+        default="float32",
+        help="Write cropland fractions as float32, or as uint8 with a scale of "
+        f"{kernels.CROPLAND_UINT8_SCALE} (a quarter of the size)",
+    )
     args = parser.parse_args()
     years = [str(year) for year in args.year]
+    if args.dtype == "uint8":
+        out_prefix = OUT_S3_PREFIX_UINT8
+    else:
+        out_prefix = OUT_S3_PREFIX
 
     tile_index = int(os.getenv("AWS_BATCH_JOB_ARRAY_INDEX", 280))
     bounds = get_tile_info(tile_index)
@@ -178,11 +218,18 @@ def main():
             f"Croplands_300m_{year}_"
             + f"{x_coord_to_str(bounds[0])}_{y_coord_to_str(bounds[3])}.tif"
         )
-        if key_exists(crop_out_file, CROP_S3_BUCKET, OUT_S3_PREFIX):
+        if key_exists(crop_out_file, CROP_S3_BUCKET, out_prefix):
             logger.info("Key already exists - skipping")
+        elif args.dtype == "uint8":
+            crop_float_file = crop_out_file.with_suffix(".float32.tif")
+            warp_croplands(str(crop_in_vrt), str(crop_float_file), x_res, y_res, bounds)
+            logger.info("Quantizing...")
+            quantize_croplands(str(crop_float_file), str(crop_out_file))
+            crop_float_file.unlink()
+            put_to_s3(crop_out_file, CROP_S3_BUCKET, out_prefix)
         else:
             warp_croplands(str(crop_in_vrt), str(crop_out_file), x_res, y_res, bounds)
-            put_to_s3(crop_out_file, CROP_S3_BUCKET, OUT_S3_PREFIX)
+            put_to_s3(crop_out_file, CROP_S3_BUCKET, out_prefix)
 
 
 if __name__ == "__main__":
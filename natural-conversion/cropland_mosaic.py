@@ -0,0 +1,415 @@
+"""
+Assemble the 10 degree cropland tiles written by cropland_match_to_esa.py into one
+global COG per year.
+
+The headers of all tiles are read once into a tile index (the window of each tile in
+the global grid, and whether it is aligned with it), which is saved and reused by later
+runs. Tiles are then read by a pool of threads and written by a single writer into a
+sparse, tiled and uncompressed GeoTIFF. Tiles on the output grid are copied as pixel
+windows, without resampling, and tiles that hold only no data (or zeros) are skipped.
+Overviews are built with GDAL_NUM_THREADS, and the file is then copied to a COG that
+reuses those overviews, so that the data are compressed only once. Several years are
+assembled at once in separate processes.
+
+Example:
+
+    python cropland_mosaic.py --year 2011 2019 --dtype uint8
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import uploads
+
+CROP_S3_BUCKET = "trends.earth-private"
+# Tiles written by cropland_match_to_esa.py, and the prefixes of the global mosaics
+# read by natural_conversion.py, for each dtype
+TILE_S3_PREFIX = {"float32": "cropland/300m", "uint8": "cropland/300m-uint8"}
+MOSAIC_S3_PREFIX = {"float32": "cropland", "uint8": "cropland/uint8"}
+
+TILE_PATTERN = re.compile(r"Croplands_300m_(\d{4})_(\d+[EW])_(\d+[NS])\.tif$")
+
+# Number of tiles in the global grid of 10 degree tiles
+N_TILES = 648
+
+# Years assembled at once, each by its own process
+DEFAULT_N_YEARS = 2
+
+# Tiles read ahead of the writer, per reader thread
+TILES_IN_FLIGHT_PER_THREAD = 2
+
+OVERVIEW_FACTORS = [2, 4, 8, 16, 32, 64, 128]
+
+# Block size of the mosaics and of their overviews
+BLOCK_SIZE = 512
+
+# Tolerance (in pixels) for treating a tile as aligned with the output grid
+ALIGNMENT_TOLERANCE = 1e-6
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+
+logging.getLogger("botocore").setLevel(logging.WARNING)
+logging.getLogger("s3transfer").setLevel(logging.WARNING)
+logging.getLogger("boto3").setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+
+def _log_file_size(out_file):
+    file_size = os.stat(out_file).st_size
+    logger.info(
+        "File size for %s is %s GB", out_file, round(file_size / (1024 ** 3), 2)
+    )
+
+
+def list_tiles(years, tile_dir=None, prefix=TILE_S3_PREFIX["float32"]):
+    """
+    Return {year: [paths]} of the tiles for each year, from tile_dir if given or from
+    s3 otherwise (as /vsis3/ paths)
+    """
+    if tile_dir is not None:
+        paths = [str(path) for path in sorted(Path(tile_dir).glob("Croplands_300m_*"))]
+    else:
+        paginator = uploads.s3_client().get_paginator("list_objects_v2")
+        paths = [
+            f"/vsis3/{CROP_S3_BUCKET}/{item['Key']}"
+            for page in paginator.paginate(
+                Bucket=CROP_S3_BUCKET, Prefix=f"{prefix}/Croplands_300m_"
+            )
+            for item in page.get("Contents", [])
+        ]
+
+    tiles = {year: [] for year in years}
+    for path in paths:
+        match = TILE_PATTERN.search(path)
+        if match and int(match.group(1)) in tiles:
+            tiles[int(match.group(1))].append(path)
+    for year, year_paths in tiles.items():
+        if len(year_paths) != N_TILES:
+            logger.warning(f"Found {len(year_paths)} of {N_TILES} tiles for {year}")
+
+    return tiles
+
+
+def read_tile_header(path):
+    """Return the georeferencing, data type and scaling of a tile, without its data"""
+    import rasterio
+
+    with rasterio.open(path) as ds:
+        return {
+            "path": path,
+            "bounds": list(ds.bounds),
+            "res": list(ds.res),
+            "height": ds.height,
+            "width": ds.width,
+            "dtype": ds.dtypes[0],
+            "nodata": ds.nodata,
+            "scale": ds.scales[0],
+            "offset": ds.offsets[0],
+        }
+
+
+def tile_window(header, res):
+    """
+    Return (row_off, col_off, nrows, ncols) of a tile in the global grid of pixel size
+    res, and whether it lies exactly on that grid
+    """
+    left, bottom, right, top = header["bounds"]
+    col = (left + 180) / res[0]
+    row = (90 - top) / res[1]
+    ncols = (right - left) / res[0]
+    nrows = (top - bottom) / res[1]
+    aligned = all(
+        abs(value - round(value)) < ALIGNMENT_TOLERANCE
+        for value in (col, row, ncols, nrows)
+    ) and (round(nrows), round(ncols)) == (header["height"], header["width"])
+
+    return (round(row), round(col), round(nrows), round(ncols)), aligned
+
+
+def build_tile_index(tiles, index_file, n_threads):
+    """
+    Read the header of every tile into an index of their windows in the global grid,
+    reusing index_file for tiles already in it. Raises ValueError if tiles differ in
+    data type or scaling.
+    """
+    index_file = Path(index_file)
+    if index_file.exists():
+        with open(index_file) as f:
+            index = json.load(f)
+    else:
+        index = {"tiles": {}}
+    known = {tile["path"] for year in index["tiles"].values() for tile in year}
+    new_paths = [
+        path for paths in tiles.values() for path in paths if path not in known
+    ]
+
+    if new_paths:
+        logger.info(f"Reading headers of {len(new_paths)} tiles")
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            headers = list(executor.map(read_tile_header, new_paths))
+        if "res" not in index:
+            first = headers[0]
+            index.update(
+                {
+                    key: first[key]
+                    for key in ["res", "dtype", "nodata", "scale", "offset"]
+                }
+            )
+            index["height"] = round(180 / first["res"][1])
+            index["width"] = round(360 / first["res"][0])
+        for header in headers:
+            for key in ["dtype", "nodata", "scale", "offset"]:
+                # A NaN no data value is unequal to itself
+                both_nan = header[key] != header[key] and index[key] != index[key]
+                if header[key] != index[key] and not both_nan:
+                    raise ValueError(
+                        f"{header['path']} has {key} {header[key]}, but other tiles "
+                        f"have {index[key]}"
+                    )
+            window, aligned = tile_window(header, index["res"])
+            year = TILE_PATTERN.search(header["path"]).group(1)
+            index["tiles"].setdefault(year, []).append(
+                {
+                    "path": header["path"],
+                    "bounds": header["bounds"],
+                    "window": window,
+                    "aligned": aligned,
+                }
+            )
+        with open(index_file, "w") as f:
+            json.dump(index, f, indent=1)
+        logger.info(f"Wrote tile index {index_file}")
+    else:
+        logger.info(f"Reusing tile index {index_file}")
+
+    return index
+
+
+def read_tile(tile, index):
+    """
+    Read a tile for writing at its window in the global grid, resampling it onto the
+    grid if it isn't aligned. Returns None if the tile holds only no data (or zeros).
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.warp import reproject
+    from rasterio.warp import Resampling
+
+    row_off, col_off, nrows, ncols = tile["window"]
+    with rasterio.open(tile["path"]) as ds:
+        if tile["aligned"]:
+            data = ds.read(1)
+        else:
+            logger.info(f"Resampling {tile['path']} onto the output grid")
+            data = np.full(
+                (nrows, ncols),
+                index["nodata"] if index["nodata"] is not None else 0,
+                dtype=index["dtype"],
+            )
+            reproject(
+                rasterio.band(ds, 1),
+                data,
+                dst_transform=from_origin(
+                    -180 + col_off * index["res"][0],
+                    90 - row_off * index["res"][1],
+                    *index["res"],
+                ),
+                dst_crs=ds.crs,
+                dst_nodata=index["nodata"],
+                resampling=Resampling.average,
+            )
+
+    fill = index["nodata"] if index["nodata"] is not None else 0
+    if np.all(data == fill):
+        return None
+
+    return data
+
+
+def write_tiles(dst, tiles, index, n_threads):
+    """
+    Read tiles with a pool of threads and write them into dst from this thread,
+    keeping at most TILES_IN_FLIGHT_PER_THREAD tiles per thread in memory. Returns the
+    number of tiles written.
+    """
+    from rasterio.windows import Window
+
+    tile_iter = iter(tiles)
+    n_written = 0
+    n_done = 0
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        pending = {}
+        while True:
+            while len(pending) < TILES_IN_FLIGHT_PER_THREAD * n_threads:
+                tile = next(tile_iter, None)
+                if tile is None:
+                    break
+                pending[executor.submit(read_tile, tile, index)] = tile
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                tile = pending.pop(future)
+                data = future.result()
+                if data is not None:
+                    row_off, col_off, nrows, ncols = tile["window"]
+                    dst.write(data, 1, window=Window(col_off, row_off, ncols, nrows))
+                    n_written += 1
+                n_done += 1
+                if n_done % max(1, len(tiles) // 20) == 0:
+                    logger.info("Mosaicked tiles - %.2f%%", 100 * n_done / len(tiles))
+
+    return n_written
+
+
+def mosaic_year(year, index, work_dir, n_threads):
+    """Assemble the tiles of one year into a global COG, and return its path"""
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_origin
+
+    work_dir = Path(work_dir)
+    tiles = index["tiles"][str(year)]
+    mosaic_file = work_dir / f"Croplands_300m_{year}.mosaic.tif"
+    out_file = work_dir / f"Croplands_300m_{year}.tif"
+
+    with rasterio.Env(
+        GDAL_NUM_THREADS=str(n_threads), GDAL_TIFF_OVR_BLOCKSIZE=BLOCK_SIZE
+    ):
+        # Uncompressed, so that blocks shared by two tiles are updated in place, and
+        # the data are only compressed when the COG is written
+        with rasterio.open(
+            mosaic_file,
+            "w",
+            driver="GTiff",
+            height=index["height"],
+            width=index["width"],
+            count=1,
+            dtype=index["dtype"],
+            nodata=index["nodata"],
+            crs="EPSG:4326",
+            transform=from_origin(-180, 90, *index["res"]),
+            tiled=True,
+            blockxsize=BLOCK_SIZE,
+            blockysize=BLOCK_SIZE,
+            SPARSE_OK=True,
+            BIGTIFF="YES",
+        ) as dst:
+            if index["scale"] is not None:
+                dst.scales = [index["scale"]]
+                dst.offsets = [index["offset"]]
+            logger.info(f"Writing {len(tiles)} tiles for {year} to {mosaic_file}")
+            n_written = write_tiles(dst, tiles, index, n_threads)
+            logger.info(f"Wrote {n_written} tiles with data for {year}")
+
+            logger.info(f"Building overviews for {year}")
+            dst.build_overviews(OVERVIEW_FACTORS, Resampling.average)
+
+        logger.info(f"Writing {out_file}")
+        rasterio.shutil.copy(
+            mosaic_file,
+            out_file,
+            driver="COG",
+            compress="LZW",
+            blocksize=BLOCK_SIZE,
+            overviews="FORCE_USE_EXISTING",
+            BIGTIFF="YES",
+            NUM_THREADS=str(n_threads),
+        )
+    mosaic_file.unlink()
+    _log_file_size(out_file)
+
+    return out_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Assemble cropland tiles into global COGs"
+    )
+    parser.add_argument(
+        "--year",
+        metavar="year",
+        type=int,
+        nargs="+",
+        required=True,
+        help="Year(s) to process",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "uint8"],
+        default="float32",
+        help="Assemble the float32 tiles, or the uint8 tiles (whose scale and no data "
+        "value are kept in the mosaic)",
+    )
+    parser.add_argument(
+        "--tile-dir",
+        default=None,
+        help="Read tiles from this directory rather than from s3, and don't upload "
+        "the mosaics",
+    )
+    parser.add_argument("--work-dir", default=tempfile.gettempdir())
+    parser.add_argument(
+        "--n-years",
+        type=int,
+        default=DEFAULT_N_YEARS,
+        help="Number of years assembled at once",
+    )
+    parser.add_argument(
+        "--n-threads",
+        type=int,
+        default=None,
+        help="Reader and GDAL threads per year (defaults to the CPUs shared between "
+        "the years assembled at once)",
+    )
+    args = parser.parse_args()
+    n_years = max(1, min(args.n_years, len(args.year)))
+    n_threads = args.n_threads or max(1, (os.cpu_count() or 1) // n_years)
+
+    tiles = list_tiles(args.year, args.tile_dir, TILE_S3_PREFIX[args.dtype])
+    index = build_tile_index(
+        tiles,
+        Path(args.work_dir) / f"cropland_tile_index_{args.dtype}.json",
+        n_threads * n_years,
+    )
+    n_unaligned = sum(
+        not tile["aligned"] for tiles in index["tiles"].values() for tile in tiles
+    )
+    if n_unaligned:
+        logger.warning(f"{n_unaligned} tiles are not on the output grid")
+
+    with contextlib.ExitStack() as stack:
+        if args.tile_dir is None:
+            uploader = stack.enter_context(
+                uploads.UploadPipeline(CROP_S3_BUCKET, MOSAIC_S3_PREFIX[args.dtype])
+            )
+        else:
+            uploader = None
+        executor = stack.enter_context(
+            concurrent.futures.ProcessPoolExecutor(n_years)
+        )
+        futures = [
+            executor.submit(mosaic_year, year, index, args.work_dir, n_threads)
+            for year in args.year
+            if tiles[year]
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            out_file = future.result()
+            if uploader is not None:
+                uploader.submit(out_file)
+
+
+if __name__ == "__main__":
+    main()
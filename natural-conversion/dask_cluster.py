@@ -0,0 +1,222 @@
+"""
+Helpers for the dask clusters used by the pipeline scripts. Scripts import this module
+in the functions that start a cluster, as it imports distributed.
+
+By default each script starts a LocalCluster on its own machine. Given a scheduler
+address (--scheduler-address, or DASK_SCHEDULER_ADDRESS) the scripts instead connect to
+an external scheduler, whose workers may run on other machines (for example the nodes
+of an AWS Batch multi-node parallel job, started by "entrypoint.sh multinode"). Workers
+then read their inputs from the same paths as the client, so inputs are staged to each
+worker with StageInputsPlugin unless the data path is on storage shared by all nodes.
+"""
+import fcntl
+import logging
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import rule_tables
+from distributed.diagnostics.plugin import WorkerPlugin
+
+logger = logging.getLogger(__name__)
+
+# Default LocalCluster layout of each script. None leaves the choice to dask, based on
+# the number of CPUs
+LOCAL_CLUSTER_DEFAULTS = {
+    "esa_cci": {"n_workers": 58, "threads_per_worker": 1},
+    "natural_conversion": {"n_workers": None, "threads_per_worker": None},
+    "initial_cover": {"n_workers": None, "threads_per_worker": None},
+}
+
+# Seconds to wait for the expected workers to connect to an external scheduler
+WORKER_WAIT_TIMEOUT = 900
+
+GB = 1024 ** 3
+
+
+def add_cluster_arguments(parser):
+    """Add the options selecting a local or external cluster to parser"""
+    parser.add_argument(
+        "--scheduler-address",
+        default=os.getenv("DASK_SCHEDULER_ADDRESS"),
+        help="Connect to the dask scheduler at this address (for example "
+        "tcp://10.0.0.1:8786) instead of starting a LocalCluster. Defaults to "
+        "DASK_SCHEDULER_ADDRESS",
+    )
+    parser.add_argument(
+        "--n-workers",
+        type=int,
+        default=None,
+        help="Number of LocalCluster workers (defaults to the script's usual layout) "
+        "or, with --scheduler-address, number of workers to wait for before starting",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="Threads per LocalCluster worker",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        metavar="GB",
+        help="Memory for the blocks in flight of the threads executor, which sizes "
+        "and limits them to stay within it, or split between the LocalCluster "
+        "workers as their memory limit (beyond which they spill to disk)",
+    )
+
+
+@contextmanager
+def start_client(args, script=None, kernel_threads=1):
+    """
+    Yield a client of the external scheduler at args.scheduler_address if it is set, or
+    else of a LocalCluster laid out by args, falling back to the defaults of script.
+    With kernel_threads > 1 the kernels parallelize internally, so the LocalCluster
+    runs that many times fewer single-threaded workers.
+    """
+    from distributed import Client
+    from distributed import LocalCluster
+
+    if args.scheduler_address:
+        with Client(args.scheduler_address) as client:
+            if args.n_workers:
+                logger.info(
+                    f"Waiting for {args.n_workers} workers on {args.scheduler_address}"
+                )
+                client.wait_for_workers(args.n_workers, timeout=WORKER_WAIT_TIMEOUT)
+            logger.info(f"Connected to {client}")
+            yield client
+        return
+
+    layout = dict(LOCAL_CLUSTER_DEFAULTS.get(script, {}))
+    if args.n_workers is not None:
+        layout["n_workers"] = args.n_workers
+    if args.threads_per_worker is not None:
+        layout["threads_per_worker"] = args.threads_per_worker
+    if kernel_threads > 1:
+        n_workers = layout.get("n_workers") or os.cpu_count()
+        layout["n_workers"] = max(1, n_workers // kernel_threads)
+        layout["threads_per_worker"] = 1
+    if args.memory_budget:
+        if not layout.get("n_workers"):
+            layout["n_workers"] = _default_n_workers(layout.get("threads_per_worker"))
+        layout["memory_limit"] = int(args.memory_budget * GB / layout["n_workers"])
+    layout = {key: value for key, value in layout.items() if value is not None}
+    with LocalCluster(**layout) as cluster, Client(cluster) as client:
+        logger.info(f"cluster {cluster}")
+        yield client
+
+
+def _default_n_workers(threads_per_worker=None):
+    """Number of workers a LocalCluster starts by default"""
+    from distributed.deploy.utils import nprocesses_nthreads
+
+    if threads_per_worker:
+        return max(1, os.cpu_count() // threads_per_worker)
+
+    return nprocesses_nthreads()[0]
+
+
+def _register_plugin(client, plugin):
+    # register_worker_plugin was replaced by register_plugin in newer distributed
+    register = getattr(client, "register_plugin", None) or client.register_worker_plugin
+    register(plugin)
+
+
+class RuleTablePlugin(WorkerPlugin):
+    """
+    Register rule tables on each worker when it starts (including workers that join or
+    restart later), so that tasks only need the table names
+    """
+
+    def __init__(self, tables):
+        self.tables = list(tables)
+        self.name = "rule-tables-" + "-".join(table.name for table in self.tables)
+
+    def setup(self, worker):
+        for table in self.tables:
+            rule_tables.register(table)
+
+
+def register_rule_tables(client, *tables):
+    """
+    Send tables once to every worker of client, and register them in this process too
+    (for tasks run by the client). Returns the table names, to pass to the tasks.
+    """
+    for table in tables:
+        rule_tables.register(table)
+    _register_plugin(client, RuleTablePlugin(tables))
+    logger.info(f"Registered {', '.join(repr(table) for table in tables)} on workers")
+
+    return [table.name for table in tables]
+
+
+class StageInputsPlugin(WorkerPlugin):
+    """
+    Download inputs from S3 to the local path expected by the tasks when a worker
+    starts, unless the file is already there (as it is on the client's machine, or when
+    the data path is shared by all nodes). Worker processes on the same node take a
+    file lock, so each file is downloaded once per node.
+    """
+
+    def __init__(self, inputs):
+        # (bucket, key, local path) of each input
+        self.inputs = [(bucket, key, str(path)) for bucket, key, path in inputs]
+        self.name = "stage-inputs-" + uuid.uuid5(
+            uuid.NAMESPACE_URL, repr(self.inputs)
+        ).hex[:8]
+
+    def setup(self, worker):
+        for bucket, key, path in self.inputs:
+            stage_input(bucket, key, Path(path))
+
+
+def stage_input(bucket, key, path):
+    """Download s3://bucket/key to path, if no other process has already"""
+    import uploads
+
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(Path(tempfile.gettempdir()) / f"{path.name}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if path.exists():
+            return
+        logger.info(f"Staging s3://{bucket}/{key} to {path}")
+        partial = path.with_name(path.name + ".partial")
+        uploads.s3_client().download_file(bucket, key, str(partial))
+        partial.rename(path)
+
+
+def stage_inputs(client, inputs):
+    """
+    Make inputs, given as (bucket, key, local path), available at their local paths on
+    every worker of client, including workers that join later
+    """
+    plugin = StageInputsPlugin(inputs)
+    _register_plugin(client, plugin)
+    logger.info(f"Staged {len(plugin.inputs)} inputs on workers")
+
+
+def check_shared_path(client, directory):
+    """
+    Raise RuntimeError if files written to directory by this process are not visible to
+    every worker of client, as is needed when the workers write the outputs
+    """
+    directory = Path(directory)
+    marker = directory / f".shared-{uuid.uuid4().hex}"
+    marker.touch()
+    try:
+        visible = client.run(os.path.exists, str(marker))
+    finally:
+        marker.unlink()
+    missing = [worker for worker, exists in visible.items() if not exists]
+    if missing:
+        raise RuntimeError(
+            f"{directory} is not shared with workers {', '.join(missing)}. Mount it on "
+            "storage shared by all nodes (for example EFS) to write outputs from an "
+            "external scheduler's workers"
+        )
@@ -1,15 +1,20 @@
 #!/bin/bash
 
-# nohup dask-scheduler --host localhost --port 8786 --dashboard-address 8787 &
-# nohup dask-worker --host localhost --dashboard-address 8786 --nprocs 8 --nthreads 1 &
-
 set -e
 
+SCHEDULER_PORT=8786
+# Workers started by the dask command line import the pipeline modules from here
+export PYTHONPATH="$(dirname "$(readlink -f "$0")")${PYTHONPATH:+:$PYTHONPATH}"
+
 case "$1" in
     cropland_match)
         echo "Resampling cropland to match ESA CCI"
         exec python cropland_match_to_esa.py "${@:2}"
 		;;
+    cropland_mosaic)
+        echo "Assembling cropland tiles into global mosaics"
+        exec python cropland_mosaic.py "${@:2}"
+		;;
     esa_cci)
         echo "Starting esa_cci_transitions calculations"
         exec python esa_cci_transitions.py "${@:2}"
@@ -22,6 +27,52 @@ case "$1" in
         echo "Starting initial_cover calculations"
         exec python natural_conversion_initial_native.py "${@:2}"
 		;;
+    conversion_patches)
+        echo "Extracting natural conversion patches"
+        exec python conversion_patches.py "${@:2}"
+		;;
+    web_tiles)
+        echo "Rendering web map tiles"
+        exec python web_tiles.py "${@:2}"
+		;;
+    coverage_fractions)
+        echo "Summing raster values within zones"
+        exec python coverage_fractions.py "${@:2}"
+		;;
+    scheduler)
+        echo "Starting dask scheduler"
+        exec dask scheduler --port $SCHEDULER_PORT --dashboard-address :8787 "${@:2}"
+		;;
+    worker)
+        # worker <scheduler address> [dask worker options]
+        echo "Starting dask worker for $2"
+        exec dask worker "$2" --nworkers "${DASK_NWORKERS:-1}" "${@:3}"
+		;;
+    multinode)
+        # AWS Batch multi-node parallel job: the main node runs the scheduler, a worker
+        # and the stage given as the next argument, connected to the scheduler. The
+        # other nodes only run workers, and are stopped when the main node exits.
+        # Netcdf outputs are written from several nodes to shared storage
+        export HDF5_USE_FILE_LOCKING=FALSE
+        if [ "$AWS_BATCH_JOB_NODE_INDEX" = "$AWS_BATCH_JOB_MAIN_NODE_INDEX" ]; then
+            echo "Starting main node of $AWS_BATCH_JOB_NUM_NODES nodes"
+            dask scheduler --port $SCHEDULER_PORT --dashboard-address :8787 &
+            dask worker "tcp://localhost:$SCHEDULER_PORT" \
+                --nworkers "${DASK_NWORKERS:-1}" &
+            exec bash "$0" "${@:2}" \
+                --scheduler-address "tcp://localhost:$SCHEDULER_PORT" \
+                --n-workers $((AWS_BATCH_JOB_NUM_NODES * ${DASK_NWORKERS:-1}))
+        else
+            main_node="$AWS_BATCH_JOB_MAIN_NODE_PRIVATE_IPV4_ADDRESS"
+            echo "Starting worker node $AWS_BATCH_JOB_NODE_INDEX for $main_node"
+            exec dask worker "tcp://$main_node:$SCHEDULER_PORT" \
+                --nworkers "${DASK_NWORKERS:-1}"
+        fi
+		;;
+    plan)
+        echo "Planning resources for pipeline stages"
+        exec python resource_planner.py "${@:2}"
+		;;
     *)
         exec "$@"
 esac
@@ -1,22 +1,22 @@
-import json
+import argparse
 import logging
+import shutil
+from contextlib import ExitStack
 from pathlib import Path
-from pathlib import PurePath
-
-import boto3
-import openpyxl
-import parallel_functions
-import requests
-import rioxarray
-import xarray as xr
-from dask.distributed import Client
-from dask.distributed import LocalCluster
-
-N_WORKERS = 58
+
+import kernels
+import reductions
+import rule_tables
+import rule_updates
+import threaded_executor
+import uploads
+
 CROP_DATA_FOR_TESTING = False
 
 DATA_PATH = Path("/data")
 
+GB = 1024 ** 3
+
 IN_S3_BUCKET = "trends.earth-private"
 IN_S3_PREFIX = "esa-cci"
 OUT_S3_BUCKET = "trends.earth-private"
@@ -43,18 +43,16 @@ def log_progress(fraction, message=None, data=None):
     logger.info("%s - %.2f%%", message, 100 * fraction)
 
 
-with open(PurePath("/data/aws_credentials.json"), "r") as f:
-    aws_creds = json.load(f)
-
-
 def put_to_s3(filename: Path, bucket: str, prefix: str):
-    client = boto3.client("s3")
+    client = uploads.s3_client()
     key = f"{prefix}/{filename.name}"
     logger.info(f"Uploading {filename} to s3 at {key}")
     client.upload_file(str(filename), bucket, key)
 
 
 def download_file(url, local_gz_file):
+    import requests
+
     with requests.get(url, stream=True) as r:
         r.raise_for_status()
         with open(local_gz_file, "wb") as f:
@@ -63,22 +61,153 @@ def download_file(url, local_gz_file):
 
 
 def get_from_s3(bucket, prefix, filename, out_path):
-    client = boto3.client("s3")
+    client = uploads.s3_client()
     logger.info(f"Downloading {filename} from s3 to {out_path}")
     client.download_file(bucket, f"{prefix}/{filename}", out_path)
 
 
-def ds_to_cog(ds, cloud="s3"):
+def transitions_file(years=f"{INITIAL_YEAR}-{FINAL_YEAR}"):
+    return DATA_PATH / f"ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_{years}.tif"
+
+
+def manifest_file(years=f"{INITIAL_YEAR}-{FINAL_YEAR}"):
+    return (
+        DATA_PATH
+        / f"ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_{years}_manifest.json"
+    )
+
+
+def presence_file(years=f"{INITIAL_YEAR}-{FINAL_YEAR}"):
+    return (
+        DATA_PATH
+        / f"ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_{years}_presence.npz"
+    )
+
+
+def ds_to_cog(ds, uploader, cloud="s3"):
     ds.rio.write_crs("EPSG:4326", inplace=True)
 
+    out_file = transitions_file()
+    ds.rio.to_raster(out_file, tiled=True, compress="LZW", dtype="int32")
+
+    uploader.submit(out_file, unlink=True)
+
+
+def fetch_previous_output(out_file: Path, base_file: Path):
+    """
+    Make the output of a previous run (base_file) available at out_file, copying it
+    locally or downloading it from S3. Returns False if there is no previous output.
+    """
+    import botocore
+
+    if out_file.exists():
+        return True
+    if base_file.exists():
+        logger.info(f"Copying {base_file} to {out_file}")
+        shutil.copyfile(base_file, out_file)
+        return True
+    try:
+        get_from_s3(OUT_S3_BUCKET, OUT_S3_PREFIX, base_file.name, str(out_file))
+    except botocore.exceptions.ClientError:
+        logger.info(f"No previous output {base_file.name} found")
+        return False
+
+    return True
+
+
+def changed_blocks(old_coding, rule_table, window):
+    """
+    Return a function selecting the blocks of the previous transitions that contain a
+    transition whose meaning differs between the coding old_coding and rule_table,
+    fetching the previous output and its presence index. Returns None (so that all
+    blocks are computed) if either is missing.
+    """
+    old_rules, _ = rule_updates.read_coding(old_coding)
+    out_file = transitions_file()
+    if not (
+        fetch_previous_output(presence_file(), presence_file())
+        and fetch_previous_output(out_file, out_file)
+    ):
+        logger.info("Computing all blocks")
+        return None
+
+    index = rule_updates.PresenceIndex.load(presence_file())
+    windows = rule_updates.affected_blocks(
+        index, rule_updates.changed_codes(old_rules, rule_table)
+    )
+
+    return rule_updates.overlapping(index, windows, (window or (0, 0))[:2])
+
+
+def run_threaded(in_files, rule_table, args, uploader):
+    out_file = transitions_file()
+
+    if args.incremental:
+        manifest_path = manifest_file()
+        base_years = args.incremental_base or f"{INITIAL_YEAR}-{FINAL_YEAR}"
+        if fetch_previous_output(manifest_path, manifest_file(base_years)):
+            fetch_previous_output(out_file, transitions_file(base_years))
+            fetch_previous_output(presence_file(), presence_file(base_years))
+    else:
+        manifest_path = None
+
+    window = None
+    if CROP_DATA_FOR_TESTING:
+        logger.warning("****** Cropping data for testing ******")
+        window = (48000, 48000, 48000, 48000)
+
+    select = None
+    if args.changed_rules:
+        select = changed_blocks(args.changed_rules, rule_table, window)
+    # Patched blocks keep the same transitions, so their index entries are unchanged
+    presence_path = presence_file() if select is None else None
+
+    threaded_executor.run_transitions(
+        in_files[0],
+        in_files[-1],
+        out_file,
+        rule_table,
+        staging_path=DATA_PATH / "staging",
+        window=window,
+        block_size=args.block_size or threaded_executor.DEFAULT_BLOCK_SIZE,
+        n_threads=args.n_threads,
+        kernel_threads=args.kernel_threads,
+        manifest_path=manifest_path,
+        memory_budget=args.memory_budget and args.memory_budget * GB,
+        input_mode=args.input_mode,
+        io_threads=args.io_threads,
+        presence_path=presence_path,
+        select=select,
+    )
+
+    # In incremental mode keep the output locally so the next run can patch it
+    uploader.submit(out_file, unlink=manifest_path is None)
+    if manifest_path is not None:
+        uploader.submit(manifest_path)
+    if presence_path is not None:
+        uploader.submit(presence_path)
+
+
+def write_area_matrices(area_matrix, class_codes, band_width, uploader):
     out_file = (
         DATA_PATH
-        / f"ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_{INITIAL_YEAR}-{FINAL_YEAR}.tif"
+        / f"ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_{INITIAL_YEAR}-{FINAL_YEAR}_area_matrix.csv"
     )
-    ds.rio.to_raster(out_file, tiled=True, compress="LZW", dtype="int32")
+    logger.info(f"Writing {out_file}...")
+    reductions.write_transition_area_matrix(
+        area_matrix.sum(axis=0), class_codes, out_file
+    )
+    uploader.submit(out_file)
 
-    put_to_s3(out_file, OUT_S3_BUCKET, OUT_S3_PREFIX)
-    out_file.unlink()
+    if band_width is not None:
+        out_file = out_file.with_name(
+            out_file.stem + f"_{band_width:g}deg_bands.csv"
+        )
+        logger.info(f"Writing {out_file}...")
+        reductions.write_transition_area_bands(
+            area_matrix, class_codes, band_width, out_file
+        )
+        uploader.submit(out_file)
 
 
 def get_trans_codes(
@@ -89,6 +218,8 @@ def get_trans_codes(
     first_data_row,
     last_data_row,
 ):
+    import openpyxl
+
     wb = openpyxl.load_workbook(xl_file)
     sheet = wb["Recoding"]
 
@@ -122,7 +253,13 @@ def get_trans_codes(
     return trans_codes, trans_meanings
 
 
-def main():
+def main(args, uploader):
+    import dask
+    import dask_cluster
+    import parallel_functions
+    import rioxarray
+    import xarray as xr
+    from dask.distributed import default_client
 
     ###############################################################################
     # Download ESA data if not already present
@@ -137,6 +274,31 @@ def main():
             get_from_s3(IN_S3_BUCKET, IN_S3_PREFIX, in_file, str(local_file_path))
     # TODO: Check md5s of downloads vs etags
 
+    trans_codes, trans_meanings = get_trans_codes(
+        "ESA_CCI_Natural_Conversion_Coding_v2.xlsx",
+        header_column=2,
+        first_data_column=4,
+        last_data_column=41,
+        first_data_row=4,
+        last_data_row=41,
+    )
+    logger.debug("trans_codes are %s", trans_codes)
+    logger.debug("trans_meanings are %s", trans_meanings)
+    rules = rule_tables.RuleTable("transition_meaning", trans_codes, trans_meanings)
+
+    if args.executor == "threads":
+        logger.info("Calculating transitions with threads executor...")
+        run_threaded(in_files, rules, args, uploader)
+        return
+
+    client = default_client()
+    # Sent once to each worker, so tasks only carry the table name
+    dask_cluster.register_rule_tables(client, rules)
+    # Workers of an external scheduler read the inputs from their own disks
+    dask_cluster.stage_inputs(
+        client, [(IN_S3_BUCKET, f"{IN_S3_PREFIX}/{f.name}", f) for f in in_files]
+    )
+
     ###########################################################################
     # Load data
 
@@ -154,6 +316,8 @@ def main():
         lc_final = lc_final[48000:96000, 48000:96000]
 
     lc = xr.merge([lc_initial, lc_final], combine_attrs="drop").unify_chunks()
+    if args.block_size:
+        lc = lc.chunk(dict(x=args.block_size, y=args.block_size))
     logger.info(f"lc {lc}")
 
     logger.debug("lc %s", lc)
@@ -165,36 +329,148 @@ def main():
     ###########################################################################
     # Compute transitions
 
-    trans_codes, trans_meanings = get_trans_codes(
-        "ESA_CCI_Natural_Conversion_Coding_v2.xlsx",
-        header_column=2,
-        first_data_column=4,
-        last_data_column=41,
-        first_data_row=4,
-        last_data_row=41,
-    )
-    logger.debug("trans_codes are %s", trans_codes)
-    logger.debug("trans_meanings are %s", trans_meanings)
-
     logger.info("Calculating transitions...")
 
     kwargs = {
-        "trans_codes": trans_codes,
-        "trans_meanings": trans_meanings,
+        "rule_table": rules.name,
         "global_attrs": global_attrs,
+        "kernel_threads": args.kernel_threads,
     }
 
     trans = xr.map_blocks(parallel_functions.compute_transitions, lc, kwargs=kwargs)
     logger.debug("transition %s", trans)
 
-    trans = trans.compute()
+    if args.area_matrix or args.area_matrix_only:
+        # Transition codes are initial_class * 1000 + final_class
+        class_codes = sorted(set(code // 1000 for code in trans_codes))
+        area_matrix = reductions.transition_area_matrix(
+            lc,
+            class_codes,
+            x_res=float((lc.x[1] - lc.x[0]).values),
+            y_res=float((lc.y[0] - lc.y[1]).values),
+            band_width=args.lat_band_width,
+        )
+        if args.area_matrix_only:
+            (area_matrix,) = dask.compute(area_matrix)
+            write_area_matrices(
+                area_matrix, class_codes, args.lat_band_width, uploader
+            )
+            return
+        trans, area_matrix = dask.compute(trans, area_matrix)
+    else:
+        trans = trans.compute()
 
     logger.info("Writing geotiff to S3")
-    ds_to_cog(trans, cloud="s3")
+    ds_to_cog(trans, uploader, cloud="s3")
+    if args.area_matrix:
+        # Written while the transitions upload
+        write_area_matrices(area_matrix, class_codes, args.lat_band_width, uploader)
 
 
 if __name__ == "__main__":
-    cluster = LocalCluster(n_workers=N_WORKERS, threads_per_worker=1)
-    client = Client(cluster)
-
-    main()
+    import dask_cluster
+
+    parser = argparse.ArgumentParser(description="Calculate ESA CCI transitions")
+    parser.add_argument(
+        "--executor",
+        choices=["dask", "threads"],
+        default="dask",
+        help="Run blocks on a dask cluster, or on a single-node thread pool over "
+        "memory-mapped inputs",
+    )
+    dask_cluster.add_cluster_arguments(parser)
+    parser.add_argument(
+        "--n-threads",
+        type=int,
+        default=None,
+        help="Number of threads for the threads executor (defaults to all CPUs)",
+    )
+    parser.add_argument(
+        "--input-mode",
+        choices=threaded_executor.INPUT_MODES,
+        default="memmap",
+        help="With the threads executor, stage the inputs to memory-mapped arrays "
+        "before the run, or read their blocks from the rasters ahead of use",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=None,
+        help="Threads reading blocks ahead of use with --input-mode prefetch",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=None,
+        help="Block size (in pixels) used for processing (defaults to dask auto "
+        "chunking)",
+    )
+    parser.add_argument(
+        "--kernel-threads",
+        type=int,
+        default=1,
+        help="Threads used inside each block by the row-parallel kernels. Use with a "
+        "larger --block-size to run fewer, bigger blocks at once",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="With the threads executor, keep per-block fingerprints of the inputs and "
+        "outputs, and only recompute blocks whose inputs changed since the last run",
+    )
+    parser.add_argument(
+        "--incremental-base",
+        metavar="INITIAL-FINAL",
+        default=None,
+        help="Years (for example 2011-2019) of a previous run whose output is used as "
+        "the starting point for an incremental run",
+    )
+    parser.add_argument(
+        "--changed-rules",
+        metavar="OLD_CODING",
+        default=None,
+        help="With the threads executor, only recompute the blocks of the previous "
+        "output with a transition whose meaning differs between this earlier version "
+        "of the coding spreadsheet and the current one (see rule_updates.py)",
+    )
+    parser.add_argument(
+        "--area-matrix",
+        action="store_true",
+        help="Also compute the area of each initial to final class transition, "
+        "written as a CSV matrix",
+    )
+    parser.add_argument(
+        "--area-matrix-only",
+        action="store_true",
+        help="Only compute the transition area matrix, without writing transitions",
+    )
+    parser.add_argument(
+        "--lat-band-width",
+        type=float,
+        default=None,
+        help="Also split the transition area matrix into latitude bands of this width "
+        "(in degrees)",
+    )
+    args = parser.parse_args()
+    if args.incremental and args.executor != "threads":
+        parser.error("--incremental requires --executor threads")
+    if args.changed_rules and (args.executor != "threads" or args.incremental):
+        parser.error(
+            "--changed-rules requires --executor threads, without --incremental"
+        )
+    if (args.area_matrix or args.area_matrix_only) and args.executor != "dask":
+        parser.error("--area-matrix requires --executor dask")
+    if args.kernel_threads > 1:
+        # Fail early if the row-parallel kernels cannot run from several threads
+        logger.info(f"Using the {kernels.check_threading_layer()} threading layer")
+
+    with ExitStack() as stack:
+        if args.executor == "dask":
+            stack.enter_context(
+                dask_cluster.start_client(args, "esa_cci", args.kernel_threads)
+            )
+        # Outputs are uploaded in the background as soon as they are written
+        uploader = stack.enter_context(
+            uploads.UploadPipeline(OUT_S3_BUCKET, OUT_S3_PREFIX)
+        )
+        main(args, uploader)
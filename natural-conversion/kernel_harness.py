@@ -0,0 +1,489 @@
+"""
+Differential harness for the kernels of kernels.py: runs each reference kernel and
+each variant of it on the same generated inputs, checks that the outputs are
+identical (bit for bit, or within AREA_RTOL for cell areas), and times both, so that
+a faster replacement is only accepted if it gives the same results and is faster.
+
+The inputs start with every edge case of their kernel (no data at 0, every code of
+the legend and every transition between them, codes missing from the rule tables,
+cropland fractions of exactly 0.5 and next to it, NaN, and rows at the poles and at
+the equator), followed by random values. Correctness is checked on a small
+raster, and speed on a larger one with the same edge cases.
+
+A candidate variant can be added from the command line, with the same arguments as
+the reference kernel:
+
+    python kernel_harness.py --variant calc_natural_conversion=my_kernels:conversion
+    python kernel_harness.py --kernels calc_cell_area --size 4096 --out report.json
+"""
+import argparse
+import importlib
+import json
+import logging
+import sys
+import time
+
+import kernels
+import numba
+import numpy as np
+from benchmark import ESA_CCI_CLASSES
+from benchmark import synthetic_legend
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+
+logger = logging.getLogger(__name__)
+
+# Relative tolerance for cell areas
+AREA_RTOL = 1e-6
+
+# Size (in pixels) of the rasters checked for correctness, and of those timed
+CHECK_SIZE = 256
+DEFAULT_SIZE = 2048
+
+# Transition codes that are not in the rule tables
+UNKNOWN_CODES = [1, 999, 221221, 2 ** 31 - 1]
+
+# Land cover codes that are not in the legend
+UNKNOWN_CLASSES = [1, 9, 255]
+
+# Cropland thresholds the natural conversion kernels are checked at (as float64, as
+# the pipeline passes them), including ones whose float32 value is above the float64
+CROPLAND_THRESHOLDS = np.array([0.1, 0.2, 0.3, 0.5, 0.7], dtype=np.float64)
+
+# Cropland fractions at and next to each threshold (as float32, as the mosaics store
+# them), with no data, the ends of the range and values between thresholds
+CROPLAND_EDGE_CASES = np.concatenate(
+    [
+        [
+            np.nextafter(np.float32(threshold), np.float32(0)),
+            np.float32(threshold),
+            np.nextafter(np.float32(threshold), np.float32(1)),
+        ]
+        for threshold in CROPLAND_THRESHOLDS
+    ]
+    + [[0.0, 1.0, np.nan, 0.25, 0.995]]
+).astype(np.float32)
+
+
+def _fill(edge_cases, size, random_values, rng):
+    """
+    A size x size array starting (in row-major order) with edge_cases, and random
+    choices from random_values after them
+    """
+    edge_cases = np.asarray(edge_cases)
+    if edge_cases.size > size * size:
+        raise ValueError(f"{edge_cases.size} edge cases do not fit in {size}x{size}")
+    out = rng.choice(np.asarray(random_values, dtype=edge_cases.dtype), size * size)
+    out[: edge_cases.size] = edge_cases
+
+    return out.reshape(size, size)
+
+
+def _legend_classes():
+    return np.array(ESA_CCI_CLASSES, dtype=np.uint8)
+
+
+def trans_meaning_inputs(size, rng):
+    """Every transition between legend classes, with a table giving each a meaning"""
+    classes = _legend_classes().astype(np.int32)
+    trans_codes = (classes[:, None] * 1000 + classes[None, :]).ravel()
+    trans_meanings = rng.integers(0, 2, trans_codes.size).astype(np.int32)
+    # Duplicates in the table, where the later one wins
+    trans_codes = np.append(trans_codes, trans_codes[-1])
+    trans_meanings = np.append(trans_meanings, 1 - trans_meanings[-1])
+
+    edge_cases = np.concatenate(
+        [[kernels.NODATA_VALUE], trans_codes, UNKNOWN_CODES]
+    ).astype(np.int32)
+    trans = _fill(edge_cases, size, trans_codes, rng)
+
+    return trans, trans_codes, trans_meanings
+
+
+def recode_cover_inputs(size, rng):
+    """Every legend class and classes missing from it, with the Legend sheet recodes"""
+    codes, recodes = synthetic_legend(int(rng.integers(1 << 16)))
+    edge_cases = np.concatenate([_legend_classes(), UNKNOWN_CLASSES]).astype(np.uint8)
+    lc = _fill(edge_cases, size, _legend_classes(), rng)
+
+    return lc, np.array(codes, dtype=np.int32), np.array(recodes, dtype=np.int32)
+
+
+def natural_conversion_inputs(size, rng):
+    """
+    Every combination of transition meaning, initial cover meaning and cropland
+    fractions of CROPLAND_EDGE_CASES, with CROPLAND_THRESHOLDS
+    """
+    trans_values = np.array([0, 1, 2, -1], dtype=np.int32)
+    cover_values = np.arange(0, 7, dtype=np.int32)
+    trans, cover, crops_initial, crops_final = (
+        grid.ravel()
+        for grid in np.meshgrid(
+            trans_values,
+            cover_values,
+            CROPLAND_EDGE_CASES,
+            CROPLAND_EDGE_CASES,
+            indexing="ij",
+        )
+    )
+    crops = rng.random(64, dtype=np.float32)
+
+    return (
+        _fill(trans, size, [0, 0, 0, 1], rng),
+        _fill(cover, size, cover_values, rng),
+        _fill(crops_initial, size, crops, rng),
+        _fill(crops_final, size, crops, rng),
+        CROPLAND_THRESHOLDS,
+    )
+
+
+def cell_area_inputs(size, rng):
+    """
+    Latitudes of the rows of a size x size raster of size / 360 degree cells, with rows
+    at both poles and on either side of and centred on the equator
+    """
+    res = 1 / 360.0
+    edge_cases = [
+        90 - res / 2,
+        -90 + res / 2,
+        res / 2,
+        -res / 2,
+        0.0,
+        45.0,
+    ]
+    y = rng.uniform(-90 + res / 2, 90 - res / 2, size)
+    y[: len(edge_cases)] = edge_cases
+
+    return y, size, res, res
+
+
+###############################################################################
+# Variants, with the arguments of their reference kernel
+
+
+def _trans_meaning_lookup(trans, trans_codes, trans_meanings):
+    lut = kernels.rule_lookup(trans_codes, trans_meanings)
+
+    return kernels.calc_rule_lookup(trans, lut)
+
+
+def _trans_meaning_rule_table(trans, trans_codes, trans_meanings):
+    import rule_tables
+
+    rules = rule_tables.RuleTable("transition_meaning", trans_codes, trans_meanings)
+
+    return rules.apply(trans)
+
+
+def _recode_cover_reference(lc, codes, recodes):
+    # As initial cover was recoded before rule lookups: one pass per legend class
+    return kernels.calc_trans_meaning(lc, codes, recodes)
+
+
+def _recode_cover_xarray(lc, codes, recodes):
+    import parallel_functions
+    import rule_tables
+    import xarray as xr
+
+    rule_tables.register(rule_tables.RuleTable("harness_recode", codes, recodes))
+    cover = xr.DataArray(
+        lc,
+        coords={"y": np.arange(lc.shape[0]), "x": np.arange(lc.shape[1])},
+        dims=("y", "x"),
+    )
+
+    return parallel_functions.recode_cover(cover, "harness_recode")["cover"].values
+
+
+def _natural_conversion_reference(
+    trans, initial_cover, crops_initial, crops_final, thresholds
+):
+    return np.stack(
+        [
+            kernels.calc_natural_conversion(
+                trans, initial_cover, crops_initial, crops_final, threshold
+            )
+            for threshold in thresholds
+        ]
+    )
+
+
+def _quantize_cropland(trans, initial_cover, crops_initial, crops_final, thresholds):
+    # Cropland inputs are quantized once, when the mosaics are written
+    return (
+        trans,
+        initial_cover,
+        kernels.quantize_cropland(crops_initial),
+        kernels.quantize_cropland(crops_final),
+        thresholds,
+    )
+
+
+def _natural_conversion_uint8(
+    trans, initial_cover, crops_initial, crops_final, thresholds
+):
+    crops_initial, crops_final, thresholds = kernels.cropland_inputs(
+        crops_initial, crops_final, thresholds
+    )
+
+    return np.stack(
+        [
+            kernels.calc_natural_conversion(
+                trans, initial_cover, crops_initial, crops_final, threshold
+            )
+            for threshold in thresholds
+        ]
+    )
+
+
+def _natural_conversion_sweep(
+    trans, initial_cover, crops_initial, crops_final, thresholds
+):
+    return kernels.calc_threshold_codes(
+        trans, initial_cover, crops_initial, crops_final, thresholds
+    )
+
+
+def _cell_area_reference(y, n_cols, x_res, y_res):
+    return np.repeat(
+        np.expand_dims(kernels.calc_cell_area(y, x_res, y_res), axis=1), n_cols, axis=1
+    )
+
+
+def _cell_area_parallel(y, n_cols, x_res, y_res):
+    return kernels.cell_area_grid(y, n_cols, x_res, y_res, kernel_threads=64)
+
+
+def variant(func, min_speedup=1.0, prepare=None, parallel=False):
+    """
+    A variant of a kernel, taking the arguments of the reference kernel, or those
+    returned by prepare (which is not timed). It fails if it is less than min_speedup
+    times as fast as the reference (None to only record its speedup). The speedup of
+    parallel variants is only required when numba has more than one thread and core.
+    """
+    return {
+        "func": func,
+        "min_speedup": min_speedup,
+        "prepare": prepare,
+        "parallel": parallel,
+    }
+
+
+# For each kernel: a function of (size, rng) returning its inputs, the reference, its
+# variants and the relative tolerance of the comparison (None for bit for bit).
+# Variants that compute the same thing for another purpose are only recorded.
+KERNELS = {
+    "calc_trans_meaning": {
+        "inputs": trans_meaning_inputs,
+        "reference": kernels.calc_trans_meaning,
+        "variants": {
+            "calc_rule_lookup": variant(_trans_meaning_lookup, 5.0),
+            "RuleTable.apply": variant(_trans_meaning_rule_table, 5.0),
+        },
+        "rtol": None,
+    },
+    "recode_cover": {
+        "inputs": recode_cover_inputs,
+        "reference": _recode_cover_reference,
+        "variants": {
+            "calc_rule_lookup": variant(_trans_meaning_lookup, 2.0),
+            "parallel_functions.recode_cover": variant(_recode_cover_xarray, 1.0),
+        },
+        "rtol": None,
+    },
+    "calc_natural_conversion": {
+        "inputs": natural_conversion_inputs,
+        "reference": _natural_conversion_reference,
+        "variants": {
+            # Quantized cropland is for memory and reads, not speed of the kernel
+            "uint8 cropland": variant(
+                _natural_conversion_uint8, None, prepare=_quantize_cropland
+            ),
+            "calc_threshold_codes": variant(_natural_conversion_sweep, None),
+        },
+        "rtol": None,
+    },
+    "calc_cell_area": {
+        "inputs": cell_area_inputs,
+        "reference": _cell_area_reference,
+        "variants": {
+            "calc_cell_area_parallel": variant(
+                _cell_area_parallel, 1.5, parallel=True
+            ),
+        },
+        "rtol": AREA_RTOL,
+    },
+}
+
+
+def compare(expected, actual, rtol=None):
+    """
+    Differences between two outputs: None if they are identical (the same dtype, shape
+    and bits, or within rtol for rtol not None, with NaN in the same places), else a
+    description of the first of them
+    """
+    expected = np.asarray(expected)
+    actual = np.asarray(actual)
+    if expected.shape != actual.shape:
+        return f"shape {actual.shape} instead of {expected.shape}"
+    if rtol is None:
+        if expected.dtype != actual.dtype:
+            return f"dtype {actual.dtype} instead of {expected.dtype}"
+        differ = np.ascontiguousarray(expected).view(np.uint8) != np.ascontiguousarray(
+            actual
+        ).view(np.uint8)
+        if not differ.any():
+            return None
+        differ = differ.reshape(expected.shape + (-1,)).any(axis=-1)
+    else:
+        differ = ~np.isclose(actual, expected, rtol=rtol, atol=0, equal_nan=True)
+        if not differ.any():
+            return None
+    first = tuple(int(i) for i in np.argwhere(differ)[0])
+
+    return (
+        f"{int(differ.sum())} values differ, first at {first}: {actual[first]} "
+        f"instead of {expected[first]}"
+    )
+
+
+def best_time(func, args, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        elapsed.append(time.perf_counter() - start)
+
+    return min(elapsed)
+
+
+def run_kernel(name, spec, size=DEFAULT_SIZE, repeats=3, seed=0, min_speedup=None):
+    """
+    Check and time each variant of a kernel against the reference, returning a list of
+    results (dicts) for the report
+    """
+    check_args = spec["inputs"](CHECK_SIZE, np.random.default_rng(seed))
+    expected = spec["reference"](*check_args)
+    timed_args = spec["inputs"](size, np.random.default_rng(seed))
+    reference_time = best_time(spec["reference"], timed_args, repeats)
+
+    results = []
+    for name_of_variant, candidate in spec["variants"].items():
+        func = candidate["func"]
+        prepare = candidate["prepare"] or (lambda *args: args)
+        required = candidate["min_speedup"] if min_speedup is None else min_speedup
+        n_threads = min(
+            numba.config.NUMBA_NUM_THREADS, numba.config.NUMBA_DEFAULT_NUM_THREADS
+        )
+        if candidate["parallel"] and n_threads == 1:
+            required = None
+        difference = compare(expected, func(*prepare(*check_args)), spec["rtol"])
+        variant_args = prepare(*timed_args)
+        if difference is None:
+            # And on the timed inputs, which also compiles it before timing
+            difference = compare(
+                spec["reference"](*timed_args), func(*variant_args), spec["rtol"]
+            )
+        variant_time = best_time(func, variant_args, repeats)
+        speedup = reference_time / variant_time
+        passed = difference is None and (required is None or speedup >= required)
+        results.append(
+            {
+                "kernel": name,
+                "variant": name_of_variant,
+                "identical": difference is None,
+                "difference": difference,
+                "reference_seconds": reference_time,
+                "variant_seconds": variant_time,
+                "speedup": speedup,
+                "required_speedup": required,
+                "passed": passed,
+            }
+        )
+        logger.info(
+            "%-24s %-32s %-9s %7.2fx (required %s)%s",
+            name,
+            name_of_variant,
+            "identical" if difference is None else "DIFFERENT",
+            speedup,
+            "-" if required is None else f"{required:.2f}x",
+            "" if passed else "  FAILED",
+        )
+        if difference is not None:
+            logger.error(f"{name} {name_of_variant}: {difference}")
+
+    return results
+
+
+def add_variant(kernels, spec):
+    """Add a variant given as KERNEL=MODULE:FUNCTION to KERNELS"""
+    kernel, target = spec.split("=", 1)
+    module, function = target.split(":", 1)
+    func = getattr(importlib.import_module(module), function)
+    kernels[kernel]["variants"][target] = variant(func)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check and time optimized variants of the kernels"
+    )
+    parser.add_argument(
+        "--kernels", nargs="+", choices=list(KERNELS), default=list(KERNELS)
+    )
+    parser.add_argument(
+        "--variant",
+        action="append",
+        default=[],
+        help="Also check KERNEL=MODULE:FUNCTION, which must be at least as fast as "
+        "the reference",
+    )
+    parser.add_argument(
+        "--size", type=int, default=DEFAULT_SIZE, help="Size of the timed rasters"
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--min-speedup",
+        type=float,
+        default=None,
+        help="Speedup required of every variant, instead of those in KERNELS",
+    )
+    parser.add_argument("--out", default=None, help="JSON report of the results")
+    args = parser.parse_args()
+
+    for variant in args.variant:
+        kernel = variant.split("=", 1)[0]
+        if kernel not in KERNELS:
+            parser.error(f"--variant {variant}: no kernel {kernel}")
+        add_variant(KERNELS, variant)
+        if kernel not in args.kernels:
+            args.kernels.append(kernel)
+
+    results = []
+    for name in args.kernels:
+        results.extend(
+            run_kernel(
+                name,
+                KERNELS[name],
+                size=args.size,
+                repeats=args.repeats,
+                seed=args.seed,
+                min_speedup=args.min_speedup,
+            )
+        )
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Wrote {args.out}")
+
+    failed = [result for result in results if not result["passed"]]
+    if failed:
+        logger.error(f"{len(failed)} of {len(results)} variants failed")
+        sys.exit(1)
+    logger.info(f"All {len(results)} variants passed")
+
+
+if __name__ == "__main__":
+    main()
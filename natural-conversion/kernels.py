@@ -0,0 +1,445 @@
+"""
+Numba kernels for the natural conversion pipeline, operating on plain numpy arrays.
+
+This module only imports numpy and numba so that dask workers and batch jobs can load
+it quickly. Kernels are compiled on first use and cached on disk (cache=True), so
+later processes load the compiled code instead of compiling again. The xarray
+wrappers used with map_blocks are in parallel_functions.
+"""
+# slice_area and calc_cell_area are based on https://stackoverflow.com/a/62041888/871101
+import numba
+import numpy as np
+
+NODATA_VALUE = 0
+
+# Codes 0-6 used in the transition layer produced by calc_natural_conversion
+N_TRANSITION_CODES = 7
+
+# Numba threading layers that can run parallel kernels from several threads at once
+THREADSAFE_LAYERS = ["omp", "tbb"]
+
+# Cropland fraction above which a pixel counts as cropland
+CROPLAND_THRESHOLD = 0.5
+
+# Cropland fractions can also be stored as uint8 (0-200, with CROPLAND_UINT8_NODATA
+# for no data), as the number of multiples of CROPLAND_UINT8_SCALE that the fraction
+# is above. The multiples are taken as the float64 values the float kernels compare
+# fractions with (so 0.1 is the float64 0.1, not 20 * 0.005), which keeps the uint8
+# comparisons identical to the float ones at any threshold that is a multiple of the
+# scale, including float32 fractions that round to just above a threshold.
+CROPLAND_UINT8_SCALE = 0.005
+CROPLAND_UINT8_NODATA = 255
+CROPLAND_UINT8_THRESHOLDS = np.arange(201) / 200
+
+
+def quantize_cropland(fraction):
+    """Encode a float array of cropland fractions (NaN for no data) as uint8"""
+    out = np.full(fraction.shape, CROPLAND_UINT8_NODATA, dtype=np.uint8)
+    valid = np.isfinite(fraction)
+    out[valid] = np.searchsorted(
+        CROPLAND_UINT8_THRESHOLDS,
+        np.clip(fraction[valid].astype(np.float64), 0, 1),
+        side="left",
+    ).astype(np.uint8)
+
+    return out
+
+
+def is_uint8_threshold(threshold):
+    """Whether a threshold is one that uint8 cropland can be compared against"""
+    step = round(threshold / CROPLAND_UINT8_SCALE)
+
+    return 0 <= step < len(CROPLAND_UINT8_THRESHOLDS) and bool(
+        threshold == CROPLAND_UINT8_THRESHOLDS[step]
+    )
+
+
+def cropland_inputs(crops_initial, crops_final, thresholds):
+    """
+    Return the cropland arrays and thresholds (fractions) in the units of the arrays.
+    For uint8 arrays, no data in crops_final is set to 0 so that (as with NaN in float
+    arrays) it never counts as a cropland increase, and thresholds are converted to
+    multiples of the scale so that the kernels compare integers. Raises ValueError for
+    uint8 arrays if a threshold is not a multiple of the scale.
+    """
+    if crops_initial.dtype == np.uint8:
+        invalid = [
+            threshold
+            for threshold in np.atleast_1d(thresholds).tolist()
+            if not is_uint8_threshold(threshold)
+        ]
+        if invalid:
+            raise ValueError(
+                f"Thresholds {invalid} are not multiples of {CROPLAND_UINT8_SCALE}, "
+                "so they cannot be compared with uint8 cropland"
+            )
+        crops_final = np.where(
+            crops_final == CROPLAND_UINT8_NODATA, np.uint8(0), crops_final
+        )
+        thresholds = np.round(np.asarray(thresholds) / CROPLAND_UINT8_SCALE).astype(
+            np.uint8
+        )
+
+    return crops_initial, crops_final, thresholds
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def slice_area(f):
+    """
+    Calculate the area of a slice of the globe from the equator to the parallel
+    at latitude f (on WGS84 ellipsoid). Based on:
+    https://gis.stackexchange.com/questions/127165/more-accurate-way-to-calculate-area-of-rasters
+    """
+    a = 6378137.0  # in meters
+    b = 6356752.3142  # in meters,
+    e = np.sqrt(1 - pow(b / a, 2))
+    zp = 1 + e * np.sin(f)
+    zm = 1 - e * np.sin(f)
+
+    return (
+        np.pi
+        * pow(b, 2)
+        * ((2 * np.arctanh(e * np.sin(f))) / (2 * e) + np.sin(f) / (zp * zm))
+    )
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_cell_area(y, x_res, y_res):
+    """
+    Returns cell area in hectares
+
+    Use formula to calculate area of a raster cell on WGS84 ellipsoid, following
+    https://gis.stackexchange.com/questions/127165/more-accurate-way-to-calculate-area-of-rasters
+
+    y_min: minimum latitude
+    y_max: maximum latitude
+    x_res: width of cell in degrees
+    """
+
+    shp = y.shape
+    out = np.zeros(shp, dtype=np.float32)
+
+    y = y.copy().ravel()
+    y_min = y - y_res / 2
+    y_max = y + y_res / 2
+
+    out = (
+        (slice_area(np.deg2rad(y_max)) - slice_area(np.deg2rad(y_min)))
+        * (x_res / 360.0)
+        * 0.0001
+    )
+
+    return np.reshape(out, shp)
+
+
+@numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def calc_cell_area_parallel(y, x_res, y_res, out):
+    """
+    Row-parallel version of calc_cell_area that fills the 2D array out in place
+
+    Each row of out (one per element of y) is set to the area of a cell at that
+    latitude, in hectares, so no per-pixel latitude copies are needed.
+    """
+    for i in numba.prange(out.shape[0]):
+        area = (
+            (
+                slice_area(np.deg2rad(y[i] + y_res / 2))
+                - slice_area(np.deg2rad(y[i] - y_res / 2))
+            )
+            * (x_res / 360.0)
+            * 0.0001
+        )
+        for j in range(out.shape[1]):
+            out[i, j] = area
+
+    return out
+
+
+def set_kernel_threads(kernel_threads):
+    numba.set_num_threads(min(kernel_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def check_threading_layer():
+    """
+    Load the numba threading layer (by running a row-parallel kernel on a single row)
+    and return its name. Raises RuntimeError if no layer can be loaded, or if it is
+    not one of THREADSAFE_LAYERS, as the executors launch the row-parallel kernels
+    from several threads at once.
+    """
+    try:
+        calc_cell_area_parallel(
+            np.zeros(1), 1.0, 1.0, np.empty((1, 1), dtype=np.float64)
+        )
+    except ValueError as e:
+        raise RuntimeError(f"Could not load a numba threading layer: {e}") from e
+    layer = numba.threading_layer()
+    if layer not in THREADSAFE_LAYERS:
+        raise RuntimeError(
+            f"The numba threading layer is {layer}, which cannot run kernels from "
+            f"several threads at once - set NUMBA_THREADING_LAYER to one of "
+            f"{', '.join(THREADSAFE_LAYERS)}"
+        )
+
+    return layer
+
+
+def cell_area_grid(y, n_cols, x_res, y_res, kernel_threads=1):
+    """Return a (len(y), n_cols) array of cell areas in hectares"""
+    if kernel_threads > 1:
+        set_kernel_threads(kernel_threads)
+        return calc_cell_area_parallel(
+            y, x_res, y_res, np.empty((y.size, n_cols), dtype=np.float64)
+        )
+
+    cell_areas = np.expand_dims(calc_cell_area(y, x_res, y_res), axis=1)
+
+    return np.repeat(cell_areas, repeats=n_cols, axis=1)
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_natural_conversion(
+    trans, initial_cover, crops_initial, crops_final, threshold=CROPLAND_THRESHOLD
+):
+    """calculate land cover degradation"""
+    shp = trans.shape
+    trans = trans.ravel()
+    initial_cover = initial_cover.ravel()
+    crops_initial = crops_initial.ravel()
+    crops_final = crops_final.ravel()
+    out = np.zeros(trans.shape, dtype=np.int8)
+
+    # Code natural conversion as indicated by CCI as conversion
+    out[trans == 1] = 1
+
+    # Code cropland increase co-occurring with esa-indicated conversion as 2
+    crop_increase = (crops_initial <= threshold) & (crops_final > threshold)
+    out[(out == 1) & crop_increase] = 2
+
+    # Code cropland increase occurring on what was initially natural, but where change
+    # was not in ESA, as 3
+    out[(out == 0) & crop_increase & (initial_cover == 1)] = 3
+
+    ##
+    # Below are not natural conversion, but are coded in the output for future use
+
+    # Code other cropland increase occurring on land that esa indicated was forest as 4
+    out[(out == 0) & crop_increase & (initial_cover == 2)] = 4
+    # Code other cropland increase occurring on land that esa indicated was urban as 5
+    out[(out == 0) & crop_increase & (initial_cover == 4)] = 5
+    # Code other cropland increase occurring on land that esa indicated was other as 6
+    out[(out == 0) & crop_increase & (initial_cover == 5)] = 6
+
+    return np.reshape(out, shp)
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def sweep_codes(trans, initial_cover):
+    """
+    Transition codes of a pixel (as in calc_natural_conversion) without and with a
+    cropland increase
+    """
+    if trans == 1:
+        return 1, 2
+    if initial_cover == 1:
+        return 0, 3
+    if initial_cover == 2:
+        return 0, 4
+    if initial_cover == 4:
+        return 0, 5
+    if initial_cover == 5:
+        return 0, 6
+    return 0, 0
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def crop_increase_range(crops_initial, crops_final, thresholds):
+    """
+    Indices [lo, hi) of the sorted thresholds at which a pixel counts as a cropland
+    increase, ie crops_initial <= threshold < crops_final
+    """
+    if crops_initial != crops_initial or crops_final != crops_final:
+        # NaN
+        return 0, 0
+
+    return (
+        np.searchsorted(thresholds, crops_initial),
+        np.searchsorted(thresholds, crops_final),
+    )
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_threshold_codes(trans, initial_cover, crops_initial, crops_final, thresholds):
+    """
+    calc_natural_conversion for each of a sorted array of cropland thresholds,
+    returning an int8 array of shape (n_thresholds, rows, cols)
+    """
+    out = np.zeros((thresholds.size,) + trans.shape, dtype=np.int8)
+    for i in range(trans.shape[0]):
+        for j in range(trans.shape[1]):
+            outside, inside = sweep_codes(trans[i, j], initial_cover[i, j])
+            out[:, i, j] = outside
+            if inside != outside:
+                lo, hi = crop_increase_range(
+                    crops_initial[i, j], crops_final[i, j], thresholds
+                )
+                out[lo:hi, i, j] = inside
+
+    return out
+
+
+def natural_conversion_block(
+    trans,
+    lc_initial,
+    crops_initial,
+    crops_final,
+    y,
+    initial_lut,
+    x_res,
+    y_res,
+    kernel_threads=1,
+):
+    """
+    Calculate transition code, cell area and natural conversion area for one block
+    of plain numpy arrays. initial_lut maps initial land cover codes to their meaning
+    (see rule_lookup).
+    """
+    initial_natural = calc_rule_lookup(lc_initial, initial_lut)
+    crops_initial, crops_final, threshold = cropland_inputs(
+        crops_initial, crops_final, CROPLAND_THRESHOLD
+    )
+    meaning = calc_natural_conversion(
+        trans, initial_natural, crops_initial, crops_final, threshold
+    )
+
+    cell_areas = cell_area_grid(y, trans.shape[1], x_res, y_res, kernel_threads)
+
+    area_natural_conversion = ((meaning >= 1) & (meaning <= 3)).astype(
+        np.float32
+    ) * cell_areas
+
+    return meaning, cell_areas, area_natural_conversion
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_block_aggregates(meaning, cell_areas, area_natural_conversion, factor):
+    """
+    Aggregate a block to cells of factor x factor pixels, returning the summed
+    natural conversion area, summed pixel area and count of each transition code
+    """
+    n_rows = (meaning.shape[0] + factor - 1) // factor
+    n_cols = (meaning.shape[1] + factor - 1) // factor
+    area_conv_sum = np.zeros((n_rows, n_cols), dtype=np.float64)
+    area_pixel_sum = np.zeros((n_rows, n_cols), dtype=np.float64)
+    counts = np.zeros((N_TRANSITION_CODES, n_rows, n_cols), dtype=np.int32)
+
+    for i in range(meaning.shape[0]):
+        ii = i // factor
+        for j in range(meaning.shape[1]):
+            jj = j // factor
+            area_conv_sum[ii, jj] += area_natural_conversion[i, j]
+            area_pixel_sum[ii, jj] += cell_areas[i, j]
+            code = meaning[i, j]
+            if code >= 0 and code < N_TRANSITION_CODES:
+                counts[code, ii, jj] += 1
+
+    return area_conv_sum, area_pixel_sum, counts
+
+
+def coarse_coords(coord, factor, res):
+    """Centers of the aggregated cells along a coordinate of pixel centers"""
+    return coord[::factor] + (factor - 1) / 2 * res
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_trans_meaning(trans, trans_codes, trans_meanings):
+    """
+    calculate meaning of land cover transition
+
+    Reference implementation, with one pass over trans per code. The pipeline uses
+    calc_rule_lookup.
+    """
+    shp = trans.shape
+    trans = trans.ravel()
+    out = np.zeros(trans.shape, dtype=np.int32)
+
+    for code, meaning in zip(trans_codes, trans_meanings):
+        out[trans == code] = meaning
+    out[trans == NODATA_VALUE] = NODATA_VALUE
+
+    return np.reshape(out, shp)
+
+
+def rule_lookup(codes, meanings):
+    """
+    Dense lookup array of the meaning of each code, with 0 for codes that aren't in
+    the table and for no data. Later duplicates win, as in calc_trans_meaning.
+    """
+    lut = np.zeros(max(codes, default=NODATA_VALUE) + 1, dtype=np.int32)
+    for code, meaning in zip(codes, meanings):
+        lut[code] = meaning
+    lut[NODATA_VALUE] = NODATA_VALUE
+
+    return lut
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_rule_lookup(values, lut):
+    """
+    Meaning of each value of a 2D array from a lookup array made by rule_lookup. Gives
+    the same result as calc_trans_meaning in a single pass, rather than one per code.
+    """
+    out = np.zeros(values.shape, dtype=np.int32)
+    for i in range(values.shape[0]):
+        for j in range(values.shape[1]):
+            value = values[i, j]
+            if value >= 0 and value < lut.size:
+                out[i, j] = lut[value]
+
+    return out
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_code_presence(values, positions, n_positions):
+    """
+    Which of n_positions positions occur in a 2D array of codes, where positions is a
+    dense array of the position of each code. Codes outside of positions are counted
+    at the last position.
+    """
+    present = np.zeros(n_positions, dtype=np.bool_)
+    other = n_positions - 1
+    for i in range(values.shape[0]):
+        for j in range(values.shape[1]):
+            value = values[i, j]
+            if value >= 0 and value < positions.size:
+                present[positions[value]] = True
+            else:
+                present[other] = True
+
+    return present
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_lc_trans(lc_bl, lc_tg, multiplier):
+    shp = lc_bl.shape
+    lc_bl = lc_bl.ravel().astype(np.int32)
+    lc_tg = lc_tg.ravel().astype(np.int32)
+    a_trans_bl_tg = lc_bl * multiplier + lc_tg
+    a_trans_bl_tg[np.logical_or(lc_bl < 1, lc_tg < 1)] = NODATA_VALUE
+
+    return np.reshape(a_trans_bl_tg, shp)
+
+
+@numba.jit(nopython=True, nogil=True, parallel=True, cache=True)
+def calc_lc_trans_parallel(lc_bl, lc_tg, multiplier, out):
+    """
+    Row-parallel version of calc_lc_trans that writes into out (int32) in place,
+    without making int32 copies of the inputs or a temporary nodata mask
+    """
+    for i in numba.prange(lc_bl.shape[0]):
+        for j in range(lc_bl.shape[1]):
+            if lc_bl[i, j] < 1 or lc_tg[i, j] < 1:
+                out[i, j] = NODATA_VALUE
+            else:
+                out[i, j] = np.int32(lc_bl[i, j]) * multiplier + np.int32(lc_tg[i, j])
+
+    return out
@@ -1,34 +1,26 @@
-import json
+import argparse
 import logging
 import os
-import sys
-from math import floor
+import shutil
 from pathlib import Path
-from pathlib import PurePath
-
-import boto3
-import dask
-import distributed
-import numpy as np
-import openpyxl
-import parallel_functions
-import psutil
-import rasterio
-import rioxarray
-import xarray as xr
-from dask.distributed import Client
-from dask.distributed import LocalCluster
-from dask.distributed import Lock
-from dask.distributed import progress
+
+import kernels
+import rule_tables
+import rule_updates
+import threaded_executor
+import uploads
 
 TESTING = False
-N_WORKERS = 14
-THREADS_PER_WORKER = 6
 
 DATA_PATH = Path("/data")
 
+MB = 1024 ** 2
+GB = 1024 ** 3
+
 CROPLANDS_S3_BUCKET = "trends.earth-private"
 CROPLANDS_S3_PREFIX = "cropland"
+# Mosaics of the uint8 tiles written by cropland_match_to_esa.py --dtype uint8
+CROPLANDS_UINT8_S3_PREFIX = "cropland/uint8"
 CCI_S3_BUCKET = "trends.earth-private"
 OUT_S3_BUCKET = "trends.earth-private"
 OUT_S3_PREFIX = "esa-cci/transitions"
@@ -38,8 +30,19 @@ FINAL_YEAR = 2019
 CROPLANDS_INITIAL_FILE = "Croplands_300m_2011.tif"
 CROPLANDS_FINAL_FILE = "Croplands_300m_2019.tif"
 CCI_TRANSITIONS_FILE = "ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_2011-2019.tif"
+# Transition codes in each block of the transitions (see rule_updates)
+CCI_PRESENCE_FILE = (
+    "ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_2011-2019_presence.npz"
+)
 CCI_INITIAL_FILE = "ESACCI-LC-L4-LCCS-Map-300m-P1Y-2011-v2.0.7.tif"
 
+# Aggregation factors (in 300m pixels) for the optional coarse outputs: 30 arc-seconds,
+# 5 arc-minutes and 0.25 degrees
+AGGREGATION_FACTORS = {"1km": 3, "10km": 30, "0.25deg": 90}
+
+# Window (row_off, col_off, nrows, ncols) used when TESTING
+TESTING_WINDOW = (22000, 22000, 10000, 10000)
+
 formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
 logging.basicConfig(level=logging.INFO, format=formatter)
 
@@ -52,19 +55,15 @@ logging.getLogger("distributed.worker").setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
 
-with open(PurePath("/data/aws_credentials.json"), "r") as f:
-    aws_creds = json.load(f)
-
-
 def put_to_s3(filename: Path, bucket: str, prefix: str):
-    client = boto3.client("s3")
+    client = uploads.s3_client()
     key = f"{prefix}/{filename.name}"
     logger.info(f"Uploading {filename} to s3 at {key}")
     client.upload_file(str(filename), bucket, key)
 
 
 def get_from_s3(bucket, prefix, filename, out_path):
-    client = boto3.client("s3")
+    client = uploads.s3_client()
     logger.info(f"Downloading {filename} from s3 to {out_path}")
     client.download_file(bucket, f"{prefix}/{filename}", out_path)
 
@@ -76,7 +75,9 @@ def _log_file_size(out_file):
     )
 
 
-def ds_to_cog(ds, client):
+def ds_to_cog(ds, client, uploader):
+    from dask.distributed import Lock
+
     ds.rio.write_crs("EPSG:4326", inplace=True)
 
     if TESTING:
@@ -96,32 +97,91 @@ def ds_to_cog(ds, client):
         lock=Lock("rio-write", client=client),
     )
     _log_file_size(out_file)
-    put_to_s3(out_file, OUT_S3_BUCKET, OUT_S3_PREFIX)
+    uploader.submit(out_file)
 
 
-def ds_to_netcdf(ds):
+def ds_to_netcdf(ds, uploader, aggregates=None, sparse_dir=None):
+    """
+    Write ds, and any aggregated datasets (keyed by resolution) computed from it, in a
+    single compute pass. If sparse_dir is given the transition events of ds are also
+    written there (see sparse_output) in the same pass.
+    """
+    import dask
+    import sparse_output
+    from dask.distributed import as_completed
+    from dask.distributed import default_client
+    from dask.distributed import progress
+
     if TESTING:
         testing_string = "_TEST"
     else:
         testing_string = ""
 
-    out_file = (
-        DATA_PATH
-        / f"natural-conversion_300m_{INITIAL_YEAR}-{FINAL_YEAR}{testing_string}.nc"
+    datasets = {"300m": ds}
+    datasets.update(aggregates or {})
+
+    out_files = []
+    write_jobs = []
+    for resolution, data in datasets.items():
+        out_file = (
+            DATA_PATH
+            / f"natural-conversion_{resolution}_{INITIAL_YEAR}-{FINAL_YEAR}{testing_string}.nc"
+        )
+        logger.info(f"Writing {out_file}...")
+        encoding_dict = {
+            key: {"zlib": True, "complevel": 6} for key in data.data_vars.keys()
+        }
+        out_files.append(out_file)
+        write_jobs.append(
+            data.to_netcdf(out_file, encoding=encoding_dict, compute=False)
+        )
+
+    if sparse_dir is None:
+        write_jobs = dask.persist(*write_jobs)
+        progress(write_jobs)
+        dask.compute(*write_jobs)
+    else:
+        # Submitted together so that the blocks are only computed once. Events are
+        # written to tiles as their blocks finish, while the netCDFs are written.
+        client = default_client()
+        windows, event_tasks = sparse_output.delayed_events(ds)
+        futures = client.compute(write_jobs + event_tasks)
+        write_futures = futures[: len(write_jobs)]
+        event_futures = futures[len(write_jobs) :]
+        event_windows = {
+            future.key: window for future, window in zip(event_futures, windows)
+        }
+        with sparse_output.SparseWriter(
+            sparse_dir,
+            ds.sizes["y"],
+            ds.sizes["x"],
+            ds.rio.transform(),
+            on_tile=sparse_uploader(uploader, sparse_dir),
+        ) as sparse:
+            for future, events in as_completed(event_futures, with_results=True):
+                sparse.add_events(event_windows[future.key], events)
+                future.release()
+        client.gather(write_futures)
+
+    for out_file in out_files:
+        _log_file_size(out_file)
+        uploader.submit(out_file)
+
+
+def sparse_uploader(uploader, sparse_dir):
+    """Return a function queueing each sparse output file for upload under its folder"""
+    return lambda path: uploader.submit(
+        path, prefix=f"{OUT_S3_PREFIX}/{Path(sparse_dir).name}"
     )
-    logger.info(f"Writing {out_file}...")
-    encoding_dict = {key: {"zlib": True, "complevel": 6} for key in ds.data_vars.keys()}
-    write_job = ds.to_netcdf(out_file, encoding=encoding_dict, compute=False)
 
-    write_job = write_job.persist()
-    progress(write_job)
-    write_job.compute()
-    _log_file_size(out_file)
 
-    put_to_s3(out_file, OUT_S3_BUCKET, OUT_S3_PREFIX)
+def sparse_output_dir(years, testing_string=""):
+    return DATA_PATH / f"natural-conversion_300m_{years}{testing_string}_sparse"
+
 
+def ds_to_cogs(ds, client, uploader):
+    from dask.distributed import Lock
 
-def ds_to_cogs(ds, client):
     ds.rio.write_crs("EPSG:4326", inplace=True)
 
     if TESTING:
@@ -141,7 +201,233 @@ def ds_to_cogs(ds, client):
             lock=Lock("rio-write", client=client),
         )
         _log_file_size(out_file)
-        put_to_s3(out_file, OUT_S3_BUCKET, OUT_S3_PREFIX)
+        uploader.submit(out_file)
+
+
+def fetch_previous_output(out_file: Path, base_file: Path):
+    """
+    Make the output of a previous run (base_file) available at out_file, copying it
+    locally or downloading it from S3. Returns False if there is no previous output.
+    """
+    import botocore
+
+    if out_file.exists():
+        return True
+    if base_file.exists():
+        logger.info(f"Copying {base_file} to {out_file}")
+        shutil.copyfile(base_file, out_file)
+        return True
+    try:
+        get_from_s3(OUT_S3_BUCKET, OUT_S3_PREFIX, base_file.name, str(out_file))
+    except botocore.exceptions.ClientError:
+        logger.info(f"No previous output {base_file.name} found")
+        return False
+
+    return True
+
+
+def changed_blocks(old_coding, window, out_files):
+    """
+    Return a function selecting the blocks affected by the differences between the
+    coding old_coding and the current one: those with a transition whose meaning
+    changed, or from an initial class whose meaning changed. Fetches the previous
+    outputs (out_files) and the presence index of the transitions. Returns None (so
+    that all blocks are computed) if any of them is missing.
+    """
+    import botocore
+
+    presence_path = DATA_PATH / CCI_PRESENCE_FILE
+    try:
+        if not presence_path.exists():
+            get_from_s3(
+                CCI_S3_BUCKET,
+                "esa-cci/transitions",
+                CCI_PRESENCE_FILE,
+                str(presence_path),
+            )
+    except botocore.exceptions.ClientError:
+        logger.info(f"No presence index {CCI_PRESENCE_FILE} found")
+        presence_path = None
+    if presence_path is None or not all(
+        fetch_previous_output(out_file, out_file) for out_file in out_files
+    ):
+        logger.info("Computing all blocks")
+        return None
+
+    old_transitions, old_initial = rule_updates.read_coding(old_coding)
+    transitions, initial = rule_updates.read_coding(rule_updates.CODING_FILE)
+    index = rule_updates.PresenceIndex.load(presence_path)
+    windows = rule_updates.affected_blocks(
+        index,
+        rule_updates.changed_codes(old_transitions, transitions),
+        rule_updates.changed_codes(old_initial, initial),
+    )
+
+    return rule_updates.overlapping(index, windows, (window or (0, 0))[:2])
+
+
+def run_threaded(
+    trans_file,
+    initial_cover_file,
+    crops_files,
+    rule_table,
+    block_size,
+    n_threads,
+    kernel_threads,
+    aggregate_resolutions,
+    uploader,
+    incremental=False,
+    incremental_base=None,
+    sparse=False,
+    memory_budget=None,
+    input_mode="memmap",
+    io_threads=None,
+    changed_rules=None,
+):
+    if TESTING:
+        logger.warning("****** Cropping data for testing ******")
+        testing_string = "_TEST"
+        window = TESTING_WINDOW
+    else:
+        testing_string = ""
+        window = None
+
+    def out_names(years):
+        out_files = {
+            name: DATA_PATH
+            / f"natural-conversion_300m_{years}_{name}{testing_string}.tif"
+            for name in threaded_executor.NATURAL_CONVERSION_OUTPUTS
+        }
+        aggregates = {
+            AGGREGATION_FACTORS[resolution]: DATA_PATH
+            / f"natural-conversion_{resolution}_{years}{testing_string}.tif"
+            for resolution in aggregate_resolutions
+        }
+        manifest = (
+            DATA_PATH / f"natural-conversion_300m_{years}{testing_string}_manifest.json"
+        )
+        return out_files, aggregates, manifest
+
+    out_files, aggregates, manifest_path = out_names(f"{INITIAL_YEAR}-{FINAL_YEAR}")
+
+    if incremental:
+        base_out_files, base_aggregates, base_manifest_path = out_names(
+            incremental_base or f"{INITIAL_YEAR}-{FINAL_YEAR}"
+        )
+        for out_file, base_file in zip(
+            [manifest_path]
+            + list(out_files.values())
+            + list(aggregates.values()),
+            [base_manifest_path]
+            + list(base_out_files.values())
+            + list(base_aggregates.values()),
+        ):
+            if not fetch_previous_output(out_file, base_file):
+                logger.info("Computing all blocks")
+                break
+    else:
+        manifest_path = None
+
+    select = None
+    if changed_rules:
+        select = changed_blocks(
+            changed_rules, window, list(out_files.values()) + list(aggregates.values())
+        )
+
+    if sparse:
+        sparse_dir = sparse_output_dir(f"{INITIAL_YEAR}-{FINAL_YEAR}", testing_string)
+        on_sparse_tile = sparse_uploader(uploader, sparse_dir)
+    else:
+        sparse_dir = on_sparse_tile = None
+
+    threaded_executor.run_natural_conversion(
+        trans_file,
+        initial_cover_file,
+        crops_files[0],
+        crops_files[-1],
+        out_files,
+        rule_table,
+        staging_path=DATA_PATH / "staging",
+        window=window,
+        block_size=block_size,
+        n_threads=n_threads,
+        kernel_threads=kernel_threads,
+        aggregates=aggregates,
+        manifest_path=manifest_path,
+        sparse_dir=sparse_dir,
+        on_sparse_tile=on_sparse_tile,
+        memory_budget=memory_budget,
+        input_mode=input_mode,
+        io_threads=io_threads,
+        select=select,
+    )
+
+    for out_file in list(out_files.values()) + list(aggregates.values()):
+        _log_file_size(out_file)
+        uploader.submit(out_file)
+    if manifest_path is not None:
+        uploader.submit(manifest_path)
+
+
+def run_sweep(in_data, thresholds, rule_table, x_res, y_res, rasters, uploader):
+    """
+    Compute natural conversion areas (and optionally transition rasters) for each of a
+    list of cropland thresholds in a single pass over the inputs. rule_table is the
+    name of the initial cover rule table registered on the workers.
+    """
+    import dask
+    import parallel_functions
+    import reductions
+    import xarray as xr
+    from dask.distributed import progress
+
+    if TESTING:
+        testing_string = "_TEST"
+    else:
+        testing_string = ""
+    years = f"{INITIAL_YEAR}-{FINAL_YEAR}"
+    thresholds = sorted(thresholds)
+    zones = "zones" in in_data
+
+    totals = reductions.threshold_sweep(
+        in_data, thresholds, rule_table, x_res, y_res, zones=zones
+    )
+    jobs = [totals]
+    out_files = []
+    if rasters:
+        logger.info("Mapping compute_threshold_codes...")
+        codes = xr.map_blocks(
+            parallel_functions.compute_threshold_codes,
+            in_data,
+            kwargs={
+                "thresholds": thresholds,
+                "rule_table": rule_table,
+            },
+            template=parallel_functions.threshold_codes_template(in_data, thresholds),
+        )
+        out_file = (
+            DATA_PATH / f"natural-conversion_sweep_300m_{years}{testing_string}.nc"
+        )
+        logger.info(f"Writing {out_file}...")
+        out_files.append(out_file)
+        jobs.append(
+            codes.to_netcdf(
+                out_file,
+                encoding={"transition": {"zlib": True, "complevel": 6}},
+                compute=False,
+            )
+        )
+
+    jobs = dask.persist(*jobs)
+    progress(jobs)
+    (zone_ids, areas), *_ = dask.compute(*jobs)
+
+    out_file = DATA_PATH / f"natural-conversion_sweep_{years}{testing_string}.csv"
+    reductions.write_threshold_sweep(zone_ids, areas, thresholds, out_file, zones)
+    out_files.insert(0, out_file)
+    for out_file in out_files:
+        _log_file_size(out_file)
+        uploader.submit(out_file)
 
 
 def get_trans_codes(
@@ -151,6 +437,8 @@ def get_trans_codes(
     first_data_row,
     last_data_row,
 ):
+    import openpyxl
+
     wb = openpyxl.load_workbook(xl_file)
     sheet = wb["Legend"]
 
@@ -180,6 +468,155 @@ def get_trans_codes(
 
 
 def main():
+    import dask
+    import dask_cluster
+    import distributed
+    import parallel_functions
+    import raster_reader
+    import rasterio
+    import rioxarray
+    import xarray as xr
+
+    parser = argparse.ArgumentParser(description="Calculate natural conversion")
+    parser.add_argument(
+        "--executor",
+        choices=["dask", "threads"],
+        default="dask",
+        help="Run blocks on a dask cluster, or on a single-node thread pool over "
+        "memory-mapped inputs",
+    )
+    dask_cluster.add_cluster_arguments(parser)
+    raster_reader.add_reader_arguments(parser)
+    parser.add_argument(
+        "--n-threads",
+        type=int,
+        default=None,
+        help="Number of threads for the threads executor (defaults to all CPUs)",
+    )
+    parser.add_argument(
+        "--input-mode",
+        choices=threaded_executor.INPUT_MODES,
+        default="memmap",
+        help="With the threads executor, stage the inputs to memory-mapped arrays "
+        "before the run, or read their blocks from the rasters ahead of use",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=None,
+        help="Threads reading blocks ahead of use with --input-mode prefetch",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=threaded_executor.DEFAULT_BLOCK_SIZE,
+        help="Block size (in pixels) used for processing",
+    )
+    parser.add_argument(
+        "--kernel-threads",
+        type=int,
+        default=1,
+        help="Threads used inside each block by the row-parallel kernels. Use with a "
+        "larger --block-size to run fewer, bigger blocks at once",
+    )
+    parser.add_argument(
+        "--aggregate",
+        nargs="+",
+        default=[],
+        choices=list(AGGREGATION_FACTORS.keys()),
+        help="Also write conversion area, pixel area and transition counts aggregated "
+        "to these resolutions. Block size is rounded up to align with them",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="With the threads executor, keep per-block fingerprints of the inputs and "
+        "outputs, and only recompute blocks whose inputs changed since the last run",
+    )
+    parser.add_argument(
+        "--incremental-base",
+        metavar="INITIAL-FINAL",
+        default=None,
+        help="Years (for example 2011-2019) of a previous run whose outputs are used as "
+        "the starting point for an incremental run",
+    )
+    parser.add_argument(
+        "--changed-rules",
+        metavar="OLD_CODING",
+        default=None,
+        help="With the threads executor, only recompute the blocks of the previous "
+        "outputs affected by the differences between this earlier version of the "
+        "coding spreadsheet and the current one (see rule_updates.py). Run after "
+        "esa_cci_transitions.py --changed-rules, with the patched transitions",
+    )
+    parser.add_argument(
+        "--sweep-thresholds",
+        nargs="+",
+        type=float,
+        default=None,
+        metavar="THRESHOLD",
+        help="Instead of the standard outputs, write natural conversion areas for each "
+        "of these cropland thresholds, computed in a single pass over the inputs",
+    )
+    parser.add_argument(
+        "--sweep-zones",
+        type=Path,
+        default=None,
+        help="Raster of integer zone ids (for example ecoregions) on the same grid as "
+        "the inputs, used to split the --sweep-thresholds areas by zone",
+    )
+    parser.add_argument(
+        "--sweep-rasters",
+        action="store_true",
+        help="Also write the transition codes for each of the --sweep-thresholds",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="Also write the pixels with a nonzero transition code as sparse tiles of "
+        "row, column, code and area, with an index (see sparse_output.py)",
+    )
+    parser.add_argument(
+        "--cropland-dtype",
+        choices=["float32", "uint8"],
+        default="float32",
+        help="Read the float32 cropland fractions, or the uint8 quantized version",
+    )
+    args = parser.parse_args()
+    if args.incremental and args.executor != "threads":
+        parser.error("--incremental requires --executor threads")
+    if args.sweep_thresholds and args.executor != "dask":
+        parser.error("--sweep-thresholds requires --executor dask")
+    if args.sweep_thresholds and args.cropland_dtype == "uint8":
+        invalid = [
+            threshold
+            for threshold in args.sweep_thresholds
+            if not kernels.is_uint8_threshold(threshold)
+        ]
+        if invalid:
+            parser.error(
+                f"--cropland-dtype uint8 can only be swept at multiples of "
+                f"{kernels.CROPLAND_UINT8_SCALE}, not {' '.join(map(str, invalid))}"
+            )
+    if (args.sweep_zones or args.sweep_rasters) and not args.sweep_thresholds:
+        parser.error("--sweep-zones and --sweep-rasters require --sweep-thresholds")
+    if args.sparse and (args.incremental or args.sweep_thresholds):
+        parser.error("--sparse cannot be used with --incremental or --sweep-thresholds")
+    if args.changed_rules and (
+        args.executor != "threads" or args.incremental or args.sparse
+    ):
+        parser.error(
+            "--changed-rules requires --executor threads, without --incremental or "
+            "--sparse"
+        )
+    aggregate_factors = [AGGREGATION_FACTORS[res] for res in args.aggregate]
+    block_size = threaded_executor.aligned_block_size(
+        args.block_size, aggregate_factors
+    )
+    if args.kernel_threads > 1:
+        # Fail early if the row-parallel kernels cannot run from several threads
+        logger.info(f"Using the {kernels.check_threading_layer()} threading layer")
+
     logger.info(
         "Using dask version %s, xarray version %s, rasterio version %s, "
         "rioxarray version %s, distributed version %s",
@@ -193,15 +630,25 @@ def main():
     # Download data
     DATA_PATH.mkdir(parents=True, exist_ok=True)
 
+    # (bucket, key, local path) of each input, for staging on external workers
+    inputs = []
     crops_in_files = []
     for in_file in [CROPLANDS_INITIAL_FILE, CROPLANDS_FINAL_FILE]:
-        local_crop_file_path = DATA_PATH / in_file
+        if args.cropland_dtype == "uint8":
+            crops_prefix = CROPLANDS_UINT8_S3_PREFIX
+            local_crop_file_path = DATA_PATH / f"{Path(in_file).stem}_uint8.tif"
+        else:
+            crops_prefix = CROPLANDS_S3_PREFIX
+            local_crop_file_path = DATA_PATH / in_file
         crops_in_files.append(local_crop_file_path)
+        inputs.append(
+            (CROPLANDS_S3_BUCKET, f"{crops_prefix}/{in_file}", local_crop_file_path)
+        )
 
         if not local_crop_file_path.exists():
             get_from_s3(
                 CROPLANDS_S3_BUCKET,
-                CROPLANDS_S3_PREFIX,
+                crops_prefix,
                 in_file,
                 str(local_crop_file_path),
             )
@@ -214,6 +661,13 @@ def main():
             CCI_TRANSITIONS_FILE,
             str(local_trans_file_path),
         )
+    inputs.append(
+        (
+            CCI_S3_BUCKET,
+            f"esa-cci/transitions/{CCI_TRANSITIONS_FILE}",
+            local_trans_file_path,
+        )
+    )
 
     local_initial_cover_file_path = DATA_PATH / CCI_INITIAL_FILE
     if not local_initial_cover_file_path.exists():
@@ -223,61 +677,96 @@ def main():
             CCI_INITIAL_FILE,
             str(local_initial_cover_file_path),
         )
+    inputs.append(
+        (CCI_S3_BUCKET, f"esa-cci/{CCI_INITIAL_FILE}", local_initial_cover_file_path)
+    )
 
-    logger.info("Loading data")
+    trans_codes, trans_meanings = get_trans_codes(
+        "ESA_CCI_Natural_Conversion_Coding_v2.xlsx",
+        initial_class_column=1,
+        final_class_column=3,
+        first_data_row=3,
+        last_data_row=40,
+    )
+    initial_rules = rule_tables.RuleTable(
+        "initial_natural", trans_codes, trans_meanings
+    )
 
-    with LocalCluster() as cluster, Client(cluster) as client:
-        logger.info(f"cluster {cluster}")
+    # Outputs are uploaded in the background as soon as they are written
+    uploader = uploads.UploadPipeline(OUT_S3_BUCKET, OUT_S3_PREFIX)
+
+    if args.executor == "threads":
+        logger.info("Calculating natural conversion with threads executor...")
+        with uploader:
+            run_threaded(
+                local_trans_file_path,
+                local_initial_cover_file_path,
+                crops_in_files,
+                initial_rules,
+                block_size=block_size,
+                n_threads=args.n_threads,
+                kernel_threads=args.kernel_threads,
+                aggregate_resolutions=args.aggregate,
+                uploader=uploader,
+                incremental=args.incremental,
+                incremental_base=args.incremental_base,
+                sparse=args.sparse,
+                memory_budget=args.memory_budget and args.memory_budget * GB,
+                input_mode=args.input_mode,
+                io_threads=args.io_threads,
+                changed_rules=args.changed_rules,
+            )
+        return
 
-        trans = rioxarray.open_rasterio(
-            local_trans_file_path,
-            chunks=dict(x=1024, y=1024),
-            # lock=Lock("rio-read-trans", client=client),
+    logger.info("Loading data")
+
+    client_context = dask_cluster.start_client(
+        args, "natural_conversion", args.kernel_threads
+    )
+    with client_context as client, uploader:
+        # Sent once to each worker, so tasks only carry the table name
+        dask_cluster.register_rule_tables(client, initial_rules)
+        # Workers of an external scheduler read the inputs from their own disks, but
+        # write outputs (and read --sweep-zones) directly under DATA_PATH
+        dask_cluster.stage_inputs(client, inputs)
+        if args.scheduler_address and (
+            not args.sweep_thresholds or args.sweep_rasters or args.sweep_zones
+        ):
+            dask_cluster.check_shared_path(client, DATA_PATH)
+
+        read_options = dict(
+            reader=args.reader, cache_bytes=int(args.reader_cache_mb * MB)
         )
         # for trans band 1 is transition code, band 2 is meaning
-        trans = trans.rename("trans").sel(band=2).drop("band")
-
-        initial_cover = rioxarray.open_rasterio(
-            local_initial_cover_file_path,
-            chunks=dict(x=1024, y=1024),
-            # lock=Lock("rio-read-initial-cover", client=client),
+        trans = raster_reader.open_band(
+            local_trans_file_path, 2, "trans", **read_options
         )
-        initial_cover = initial_cover.rename("lc_initial").sel(band=1).drop("band")
-
-        crops_initial = rioxarray.open_rasterio(
-            crops_in_files[0],
-            chunks=dict(x=1024, y=1024),
-            # lock=Lock("rio-read-crops", client=client),
+        initial_cover = raster_reader.open_band(
+            local_initial_cover_file_path, 1, "lc_initial", **read_options
         )
-        crops_initial = crops_initial.rename("crops_initial").sel(band=1).drop("band")
-        crops_final = rioxarray.open_rasterio(
-            crops_in_files[-1],
-            chunks=dict(x=1024, y=1024),
-            # lock=Lock("rio-read-crops", client=client),
+        crops_initial = raster_reader.open_band(
+            crops_in_files[0], 1, "crops_initial", **read_options
         )
-        crops_final = crops_final.rename("crops_final").sel(band=1).drop("band")
+        crops_final = raster_reader.open_band(
+            crops_in_files[-1], 1, "crops_final", **read_options
+        )
+
+        layers = [trans, initial_cover, crops_initial, crops_final]
+        if args.sweep_zones:
+            layers.append(
+                raster_reader.open_band(args.sweep_zones, 1, "zones", **read_options)
+            )
 
         # Crop data for testing
         if TESTING:
             logger.warning("****** Cropping data for testing ******")
-            trans = trans[22000:32000, 22000:32000]
-            initial_cover = initial_cover[22000:32000, 22000:32000]
-            crops_initial = crops_initial[22000:32000, 22000:32000]
-            crops_final = crops_final[22000:32000, 22000:32000]
+            layers = [layer[22000:32000, 22000:32000] for layer in layers]
 
         in_data = xr.merge(
-            [trans, initial_cover, crops_initial, crops_final],
+            layers,
             join="override",
             combine_attrs="drop",
-        ).chunk(dict(x=512, y=512))
-
-        trans_codes, trans_meanings = get_trans_codes(
-            "ESA_CCI_Natural_Conversion_Coding_v2.xlsx",
-            initial_class_column=1,
-            final_class_column=3,
-            first_data_row=3,
-            last_data_row=40,
-        )
+        ).chunk(dict(x=block_size, y=block_size))
 
         ###########################################################################
         # Compute transitions
@@ -289,19 +778,55 @@ def main():
 
         # sys.exit()
 
+        x_res = float((in_data.x[1] - in_data.x[0]).values)
+        y_res = float((in_data.y[0] - in_data.y[1]).values)
+
+        if args.sweep_thresholds:
+            logger.info(f"Sweeping cropland thresholds {args.sweep_thresholds}...")
+            run_sweep(
+                in_data,
+                args.sweep_thresholds,
+                initial_rules.name,
+                x_res,
+                y_res,
+                args.sweep_rasters,
+                uploader,
+            )
+            return
+
         logger.info("Mapping compute_natural_conversion...")
         out = xr.map_blocks(
             parallel_functions.compute_natural_conversion,
             in_data,
             kwargs={
-                "trans_codes": trans_codes,
-                "trans_meanings": trans_meanings,
-                "x_res": float((in_data.x[1] - in_data.x[0]).values),
-                "y_res": float((in_data.y[0] - in_data.y[1]).values),
+                "rule_table": initial_rules.name,
+                "x_res": x_res,
+                "y_res": y_res,
+                "kernel_threads": args.kernel_threads,
             },
         )
 
-        ds_to_netcdf(out)
+        aggregates = {}
+        for resolution in args.aggregate:
+            factor = AGGREGATION_FACTORS[resolution]
+            logger.info(f"Mapping compute_aggregates to {resolution}...")
+            aggregates[resolution] = xr.map_blocks(
+                parallel_functions.compute_aggregates,
+                out,
+                kwargs={"factor": factor, "x_res": x_res, "y_res": y_res},
+                template=parallel_functions.aggregates_template(
+                    out, factor, x_res, y_res
+                ),
+            )
+
+        if args.sparse:
+            testing_string = "_TEST" if TESTING else ""
+            sparse_dir = sparse_output_dir(
+                f"{INITIAL_YEAR}-{FINAL_YEAR}", testing_string
+            )
+        else:
+            sparse_dir = None
+        ds_to_netcdf(out, uploader, aggregates, sparse_dir)
 
         # nat_conv = client.persist(nat_conv)
         # nat_conv = nat_conv.compute()
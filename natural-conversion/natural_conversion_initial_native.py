@@ -1,36 +1,19 @@
-import json
+import argparse
 import logging
 import os
-import sys
-from math import floor
 from pathlib import Path
-from pathlib import PurePath
-
-import boto3
-import dask
-import distributed
-import numpy as np
-import openpyxl
-import parallel_functions
-import psutil
-import rasterio
-import rioxarray
-import xarray as xr
-from dask.distributed import Client
-from dask.distributed import LocalCluster
-from dask.distributed import Lock
-from dask.distributed import progress
+
+import rule_tables
+import uploads
 
 TESTING = False
-N_WORKERS = 32
-THREADS_PER_WORKER = 4
 
 # TESTING = True
-# N_WORKERS = 8
-# THREADS_PER_WORKER = 4
 
 DATA_PATH = Path("/data")
 
+MB = 1024 ** 2
+
 CCI_S3_BUCKET = "trends.earth-private"
 OUT_S3_BUCKET = "trends.earth-private"
 OUT_S3_PREFIX = "esa-cci/transitions"
@@ -50,19 +33,15 @@ logging.getLogger("distributed.worker").setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
 
-with open(PurePath("/data/aws_credentials.json"), "r") as f:
-    aws_creds = json.load(f)
-
-
 def put_to_s3(filename: Path, bucket: str, prefix: str):
-    client = boto3.client("s3")
+    client = uploads.s3_client()
     key = f"{prefix}/{filename.name}"
     logger.info(f"Uploading {filename} to s3 at {key}")
     client.upload_file(str(filename), bucket, key)
 
 
 def get_from_s3(bucket, prefix, filename, out_path):
-    client = boto3.client("s3")
+    client = uploads.s3_client()
     logger.info(f"Downloading {filename} from s3 to {out_path}")
     client.download_file(bucket, f"{prefix}/{filename}", out_path)
 
@@ -104,6 +83,8 @@ def get_recode(
     first_data_row,
     last_data_row,
 ):
+    import openpyxl
+
     wb = openpyxl.load_workbook(xl_file)
     sheet = wb["Legend"]
 
@@ -133,6 +114,20 @@ def get_recode(
 
 
 def main():
+    import dask
+    import dask_cluster
+    import distributed
+    import parallel_functions
+    import raster_reader
+    import rasterio
+    import rioxarray
+    import xarray as xr
+
+    parser = argparse.ArgumentParser(description="Recode initial land cover")
+    dask_cluster.add_cluster_arguments(parser)
+    raster_reader.add_reader_arguments(parser)
+    args = parser.parse_args()
+
     logger.info(
         "Using dask version %s, xarray version %s, rasterio version %s, "
         "rioxarray version %s, distributed version %s",
@@ -157,15 +152,22 @@ def main():
 
     logger.info("Loading data")
 
-    with LocalCluster() as cluster, Client(cluster) as client:
-        logger.info(f"cluster {cluster}")
+    with dask_cluster.start_client(args, "initial_cover") as client:
+        # Workers of an external scheduler read the input from their own disks
+        initial_input = (
+            CCI_S3_BUCKET,
+            f"esa-cci/{CCI_INITIAL_FILE}",
+            local_initial_cover_file_path,
+        )
+        dask_cluster.stage_inputs(client, [initial_input])
 
-        initial_cover = rioxarray.open_rasterio(
+        initial_cover = raster_reader.open_band(
             local_initial_cover_file_path,
-            chunks=dict(x=1024, y=1024),
-            # lock=Lock("rio-read-initial-cover", client=client),
+            1,
+            "lc_initial",
+            reader=args.reader,
+            cache_bytes=int(args.reader_cache_mb * MB),
         )
-        initial_cover = initial_cover.rename("lc_initial").sel(band=1).drop("band")
 
         # Crop data for testing
         if TESTING:
@@ -179,6 +181,10 @@ def main():
             first_data_row=3,
             last_data_row=40,
         )
+        # Sent once to each worker, so tasks only carry the table name
+        (recode_table,) = dask_cluster.register_rule_tables(
+            client, rule_tables.RuleTable("initial_cover_recode", initial_code, recode)
+        )
 
         ###########################################################################
         # Compute transitions
@@ -190,7 +196,7 @@ def main():
         out = xr.map_blocks(
             parallel_functions.recode_cover,
             initial_cover,
-            kwargs={"initial_code": initial_code, "recode": recode},
+            kwargs={"rule_table": recode_table},
         )
 
         # ds_to_cog(out, client)
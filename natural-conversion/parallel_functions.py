@@ -1,137 +1,158 @@
-# Based on https://stackoverflow.com/a/62041888/871101
+"""
+xarray wrappers around the kernels, for use with xarray.map_blocks. The kernels
+themselves are in kernels. Rule tables are passed to the wrappers by name, and looked
+up in the registry of the worker (see rule_tables).
+"""
 import logging
 
-import numba
 import numpy as np
+import rule_tables
 import xarray as xr
-from numba.pycc import CC
-
-cc = CC("parallel_functions")
+from kernels import CROPLAND_THRESHOLD
+from kernels import N_TRANSITION_CODES
+from kernels import calc_block_aggregates
+from kernels import calc_lc_trans
+from kernels import calc_lc_trans_parallel
+from kernels import calc_natural_conversion
+from kernels import calc_threshold_codes
+from kernels import cell_area_grid
+from kernels import coarse_coords
+from kernels import cropland_inputs
+from kernels import natural_conversion_block
+from kernels import set_kernel_threads
 
 logger = logging.getLogger(__name__)
 
-NODATA_VALUE = 0
-
 
-@numba.jit(nopython=True, nogil=True)
-@cc.export("slice_area", "f8(f8)")
-def slice_area(f):
-    """
-    Calculate the area of a slice of the globe from the equator to the parallel
-    at latitude f (on WGS84 ellipsoid). Based on:
-    https://gis.stackexchange.com/questions/127165/more-accurate-way-to-calculate-area-of-rasters
-    """
-    a = 6378137.0  # in meters
-    b = 6356752.3142  # in meters,
-    e = np.sqrt(1 - pow(b / a, 2))
-    zp = 1 + e * np.sin(f)
-    zm = 1 - e * np.sin(f)
-
-    return (
-        np.pi
-        * pow(b, 2)
-        * ((2 * np.arctanh(e * np.sin(f))) / (2 * e) + np.sin(f) / (zp * zm))
-    )
+def compute_natural_conversion(
+    data: xr.DataArray,
+    rule_table: str,
+    x_res: float,
+    y_res: float,
+    kernel_threads: int = 1,
+) -> xr.DataArray:
 
+    coords = {"y": data.y, "x": data.x}
+    out = xr.Dataset(coords=coords)
 
-@numba.jit(nopython=True, nogil=True)
-@cc.export("calc_cell_area", "f8(f8, f8, f8)")
-def calc_cell_area(y, x_res, y_res):
-    """
-    Returns cell area in hectares
+    meaning, cell_areas, area_natural_conversion = natural_conversion_block(
+        data.trans.values,
+        data.lc_initial.values,
+        data.crops_initial.values,
+        data.crops_final.values,
+        data.y.values,
+        rule_tables.get(rule_table).lut,
+        x_res,
+        y_res,
+        kernel_threads,
+    )
 
-    Use formula to calculate area of a raster cell on WGS84 ellipsoid, following
-    https://gis.stackexchange.com/questions/127165/more-accurate-way-to-calculate-area-of-rasters
+    out["transition"] = (("y", "x"), meaning)
+    out["area_pixel"] = (("y", "x"), cell_areas)
+    out["area_natural_conversion"] = (("y", "x"), area_natural_conversion)
 
-    y_min: minimum latitude
-    y_max: maximum latitude
-    x_res: width of cell in degrees
-    """
+    return out
 
-    shp = y.shape
-    out = np.zeros(shp, dtype=np.float32)
 
-    y = y.copy().ravel()
-    y_min = y - y_res / 2
-    y_max = y + y_res / 2
+def aggregates_template(data: xr.Dataset, factor: int, x_res: float, y_res: float):
+    """Lazy template of the output of compute_aggregates, for use with map_blocks"""
+    import dask.array as da
 
-    out = (
-        (slice_area(np.deg2rad(y_max)) - slice_area(np.deg2rad(y_min)))
-        * (x_res / 360.0)
-        * 0.0001
+    y_chunks = tuple(-(-c // factor) for c in data.chunks["y"])
+    x_chunks = tuple(-(-c // factor) for c in data.chunks["x"])
+    coords = {
+        "y": coarse_coords(data.y.values, factor, -y_res),
+        "x": coarse_coords(data.x.values, factor, x_res),
+        "transition": np.arange(N_TRANSITION_CODES),
+    }
+    area = da.zeros(
+        (sum(y_chunks), sum(x_chunks)), chunks=(y_chunks, x_chunks), dtype=np.float64
+    )
+    counts = da.zeros(
+        (N_TRANSITION_CODES, sum(y_chunks), sum(x_chunks)),
+        chunks=((N_TRANSITION_CODES,), y_chunks, x_chunks),
+        dtype=np.int32,
     )
 
-    return np.reshape(out, shp)
+    return xr.Dataset(
+        {
+            "area_natural_conversion": (("y", "x"), area),
+            "area_pixel": (("y", "x"), area),
+            "transition_count": (("transition", "y", "x"), counts),
+        },
+        coords=coords,
+    )
 
 
-@numba.jit(nopython=True, nogil=True)
-@cc.export("calc_natural_conversion", "i2[:,:](i4[:,:], i4[:,:], i4[:,:], i4[:,:])")
-def calc_natural_conversion(trans, initial_cover, crops_initial, crops_final):
-    """calculate land cover degradation"""
-    shp = trans.shape
-    trans = trans.ravel()
-    initial_cover = initial_cover.ravel()
-    crops_initial = crops_initial.ravel()
-    crops_final = crops_final.ravel()
-    out = np.zeros(trans.shape, dtype=np.int8)
+def compute_aggregates(
+    data: xr.Dataset, factor: int, x_res: float, y_res: float
+) -> xr.Dataset:
+    """
+    Aggregate the output of compute_natural_conversion to factor x factor cells. Block
+    sizes must be multiples of factor so that aggregated cells don't span blocks.
+    """
+    coords = {
+        "y": coarse_coords(data.y.values, factor, -y_res),
+        "x": coarse_coords(data.x.values, factor, x_res),
+        "transition": np.arange(N_TRANSITION_CODES),
+    }
+    out = xr.Dataset(coords=coords)
 
-    # Code natural conversion as indicated by CCI as conversion
-    out[trans == 1] = 1
+    area_conv_sum, area_pixel_sum, counts = calc_block_aggregates(
+        data.transition.values,
+        data.area_pixel.values,
+        data.area_natural_conversion.values,
+        factor,
+    )
 
-    # Code cropland increase co-occurring with esa-indicated conversion as 2
-    crop_increase = (crops_initial <= 0.5) & (crops_final > 0.5)
-    out[(out == 1) & crop_increase] = 2
+    out["area_natural_conversion"] = (("y", "x"), area_conv_sum)
+    out["area_pixel"] = (("y", "x"), area_pixel_sum)
+    out["transition_count"] = (("transition", "y", "x"), counts)
 
-    # Code cropland increase occurring on what was initially natural, but where change
-    # was not in ESA, as 3
-    out[(out == 0) & crop_increase & (initial_cover == 1)] = 3
+    return out
 
-    ##
-    # Below are not natural conversion, but are coded in the output for future use
 
-    # Code other cropland increase occurring on land that esa indicated was forest as 4
-    out[(out == 0) & crop_increase & (initial_cover == 2)] = 4
-    # Code other cropland increase occurring on land that esa indicated was urban as 5
-    out[(out == 0) & crop_increase & (initial_cover == 4)] = 5
-    # Code other cropland increase occurring on land that esa indicated was other as 6
-    out[(out == 0) & crop_increase & (initial_cover == 5)] = 6
+def threshold_codes_template(data: xr.Dataset, thresholds):
+    """Lazy template of the output of compute_threshold_codes, for use with map_blocks"""
+    import dask.array as da
 
-    return np.reshape(out, shp)
+    codes = da.zeros(
+        (len(thresholds),) + data.trans.shape,
+        chunks=((len(thresholds),),) + data.trans.chunks,
+        dtype=np.int8,
+    )
 
+    return xr.Dataset(
+        {"transition": (("threshold", "y", "x"), codes)},
+        coords={"threshold": thresholds, "y": data.y, "x": data.x},
+    )
 
-def compute_natural_conversion(
-    data: xr.DataArray,
-    trans_codes: list,
-    trans_meanings: list,
-    x_res: float,
-    y_res: float,
-) -> xr.DataArray:
 
-    coords = {"y": data.y, "x": data.x}
+def compute_threshold_codes(
+    data: xr.Dataset,
+    thresholds,
+    rule_table: str,
+) -> xr.Dataset:
+    """Transition codes for each of a sorted list of cropland thresholds"""
+    coords = {"threshold": thresholds, "y": data.y, "x": data.x}
     out = xr.Dataset(coords=coords)
 
-    initial_natural = calc_trans_meaning(
-        data.lc_initial.values,
-        numba.typed.List(trans_codes),
-        numba.typed.List(trans_meanings),
-    )
-    meaning = calc_natural_conversion(
-        data.trans.values,
-        initial_natural,
+    initial_natural = rule_tables.get(rule_table).apply(data.lc_initial.values)
+    crops_initial, crops_final, raw_thresholds = cropland_inputs(
         data.crops_initial.values,
         data.crops_final.values,
+        np.asarray(thresholds, dtype=np.float64),
+    )
+    out["transition"] = (
+        ("threshold", "y", "x"),
+        calc_threshold_codes(
+            data.trans.values,
+            initial_natural,
+            crops_initial,
+            crops_final,
+            raw_thresholds,
+        ),
     )
-
-    cell_areas = np.expand_dims(calc_cell_area(data.y.values, x_res, y_res), axis=1)
-    cell_areas = np.repeat(cell_areas, repeats=data.x.size, axis=1)
-
-    area_natural_conversion = ((meaning >= 1) & (meaning <= 3)).astype(
-        np.float32
-    ) * cell_areas
-
-    out["transition"] = (("y", "x"), meaning)
-    out["area_pixel"] = (("y", "x"), cell_areas)
-    out["area_natural_conversion"] = (("y", "x"), area_natural_conversion)
 
     return out
 
@@ -140,12 +161,12 @@ def compute_cell_areas(
     data: xr.DataArray,
     x_res: float,
     y_res: float,
+    kernel_threads: int = 1,
 ) -> xr.DataArray:
     coords = {"y": data.y, "x": data.x}
     out = xr.Dataset(coords=coords)
 
-    cell_areas = np.expand_dims(calc_cell_area(data.y.values, x_res, y_res), axis=1)
-    cell_areas = np.repeat(cell_areas, repeats=data.x.size, axis=1)
+    cell_areas = cell_area_grid(data.y.values, data.x.size, x_res, y_res, kernel_threads)
 
     out["area_pixel"] = (("y", "x"), cell_areas)
 
@@ -153,21 +174,17 @@ def compute_cell_areas(
 
 
 def compute_natural_conv_transitions(
-    data: xr.DataArray, trans_codes: list, trans_meanings: list
+    data: xr.DataArray, rule_table: str
 ) -> xr.DataArray:
     coords = {"y": data.y, "x": data.x}
     out = xr.Dataset(coords=coords)
 
-    initial_natural = calc_trans_meaning(
-        data.lc_initial.values,
-        numba.typed.List(trans_codes),
-        numba.typed.List(trans_meanings),
+    initial_natural = rule_tables.get(rule_table).apply(data.lc_initial.values)
+    crops_initial, crops_final, threshold = cropland_inputs(
+        data.crops_initial.values, data.crops_final.values, CROPLAND_THRESHOLD
     )
     meaning = calc_natural_conversion(
-        data.trans.values,
-        initial_natural,
-        data.crops_initial.values,
-        data.crops_final.values,
+        data.trans.values, initial_natural, crops_initial, crops_final, threshold
     )
 
     out["transition"] = (("y", "x"), meaning)
@@ -188,61 +205,38 @@ def compute_natural_conv_areas(data: xr.DataArray) -> xr.DataArray:
     return out
 
 
-# @numba.jit(nopython=True, nogil=True)
-# @cc.export("recode_cover", "i4[:,:](i4[:,:], i2[:], i2[:])")
-def recode_cover(initial_cover, initial_code, recode):
-    """calculate meaning of land cover transition"""
+def recode_cover(initial_cover, rule_table: str):
+    """recode initial land cover with a rule table of initial codes and recodes"""
     coords = {"y": initial_cover.y, "x": initial_cover.x}
     out = xr.Dataset(coords=coords)
 
-    recoded_cover = np.zeros(initial_cover.values.shape, dtype=np.int32)
-
-    for initial_code, recode in zip(initial_code, recode):
-        recoded_cover[initial_cover.values == initial_code] = recode
-    recoded_cover[initial_cover.values == NODATA_VALUE] = NODATA_VALUE
+    recoded_cover = rule_tables.get(rule_table).apply(initial_cover.values)
 
     out["cover"] = (("y", "x"), recoded_cover)
 
     return out
 
 
-@numba.jit(nopython=True, nogil=True)
-@cc.export("calc_trans_meaning", "i4[:,:](i4[:,:], i4[:,:], i2[:], i4)")
-def calc_trans_meaning(trans, trans_codes, trans_meanings):
-    """calculate meaning of land cover transition"""
-    shp = trans.shape
-    trans = trans.ravel()
-    out = np.zeros(trans.shape, dtype=np.int32)
-
-    for code, meaning in zip(trans_codes, trans_meanings):
-        out[trans == code] = meaning
-    out[trans == NODATA_VALUE] = NODATA_VALUE
-
-    return np.reshape(out, shp)
-
-
-@numba.jit(nopython=True, nogil=True)
-@cc.export("calc_lc_trans", "i4[:,:](u1[:,:], u1[:,:], i4)")
-def calc_lc_trans(lc_bl, lc_tg, multiplier):
-    shp = lc_bl.shape
-    lc_bl = lc_bl.ravel().astype(np.int32)
-    lc_tg = lc_tg.ravel().astype(np.int32)
-    a_trans_bl_tg = lc_bl * multiplier + lc_tg
-    a_trans_bl_tg[np.logical_or(lc_bl < 1, lc_tg < 1)] = NODATA_VALUE
-
-    return np.reshape(a_trans_bl_tg, shp)
-
-
 def compute_transitions(
-    lc: xr.DataArray, trans_codes: list, trans_meanings: list, global_attrs: dict
+    lc: xr.DataArray,
+    rule_table: str,
+    global_attrs: dict,
+    kernel_threads: int = 1,
 ) -> xr.DataArray:
     coords = {"y": lc.y, "x": lc.x}
     out = xr.Dataset(coords=coords, attrs=global_attrs)
 
-    trans = calc_lc_trans(lc.lc_initial.values, lc.lc_final.values, 1000)
-    meaning = calc_trans_meaning(
-        trans, numba.typed.List(trans_codes), numba.typed.List(trans_meanings)
-    )
+    if kernel_threads > 1:
+        set_kernel_threads(kernel_threads)
+        trans = calc_lc_trans_parallel(
+            lc.lc_initial.values,
+            lc.lc_final.values,
+            1000,
+            np.empty(lc.lc_initial.shape, dtype=np.int32),
+        )
+    else:
+        trans = calc_lc_trans(lc.lc_initial.values, lc.lc_final.values, 1000)
+    meaning = rule_tables.get(rule_table).apply(trans)
 
     out["transition"] = (("y", "x"), trans)
     out["meaning"] = (("y", "x"), meaning)
@@ -0,0 +1,407 @@
+"""
+Readers of input raster blocks for the block executors and the dask pipeline.
+
+ThreadLocalRasterReader reads windows of one band of a raster without any lock: each
+thread (of the thread pool, or of a dask worker) opens its own dataset handle, and
+keeps its own cache of the decoded internal blocks (tiles) of the raster, up to
+cache_bytes. Windows that share tiles with earlier windows (overlapping windows, or
+windows not aligned with the tiles) reuse the decoded tiles instead of decompressing
+them again. Striped (untiled) rasters are read directly, as each strip spans the full
+width of the raster. The reader can be pickled, so it can be sent to dask workers,
+where each worker thread opens its own handle on first use. open_band wraps it as a
+chunked DataArray, in place of rioxarray.open_rasterio, whose reads either share a
+lock or reopen the file for every chunk.
+
+PrefetchReader decodes the blocks of several rasters ahead of use in a background pool
+of I/O threads, in the order the blocks will be processed, so that reading and
+decompressing the next blocks overlaps with computing the current ones. At most
+depth blocks are buffered (read or being read) at once, enough for the next block of
+every thread computing blocks and a few more read ahead of them. Its counters record how
+often a block was ready when asked for (hits), how often it had to be waited for or
+read on demand (misses), and the time spent waiting (stall_seconds).
+
+Windows are (row_off, col_off, height, width) in pixels, as in threaded_executor.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Threads decoding blocks in the background
+DEFAULT_IO_THREADS = 4
+
+# Blocks buffered ahead per I/O thread
+BLOCKS_AHEAD_PER_THREAD = 2
+
+MB = 1024 ** 2
+
+# Decoded tiles cached per dataset handle (so per thread) by ThreadLocalRasterReader
+DEFAULT_CACHE_MB = 64
+
+# How open_band reads rasters
+READERS = ["threadlocal", "rioxarray"]
+
+
+class _Handle:
+    """A dataset handle of one thread, with its cache of decoded tiles"""
+
+    def __init__(self, ds):
+        self.ds = ds
+        self.tiles = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+class ThreadLocalRasterReader:
+    """
+    Read windows of band of the raster at path, with one dataset handle and tile cache
+    (of up to cache_bytes, 0 to disable it) per thread, and no locks on the read path.
+    Also supports numpy-style 2D slicing, for dask.array.from_array.
+    """
+
+    def __init__(self, path, band=1, cache_bytes=DEFAULT_CACHE_MB * MB):
+        import rasterio
+
+        self.path = str(path)
+        self.band = band
+        self.cache_bytes = cache_bytes
+        with rasterio.open(self.path) as ds:
+            self.shape = (ds.height, ds.width)
+            self.dtype = np.dtype(ds.dtypes[band - 1])
+            self.block_shape = ds.block_shapes[band - 1]
+            self.transform = ds.transform
+            self.nodata = ds.nodatavals[band - 1]
+        self.ndim = 2
+        # Striped rasters are left to GDAL, as caching full-width strips per thread
+        # would hold most of a window of rows
+        self.tiled = self.block_shape[1] < self.shape[1]
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"], state["_handles"], state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _handle(self):
+        import rasterio
+
+        handle = getattr(self._local, "handle", None)
+        if handle is None:
+            handle = _Handle(rasterio.open(self.path))
+            # Only taken once per thread, to track handles for close and stats
+            with self._lock:
+                self._handles.append(handle)
+            self._local.handle = handle
+
+        return handle
+
+    def _tile(self, handle, tile_row, tile_col):
+        from rasterio.windows import Window
+
+        key = (tile_row, tile_col)
+        tile = handle.tiles.get(key)
+        if tile is not None:
+            handle.tiles.move_to_end(key)
+            handle.hits += 1
+            return tile
+
+        handle.misses += 1
+        tile_height, tile_width = self.block_shape
+        row_off = tile_row * tile_height
+        col_off = tile_col * tile_width
+        tile = handle.ds.read(
+            self.band,
+            window=Window(
+                col_off,
+                row_off,
+                min(tile_width, self.shape[1] - col_off),
+                min(tile_height, self.shape[0] - row_off),
+            ),
+        )
+        if tile.nbytes <= self.cache_bytes:
+            handle.tiles[key] = tile
+            handle.cached_bytes += tile.nbytes
+            while handle.cached_bytes > self.cache_bytes:
+                _, evicted = handle.tiles.popitem(last=False)
+                handle.cached_bytes -= evicted.nbytes
+
+        return tile
+
+    def read(self, window):
+        """Return the array of window (row_off, col_off, height, width)"""
+        from rasterio.windows import Window
+
+        row_off, col_off, nrows, ncols = window
+        handle = self._handle()
+        if not self.tiled or not self.cache_bytes:
+            return handle.ds.read(
+                self.band, window=Window(col_off, row_off, ncols, nrows)
+            )
+
+        tile_height, tile_width = self.block_shape
+        out = np.empty((nrows, ncols), dtype=self.dtype)
+        for tile_row in range(
+            row_off // tile_height, -(-(row_off + nrows) // tile_height)
+        ):
+            for tile_col in range(
+                col_off // tile_width, -(-(col_off + ncols) // tile_width)
+            ):
+                tile = self._tile(handle, tile_row, tile_col)
+                # Overlap of the tile and the window, relative to the tile
+                top = max(row_off - tile_row * tile_height, 0)
+                left = max(col_off - tile_col * tile_width, 0)
+                bottom = min(row_off + nrows - tile_row * tile_height, tile.shape[0])
+                right = min(col_off + ncols - tile_col * tile_width, tile.shape[1])
+                out_row = tile_row * tile_height + top - row_off
+                out_col = tile_col * tile_width + left - col_off
+                out[
+                    out_row : out_row + bottom - top, out_col : out_col + right - left
+                ] = tile[top:bottom, left:right]
+
+        return out
+
+    def __getitem__(self, key):
+        rows, cols = key
+        row_off, row_end, row_step = rows.indices(self.shape[0])
+        col_off, col_end, col_step = cols.indices(self.shape[1])
+        if row_step != 1 or col_step != 1:
+            raise IndexError("ThreadLocalRasterReader only supports contiguous slices")
+
+        return self.read(
+            (row_off, col_off, max(row_end - row_off, 0), max(col_end - col_off, 0))
+        )
+
+    def stats(self):
+        """Tile cache hits and misses, summed over the handles of this process"""
+        with self._lock:
+            hits = sum(handle.hits for handle in self._handles)
+            misses = sum(handle.misses for handle in self._handles)
+
+        return {
+            "handles": len(self._handles),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def close(self):
+        """Close the dataset handles opened so far in this process"""
+        with self._lock:
+            for handle in self._handles:
+                handle.ds.close()
+                handle.tiles.clear()
+            self._handles = []
+        self._local = threading.local()
+
+
+def add_reader_arguments(parser):
+    """Add the options selecting how the dask pipeline reads its input rasters"""
+    parser.add_argument(
+        "--reader",
+        choices=READERS,
+        default="threadlocal",
+        help="Read input chunks with one dataset handle per worker thread and no "
+        "lock (threadlocal), or with rioxarray.open_rasterio",
+    )
+    parser.add_argument(
+        "--reader-cache-mb",
+        type=float,
+        default=DEFAULT_CACHE_MB,
+        help="Decoded tiles cached per dataset handle (so per worker thread) by the "
+        "threadlocal reader, in MB. 0 disables the cache",
+    )
+
+
+def open_band(
+    path,
+    band=1,
+    name=None,
+    chunks=1024,
+    reader="threadlocal",
+    cache_bytes=DEFAULT_CACHE_MB * MB,
+):
+    """
+    Open band of the raster at path as a DataArray with dims (y, x) and pixel center
+    coordinates, in chunks of chunks x chunks pixels, read with a
+    ThreadLocalRasterReader or (with reader "rioxarray") with rioxarray.open_rasterio
+    """
+    if reader == "rioxarray":
+        import rioxarray
+
+        data = rioxarray.open_rasterio(path, chunks=dict(x=chunks, y=chunks))
+        data = data.sel(band=band).drop_vars("band")
+        return data.rename(name) if name else data
+    if reader != "threadlocal":
+        raise ValueError(f"reader must be one of {READERS}, not {reader!r}")
+
+    import dask.array
+    import xarray as xr
+    from affine import Affine
+    from dask.base import tokenize
+
+    source = ThreadLocalRasterReader(path, band, cache_bytes)
+    height, width = source.shape
+    # Pixel centers, computed as rioxarray does so coordinates match exactly
+    centers = source.transform * Affine.translation(0.5, 0.5)
+    x, _ = centers * (np.arange(width), np.zeros(width))
+    _, y = centers * (np.zeros(height), np.arange(height))
+    data = dask.array.from_array(
+        source,
+        chunks=(chunks, chunks),
+        lock=False,
+        asarray=False,
+        name=f"{name or 'band'}-{tokenize(source.path, band, chunks)}",
+    )
+    attrs = {} if source.nodata is None else {"_FillValue": source.nodata}
+
+    return xr.DataArray(
+        data, dims=("y", "x"), coords={"y": y, "x": x}, name=name, attrs=attrs
+    )
+
+
+def prefetch_depth(consumers, io_threads=DEFAULT_IO_THREADS):
+    """
+    Blocks a PrefetchReader buffers so that each of consumers threads finds its next
+    block queued, with BLOCKS_AHEAD_PER_THREAD blocks per I/O thread read ahead of them
+    """
+    return consumers + BLOCKS_AHEAD_PER_THREAD * io_threads
+
+
+class PrefetchReader:
+    """
+    Read the same window of each of sources (a dict of name: (path, band)), returning
+    a dict of name: array. offset (row_off, col_off) is added to every window, to read
+    a region of the rasters.
+
+    Windows passed to schedule are read ahead in the background, keeping up to depth
+    blocks queued (see prefetch_depth, which should count the threads reading them).
+    Other windows (and those read before schedule is called) are read on demand, and
+    scheduled windows read on demand before their turn are not read again. Each
+    thread opens its own dataset handles (see ThreadLocalRasterReader), so reads never
+    share a GDAL handle.
+    """
+
+    def __init__(
+        self, sources, n_threads=DEFAULT_IO_THREADS, depth=None, offset=(0, 0)
+    ):
+        self.sources = dict(sources)
+        self.n_threads = n_threads
+        self.depth = depth or prefetch_depth(1, n_threads)
+        self.offset = offset
+        self.hits = 0
+        self.misses = 0
+        self.stall_seconds = 0.0
+        # Each block is read once, so the readers do not cache tiles
+        self._readers = {
+            name: ThreadLocalRasterReader(path, band, cache_bytes=0)
+            for name, (path, band) in self.sources.items()
+        }
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._windows = iter(())
+        # Windows read on demand, skipped when their turn in the schedule comes
+        self._taken = set()
+        self._pool = ThreadPoolExecutor(n_threads, thread_name_prefix="prefetch")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _read(self, window):
+        row_off, col_off, nrows, ncols = window
+        window = (row_off + self.offset[0], col_off + self.offset[1], nrows, ncols)
+
+        return {name: reader.read(window) for name, reader in self._readers.items()}
+
+    def _fill(self):
+        # Called with self._lock held
+        while len(self._pending) < self.depth:
+            window = next(self._windows, None)
+            if window is None:
+                return
+            if tuple(window) in self._taken:
+                self._taken.discard(tuple(window))
+                continue
+            self._pending[tuple(window)] = self._pool.submit(self._read, window)
+
+    def schedule(self, windows):
+        """Start reading windows (in this order) ahead of use, and reset counters"""
+        with self._lock:
+            self._windows = iter(windows)
+            self._taken = set()
+            self.hits = 0
+            self.misses = 0
+            self.stall_seconds = 0.0
+            self._fill()
+
+    def read(self, window):
+        """Return the blocks of window, waiting for them if they are not read yet"""
+        with self._lock:
+            future = self._pending.pop(tuple(window), None)
+            if future is None:
+                self._taken.add(tuple(window))
+            self._fill()
+        if future is not None and future.done():
+            with self._lock:
+                self.hits += 1
+            return future.result()
+
+        start = time.perf_counter()
+        blocks = future.result() if future is not None else self._read(window)
+        with self._lock:
+            self.misses += 1
+            self.stall_seconds += time.perf_counter() - start
+
+        return blocks
+
+    def stats(self):
+        n = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n if n else 0.0,
+            "stall_seconds": self.stall_seconds,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            f"Prefetch hits {stats['hits']}, misses {stats['misses']} "
+            f"({100 * stats['hit_rate']:.1f}% hit rate), stalled for "
+            f"{stats['stall_seconds']:.2f} s"
+        )
+
+    def close(self):
+        """Stop reading ahead and close the dataset handles"""
+        with self._lock:
+            self._windows = iter(())
+            self._taken = set()
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+        self._pool.shutdown(wait=True)
+        for reader in self._readers.values():
+            reader.close()
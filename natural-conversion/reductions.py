@@ -0,0 +1,301 @@
+"""
+Per-block reductions that run alongside the raster computations and produce small
+summary tables instead of rasters.
+"""
+import logging
+
+import kernels
+import numba
+import numpy as np
+import rule_tables
+
+logger = logging.getLogger(__name__)
+
+# Tree reductions combine this many partial results per task
+SPLIT_EVERY = 8
+
+# Land cover codes are stored as uint8
+N_LC_CODES = 256
+
+
+def class_lookup(class_codes):
+    """Return an array mapping each land cover code to its index in class_codes (or -1)"""
+    lut = np.full(N_LC_CODES, -1, dtype=np.int16)
+    for index, code in enumerate(class_codes):
+        lut[code] = index
+
+    return lut
+
+
+def latitude_bands(y, band_width):
+    """Index of the band_width degree latitude band (counted from 90N) of each y"""
+    if band_width is None:
+        return np.zeros(y.size, dtype=np.int32), 1
+    n_bands = int(np.ceil(180 / band_width))
+    bands = np.floor((90 - y) / band_width).astype(np.int32)
+
+    return np.clip(bands, 0, n_bands - 1), n_bands
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_transition_areas(lc_bl, lc_tg, row_areas, row_bands, lut, n_classes, n_bands):
+    """
+    Area-weighted bincount of (initial class, final class) pairs for one block, by
+    latitude band. Pixels with codes missing from lut are skipped.
+    """
+    out = np.zeros((n_bands, n_classes, n_classes), dtype=np.float64)
+    for i in range(lc_bl.shape[0]):
+        area = row_areas[i]
+        band = row_bands[i]
+        for j in range(lc_bl.shape[1]):
+            initial = lut[lc_bl[i, j]]
+            final = lut[lc_tg[i, j]]
+            if initial >= 0 and final >= 0:
+                out[band, initial, final] += area
+
+    return out
+
+
+def block_transition_areas(lc_bl, lc_tg, y, x_res, y_res, lut, n_classes, band_width):
+    row_areas = kernels.calc_cell_area(y, x_res, y_res)
+    row_bands, n_bands = latitude_bands(y, band_width)
+
+    return calc_transition_areas(
+        lc_bl, lc_tg, row_areas, row_bands, lut, n_classes, n_bands
+    )
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def calc_threshold_sweep(
+    trans, initial_cover, crops_initial, crops_final, row_areas, zones, thresholds, n_zones
+):
+    """
+    Area of each transition code for each of a sorted array of cropland thresholds,
+    by zone index, for one block. Each pixel is a cropland increase for a contiguous
+    range of thresholds, so rather than recoding it per threshold its area is added to
+    a difference array at the two ends of that range, at a cost of two binary searches.
+    Returns areas of shape (n_zones, N_TRANSITION_CODES, n_thresholds).
+    """
+    n_codes = kernels.N_TRANSITION_CODES
+    base = np.zeros((n_zones, n_codes), dtype=np.float64)
+    diff = np.zeros((n_zones, n_codes, thresholds.size + 1), dtype=np.float64)
+    for i in range(trans.shape[0]):
+        area = row_areas[i]
+        for j in range(trans.shape[1]):
+            zone = zones[i, j]
+            outside, inside = kernels.sweep_codes(
+                trans[i, j], initial_cover[i, j]
+            )
+            base[zone, outside] += area
+            if inside != outside:
+                lo, hi = kernels.crop_increase_range(
+                    crops_initial[i, j], crops_final[i, j], thresholds
+                )
+                if lo < hi:
+                    diff[zone, outside, lo] -= area
+                    diff[zone, outside, hi] += area
+                    diff[zone, inside, lo] += area
+                    diff[zone, inside, hi] -= area
+
+    out = np.empty((n_zones, n_codes, thresholds.size), dtype=np.float64)
+    for zone in range(n_zones):
+        for code in range(n_codes):
+            total = base[zone, code]
+            for k in range(thresholds.size):
+                total += diff[zone, code, k]
+                out[zone, code, k] = total
+
+    return out
+
+
+def block_threshold_sweep(
+    trans,
+    lc_initial,
+    crops_initial,
+    crops_final,
+    y,
+    thresholds,
+    rule_table,
+    x_res,
+    y_res,
+    zones=None,
+):
+    """Return (zone ids, areas by zone, transition code and threshold) for one block"""
+    initial_natural = rule_tables.get(rule_table).apply(lc_initial)
+    row_areas = kernels.calc_cell_area(y, x_res, y_res)
+    crops_initial, crops_final, thresholds = kernels.cropland_inputs(
+        crops_initial, crops_final, thresholds
+    )
+    if zones is None:
+        zone_ids = np.zeros(1, dtype=np.int64)
+        zone_index = np.zeros(trans.shape, dtype=np.int32)
+    else:
+        zone_ids, zone_index = np.unique(zones, return_inverse=True)
+        zone_index = zone_index.reshape(zones.shape).astype(np.int32)
+
+    return zone_ids, calc_threshold_sweep(
+        trans,
+        initial_natural,
+        crops_initial,
+        crops_final,
+        row_areas,
+        zone_index,
+        thresholds,
+        zone_ids.size,
+    )
+
+
+def _block_threshold_sweep_zones(
+    trans, lc_initial, crops_initial, crops_final, zones, y, *args
+):
+    return block_threshold_sweep(
+        trans, lc_initial, crops_initial, crops_final, y, *args, zones=zones
+    )
+
+
+def _merge_zone_totals(*partials):
+    zone_ids, inverse = np.unique(
+        np.concatenate([ids for ids, _ in partials]), return_inverse=True
+    )
+    totals = np.zeros((zone_ids.size,) + partials[0][1].shape[1:], dtype=np.float64)
+    np.add.at(totals, inverse, np.concatenate([areas for _, areas in partials]))
+
+    return zone_ids, totals
+
+
+def _sum(*arrays):
+    return np.sum(arrays, axis=0)
+
+
+def tree_reduce(partials, func=_sum, split_every=SPLIT_EVERY):
+    """Combine a list of delayed partial results with a tree of delayed func calls"""
+    import dask
+
+    while len(partials) > 1:
+        partials = [
+            dask.delayed(func)(*partials[n : n + split_every])
+            for n in range(0, len(partials), split_every)
+        ]
+
+    return partials[0]
+
+
+def map_blocks_delayed(func, data, variables, *args, **kwargs):
+    """
+    Call func(*blocks, y, *args, **kwargs) with dask.delayed on each block of the named
+    variables of a dataset, returning the list of delayed results. y holds the latitudes
+    of the rows of the block.
+    """
+    import dask
+
+    blocks = [data[name].data.to_delayed() for name in variables]
+    y_offsets = np.cumsum((0,) + data.chunks["y"])
+    partials = []
+    for i in range(blocks[0].shape[0]):
+        y = data.y.values[y_offsets[i] : y_offsets[i + 1]]
+        for j in range(blocks[0].shape[1]):
+            partials.append(
+                dask.delayed(func)(
+                    *[block[i, j] for block in blocks], y, *args, **kwargs
+                )
+            )
+
+    return partials
+
+
+def transition_area_matrix(lc, class_codes, x_res, y_res, band_width=None):
+    """
+    Lazily compute the area (in hectares) of each transition between the classes in
+    class_codes, from lc.lc_initial to lc.lc_final. Returns a delayed array of shape
+    (n_bands, n_classes, n_classes), with one band unless band_width (in degrees) is
+    given.
+    """
+    lut = class_lookup(class_codes)
+    partials = map_blocks_delayed(
+        block_transition_areas,
+        lc,
+        ["lc_initial", "lc_final"],
+        x_res,
+        y_res,
+        lut,
+        len(class_codes),
+        band_width,
+    )
+    logger.info(f"Reducing transition areas over {len(partials)} blocks")
+
+    return tree_reduce(partials)
+
+
+def threshold_sweep(data, thresholds, rule_table, x_res, y_res, zones=False):
+    """
+    Lazily compute the area (in hectares) of each transition code for each of a sorted
+    list of cropland thresholds, reading each block of data once. rule_table is the
+    name of the registered table of initial cover meanings. If zones is True the
+    areas are also split by the values of data.zones. Returns a delayed tuple of zone
+    ids and areas of shape (n_zones, N_TRANSITION_CODES, n_thresholds).
+    """
+    variables = ["trans", "lc_initial", "crops_initial", "crops_final"]
+    if zones:
+        func = _block_threshold_sweep_zones
+        variables.append("zones")
+    else:
+        func = block_threshold_sweep
+    partials = map_blocks_delayed(
+        func,
+        data,
+        variables,
+        np.asarray(thresholds, dtype=np.float64),
+        rule_table,
+        x_res,
+        y_res,
+    )
+    logger.info(
+        f"Reducing areas for {len(thresholds)} thresholds over {len(partials)} blocks"
+    )
+
+    return tree_reduce(partials, func=_merge_zone_totals)
+
+
+def write_threshold_sweep(zone_ids, areas, thresholds, out_file, zones=False):
+    """
+    Write threshold sweep areas as a CSV with one row per (zone and) threshold, with
+    the natural conversion area (codes 1-3) and the area of each transition code
+    """
+    codes = range(kernels.N_TRANSITION_CODES)
+    with open(out_file, "w") as f:
+        f.write(
+            ("zone," if zones else "")
+            + "threshold,area_natural_conversion,"
+            + ",".join(f"area_transition_{code}" for code in codes)
+            + "\n"
+        )
+        for zone, zone_areas in zip(zone_ids, areas):
+            for k, threshold in enumerate(thresholds):
+                f.write(
+                    (f"{zone}," if zones else "")
+                    + f"{threshold:g},{zone_areas[1:4, k].sum():.4f},"
+                    + ",".join(f"{zone_areas[code, k]:.4f}" for code in codes)
+                    + "\n"
+                )
+
+
+def write_transition_area_matrix(matrix, class_codes, out_file):
+    """Write a (n_classes, n_classes) matrix of areas as a CSV with class code headers"""
+    with open(out_file, "w") as f:
+        f.write("initial\\final," + ",".join(str(c) for c in class_codes) + "\n")
+        for code, row in zip(class_codes, matrix):
+            f.write(f"{code}," + ",".join(f"{area:.4f}" for area in row) + "\n")
+
+
+def write_transition_area_bands(matrices, class_codes, band_width, out_file):
+    """Write nonzero per-band transition areas as a long format CSV"""
+    with open(out_file, "w") as f:
+        f.write("lat_north,lat_south,initial,final,area_ha\n")
+        for band, matrix in enumerate(matrices):
+            lat_north = 90 - band * band_width
+            lat_south = max(-90, lat_north - band_width)
+            for i, j in zip(*np.nonzero(matrix)):
+                f.write(
+                    f"{lat_north:g},{lat_south:g},{class_codes[i]},{class_codes[j]},"
+                    f"{matrix[i, j]:.4f}\n"
+                )
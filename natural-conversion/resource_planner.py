@@ -0,0 +1,499 @@
+"""
+Predict the memory, runtime and output size of each pipeline stage from the headers of
+its input rasters and the chosen block size, and recommend worker, thread and instance
+settings for the Batch job, without running it.
+
+The per-stage figures (bytes of memory per pixel of a block, pixels computed per
+second per thread, and MB of uncompressed pixels read and decoded, or encoded and
+written, per second per thread) default to measurements from `benchmark.py
+calibrate`, and can be replaced by running it on the target instance type and passing
+the result with --calibration.
+
+Example:
+
+    python resource_planner.py natural_conversion --vcpus 48 --memory-gb 300
+    python resource_planner.py --calibration calibration.json --json plans.json
+"""
+import argparse
+import json
+import logging
+import math
+from pathlib import Path
+
+import numpy as np
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# ESA CCI 300m grid, used when an input can't be read
+GLOBAL_SHAPE = (64800, 129600)
+
+DATA_PATH = Path("/data")
+
+# Memory used by a dask worker or the client before running any tasks, and by a
+# single-process (threads executor or GDAL) job
+WORKER_BASE_BYTES = 0.4 * GB
+CLIENT_BASE_BYTES = 1 * GB
+PROCESS_BASE_BYTES = 0.5 * GB
+
+# Chunk size of the rasters opened by natural_conversion and initial_cover
+DASK_CHUNK_SIZE = 1024
+
+# Blocks held per dask worker thread: one being computed, one waiting to be written
+DASK_BLOCKS_PER_THREAD = 2
+
+# Fraction of the vCPUs kept busy, and fixed startup time (cluster, staging, etc)
+PARALLEL_EFFICIENCY = {"dask": 0.7, "threads": 0.9, "gdal": 1.0}
+STARTUP_SECONDS = {"dask": 30, "threads": 5, "gdal": 10}
+
+# Fraction of the requested memory that the predicted peak may use
+MEMORY_HEADROOM = 0.8
+
+THREADS_PER_WORKER_CHOICES = [1, 2, 4, 6, 8]
+VCPU_CHOICES = {
+    "dask": [8, 16, 32, 48, 64, 96, 128],
+    "threads": [8, 16, 32, 48, 64, 96, 128],
+    "gdal": [1, 2, 4, 8],
+}
+
+# Data types of the inputs, used when their headers can't be read
+INPUT_DTYPES = {
+    "lc_initial": "uint8",
+    "lc_final": "uint8",
+    "trans": "int32",
+    "crops_initial": "float32",
+    "crops_final": "float32",
+}
+
+# Instance families by maximum memory per vCPU (GB)
+INSTANCE_FAMILIES = [(2, "c5"), (4, "m5"), (8, "r5"), (16, "x2iedn")]
+
+# Bytes per pixel of each output in memory, and an estimate of the fraction left after
+# LZW / zlib compression (mostly zeros outside conversion areas)
+STAGES = {
+    "esa_cci": {
+        "inputs": {
+            "lc_initial": DATA_PATH / "ESACCI-LC-L4-LCCS-Map-300m-P1Y-2011-v2.0.7.tif",
+            "lc_final": DATA_PATH / "C3S-LC-L4-LCCS-Map-300m-P1Y-2019-v2.1.1.tif",
+        },
+        "outputs": {"transition": (4, 0.15), "meaning": (4, 0.05)},
+        "executors": ["dask", "threads"],
+        # The dask path computes the whole output into the client before writing it
+        "gathers_output": True,
+        "mpixels_per_second": 90.0,
+        "bytes_per_pixel": 19.0,
+        "read_mb_per_second": 150.0,
+        "encode_mb_per_second": 190.0,
+    },
+    "natural_conversion": {
+        "inputs": {
+            "trans": DATA_PATH
+            / "ESACCI-LC-L4-LCCS-Map-300m-P1Y-Transitions_2011-2019.tif",
+            "lc_initial": DATA_PATH / "ESACCI-LC-L4-LCCS-Map-300m-P1Y-2011-v2.0.7.tif",
+            "crops_initial": DATA_PATH / "Croplands_300m_2011.tif",
+            "crops_final": DATA_PATH / "Croplands_300m_2019.tif",
+        },
+        "outputs": {
+            "transition": (1, 0.05),
+            "area_pixel": (8, 0.02),
+            "area_natural_conversion": (8, 0.02),
+        },
+        "executors": ["dask", "threads"],
+        "gathers_output": False,
+        "mpixels_per_second": 50.0,
+        "bytes_per_pixel": 39.0,
+        "read_mb_per_second": 150.0,
+        "encode_mb_per_second": 190.0,
+    },
+    "initial_cover": {
+        "inputs": {
+            "lc_initial": DATA_PATH / "ESACCI-LC-L4-LCCS-Map-300m-P1Y-2010-v2.0.7.tif",
+        },
+        "outputs": {"cover": (4, 0.05)},
+        "executors": ["dask"],
+        "gathers_output": False,
+        "mpixels_per_second": 1000.0,
+        "bytes_per_pixel": 9.0,
+        "read_mb_per_second": 150.0,
+        "encode_mb_per_second": 190.0,
+    },
+    # One Batch array job per 10 degree tile, averaging the 30m cropland layer
+    "cropland_match": {
+        "inputs": {},
+        "tile_shape": (3600, 3600),
+        "n_tiles": 648,
+        "source_pixels_per_pixel": 100,
+        "outputs": {"cropland": (4, 0.3)},
+        "executors": ["gdal"],
+        "gathers_output": False,
+        # GDAL warp memory limit and block cache set in warp_croplands
+        "fixed_bytes": 3 * GB,
+        # Source (30m) pixels read from S3 and averaged per second (including the
+        # reads), not calibrated
+        "mpixels_per_second": 5.0,
+        "bytes_per_pixel": 0,
+        "encode_mb_per_second": 190.0,
+    },
+}
+
+
+def load_calibration(calibration_file):
+    """Return STAGES updated with any figures in a benchmark.py calibrate file"""
+    stages = {name: dict(profile) for name, profile in STAGES.items()}
+    if calibration_file is None:
+        return stages
+    with open(calibration_file) as f:
+        calibration = json.load(f)
+    for name, figures in calibration.items():
+        if name not in stages:
+            logger.warning(f"Ignoring calibration for unknown stage {name}")
+            continue
+        stages[name].update(figures)
+        logger.info(f"Using calibrated figures for {name}: {figures}")
+
+    return stages
+
+
+def read_header(path):
+    """Return (height, width, dtype of band 1) of a raster, without reading its data"""
+    import rasterio
+
+    with rasterio.open(path) as ds:
+        return ds.height, ds.width, ds.dtypes[0]
+
+
+def stage_shape(profile, inputs):
+    """
+    Shape of the grid processed by a stage, and the total bytes per pixel of its
+    inputs, from the headers of the inputs
+    """
+    if "tile_shape" in profile:
+        return profile["tile_shape"], 0
+    shapes = {}
+    input_bytes = 0
+    for name, path in inputs.items():
+        path = str(path)
+        if path.startswith("/vsi") or Path(path).exists():
+            height, width, dtype = read_header(path)
+            logger.info(f"{name}: {path} is {height} x {width} {dtype}")
+            shapes[name] = (height, width)
+            input_bytes += np.dtype(dtype).itemsize
+        else:
+            logger.warning(f"{name}: {path} not found, assuming the global 300m grid")
+            shapes[name] = GLOBAL_SHAPE
+            input_bytes += np.dtype(INPUT_DTYPES[name]).itemsize
+    if len(set(shapes.values())) > 1:
+        logger.warning(f"Inputs have different shapes: {shapes}")
+
+    shape = max(shapes.values(), key=lambda shape: shape[0] * shape[1])
+
+    return shape, input_bytes
+
+
+def auto_block_size(shape):
+    """Approximate the square block size dask picks for chunks="auto" (uint8 input)"""
+    from dask.array.core import normalize_chunks
+
+    chunks = normalize_chunks("auto", shape, dtype=np.uint8)
+
+    return int(math.sqrt(chunks[0][0] * chunks[1][0]))
+
+
+def predict(profile, shape, executor, block_size, n_workers, threads_per_worker):
+    """
+    Predict peak memory, runtime and output size of one stage. n_workers is the number
+    of dask workers (1 for the threads executor and GDAL).
+    """
+    n_pixels = shape[0] * shape[1]
+    block_pixels = min(block_size ** 2, n_pixels)
+    block_bytes = block_pixels * profile["bytes_per_pixel"]
+    output_bytes_per_pixel = sum(size for size, _ in profile["outputs"].values())
+    output_bytes = n_pixels * output_bytes_per_pixel
+    compressed_bytes = n_pixels * sum(
+        size * ratio for size, ratio in profile["outputs"].values()
+    )
+    n_threads = n_workers * threads_per_worker
+
+    if executor == "dask":
+        worker_peak = (
+            WORKER_BASE_BYTES
+            + threads_per_worker * DASK_BLOCKS_PER_THREAD * block_bytes
+        )
+        client_peak = CLIENT_BASE_BYTES
+        if profile["gathers_output"]:
+            # The gathered blocks, plus the array they are concatenated into
+            client_peak += 2 * output_bytes
+        total_peak = n_workers * worker_peak + client_peak
+    elif executor == "threads":
+        # Each thread holds one block, and up to two blocks per thread of outputs are
+        # queued for the writer
+        worker_peak = (
+            PROCESS_BASE_BYTES
+            + n_threads * block_bytes
+            + 2 * n_threads * block_pixels * output_bytes_per_pixel
+        )
+        total_peak = worker_peak
+    else:
+        worker_peak = PROCESS_BASE_BYTES + profile["fixed_bytes"]
+        total_peak = worker_peak
+
+    if "source_pixels_per_pixel" in profile:
+        work_pixels = n_pixels * profile["source_pixels_per_pixel"]
+    else:
+        work_pixels = n_pixels
+    compute_seconds = work_pixels / (
+        profile["mpixels_per_second"]
+        * 1e6
+        * n_threads
+        * PARALLEL_EFFICIENCY[executor]
+    )
+    input_bytes = n_pixels * profile["bytes_per_input_pixel"]
+    if input_bytes:
+        if executor == "threads":
+            # The inputs are staged one strip at a time before any block is computed
+            read_threads = 1
+        else:
+            # Each thread reads the chunks of its own blocks
+            read_threads = n_threads * PARALLEL_EFFICIENCY[executor]
+        read_seconds = input_bytes / (
+            profile["read_mb_per_second"] * 1024 ** 2 * read_threads
+        )
+    else:
+        read_seconds = 0
+    # Blocks are encoded and written one at a time, by the writer holding the lock
+    write_seconds = output_bytes / (profile["encode_mb_per_second"] * 1024 ** 2)
+    if profile["gathers_output"] and executor == "dask":
+        runtime = read_seconds + compute_seconds + write_seconds
+    else:
+        # Blocks are written while others are read and computed
+        runtime = max(read_seconds + compute_seconds, write_seconds)
+
+    return {
+        "n_pixels": n_pixels,
+        "block_size": block_size,
+        "n_blocks": math.ceil(shape[0] / block_size) * math.ceil(shape[1] / block_size),
+        "n_workers": n_workers,
+        "threads_per_worker": threads_per_worker,
+        "worker_peak_gb": worker_peak / GB,
+        "total_peak_gb": total_peak / GB,
+        "runtime_hours": (runtime + STARTUP_SECONDS[executor]) / 3600,
+        "read_hours": read_seconds / 3600,
+        "compute_hours": compute_seconds / 3600,
+        "write_hours": write_seconds / 3600,
+        "output_gb": output_bytes / GB,
+        "compressed_output_gb": compressed_bytes / GB,
+        "staging_gb": (
+            n_pixels * profile["bytes_per_input_pixel"] / GB
+            if executor == "threads"
+            else 0
+        ),
+    }
+
+
+def instance_family(memory_gb, vcpus):
+    for max_gb_per_vcpu, family in INSTANCE_FAMILIES:
+        if memory_gb / vcpus <= max_gb_per_vcpu:
+            return family
+
+    return INSTANCE_FAMILIES[-1][1]
+
+
+def recommend(profile, shape, executor, block_size, vcpus, memory_gb):
+    """
+    Choose the layout of workers and threads that uses the most vCPUs within
+    memory_gb (or all vCPUs if memory_gb is None), halving the block size if nothing
+    fits. Returns the prediction for that layout, or None.
+    """
+    while block_size >= 64:
+        candidates = []
+        if executor == "dask":
+            layouts = [
+                (vcpus // threads, threads)
+                for threads in THREADS_PER_WORKER_CHOICES
+                if threads <= vcpus
+            ]
+        else:
+            layouts = [(1, vcpus)]
+        for n_workers, threads_per_worker in layouts:
+            plan = predict(
+                profile, shape, executor, block_size, n_workers, threads_per_worker
+            )
+            if memory_gb is None or plan["total_peak_gb"] <= memory_gb * MEMORY_HEADROOM:
+                candidates.append(plan)
+        if candidates:
+            # Most threads, then fewest workers (less per-worker overhead)
+            plan = max(
+                candidates,
+                key=lambda p: (p["n_workers"] * p["threads_per_worker"], -p["n_workers"]),
+            )
+            plan["vcpus"] = vcpus
+            plan["memory_request_gb"] = math.ceil(
+                plan["total_peak_gb"] / MEMORY_HEADROOM
+            )
+            plan["instance_family"] = instance_family(plan["memory_request_gb"], vcpus)
+            return plan
+        logger.info(f"Nothing fits in {memory_gb} GB with {block_size} pixel blocks")
+        block_size //= 2
+
+    return None
+
+
+def log_plan(stage, executor, plan):
+    logger.info(
+        f"{stage} ({executor}): {plan['vcpus']} vCPUs as {plan['n_workers']} workers "
+        f"x {plan['threads_per_worker']} threads, {plan['block_size']} pixel blocks "
+        f"({plan['n_blocks']} blocks)"
+    )
+    logger.info(
+        f"  peak memory {plan['worker_peak_gb']:.1f} GB per worker, "
+        f"{plan['total_peak_gb']:.1f} GB in total - request "
+        f"{plan['memory_request_gb']} GB ({plan['instance_family']} family)"
+    )
+    logger.info(
+        f"  runtime {plan['runtime_hours']:.2f} h "
+        f"({plan['read_hours']:.2f} h reading, {plan['compute_hours']:.2f} h "
+        f"computing, {plan['write_hours']:.2f} h writing), output {plan['output_gb']:.1f} GB "
+        f"uncompressed (~{plan['compressed_output_gb']:.1f} GB compressed)"
+        + (
+            f", {plan['staging_gb']:.1f} GB of staged inputs"
+            if plan["staging_gb"]
+            else ""
+        )
+    )
+
+
+def plan_stage(stage, profile, args):
+    """Predict resources for one stage, log them and return the chosen plan"""
+    import threaded_executor
+
+    executor = args.executor or profile["executors"][0]
+    if executor not in profile["executors"]:
+        executor = profile["executors"][0]
+        logger.info(f"{stage} can't be run with {args.executor}, planning {executor}")
+
+    inputs = dict(profile["inputs"])
+    for item in args.input:
+        name, path = item.split("=", 1)
+        if name in inputs:
+            inputs[name] = path
+    shape, profile["bytes_per_input_pixel"] = stage_shape(profile, inputs)
+
+    block_size = args.block_size
+    if block_size is None:
+        if executor == "gdal":
+            block_size = max(shape)
+        elif executor == "threads":
+            block_size = threaded_executor.DEFAULT_BLOCK_SIZE
+        elif stage == "esa_cci":
+            block_size = auto_block_size(shape)
+        else:
+            block_size = DASK_CHUNK_SIZE
+
+    if args.vcpus is not None:
+        plan = recommend(
+            profile, shape, executor, block_size, args.vcpus, args.memory_gb
+        )
+        if plan is None:
+            logger.error(f"{stage} does not fit in {args.memory_gb} GB")
+            return None
+    else:
+        plan = None
+        for vcpus in VCPU_CHOICES[executor]:
+            candidate = recommend(
+                profile, shape, executor, block_size, vcpus, args.memory_gb
+            )
+            if candidate is None:
+                continue
+            logger.info(
+                f"{stage} on {vcpus:4d} vCPUs: {candidate['runtime_hours']:6.2f} h, "
+                f"{candidate['memory_request_gb']:5d} GB"
+            )
+            if plan is None and candidate["runtime_hours"] <= args.target_hours:
+                plan = candidate
+        if plan is None:
+            logger.error(f"No layout finishes {stage} in {args.target_hours} h")
+            return None
+
+    plan["stage"] = stage
+    plan["executor"] = executor
+    log_plan(stage, executor, plan)
+    if "n_tiles" in profile:
+        plan["array_size"] = profile["n_tiles"]
+        logger.info(f"  per tile, as an array job of {profile['n_tiles']} tiles")
+
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Predict resources needed by the pipeline stages"
+    )
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        metavar="stage",
+        help=f"Stages to plan, of {', '.join(STAGES.keys())} (defaults to all)",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=["dask", "threads", "gdal"],
+        default=None,
+        help="Executor the stages are run with (defaults to the first each supports)",
+    )
+    parser.add_argument(
+        "--input",
+        nargs="+",
+        default=[],
+        metavar="NAME=PATH",
+        help="Paths (or /vsis3/ URLs) of input rasters, replacing the defaults. "
+        "Names are lc_initial, lc_final, trans, crops_initial and crops_final",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=None,
+        help="Block (chunk) size in pixels (defaults to the size each stage uses)",
+    )
+    parser.add_argument(
+        "--vcpus",
+        type=int,
+        default=None,
+        help="vCPUs available (defaults to comparing several instance sizes)",
+    )
+    parser.add_argument("--memory-gb", type=float, default=None)
+    parser.add_argument(
+        "--target-hours",
+        type=float,
+        default=2,
+        help="Without --vcpus, recommend the fewest vCPUs finishing in this time",
+    )
+    parser.add_argument(
+        "--calibration",
+        default=None,
+        help="JSON file written by benchmark.py calibrate",
+    )
+    parser.add_argument("--json", default=None, help="Also write the plans to JSON")
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f"Unknown stage {stage}")
+
+    stages = load_calibration(args.calibration)
+    plans = []
+    for stage in args.stages or list(STAGES.keys()):
+        plan = plan_stage(stage, stages[stage], args)
+        if plan is not None:
+            plans.append(plan)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(plans, f, indent=2)
+        logger.info(f"Wrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Rule tables mapping codes (land cover classes or transition codes) to their meaning,
+as read from ESA_CCI_Natural_Conversion_Coding_v2.xlsx.
+
+A table is converted to a dense lookup array (see kernels.rule_lookup) once per
+process, and kept in a per-process registry. Tasks only carry the name of the table and
+look it up with get(), rather than each carrying the codes and converting them again.
+Tables are added to the registry with register() locally, and on dask workers with
+dask_cluster.register_rule_tables.
+"""
+import kernels
+
+_REGISTRY = {}
+
+
+class RuleTable:
+    """Named table of codes and their meanings"""
+
+    def __init__(self, name, codes, meanings):
+        if len(codes) != len(meanings):
+            raise ValueError(
+                f"Rule table {name} has {len(codes)} codes but {len(meanings)} meanings"
+            )
+        self.name = name
+        self.codes = [int(code) for code in codes]
+        self.meanings = [int(meaning) for meaning in meanings]
+        self._lut = None
+
+    def __getstate__(self):
+        # Send the codes rather than the (larger) lookup array, which is rebuilt once
+        # by the receiving process
+        state = self.__dict__.copy()
+        state["_lut"] = None
+        return state
+
+    def __repr__(self):
+        return f"RuleTable({self.name!r}, {len(self.codes)} codes)"
+
+    @property
+    def lut(self):
+        """Dense lookup array of the meaning of each code"""
+        if self._lut is None:
+            self._lut = kernels.rule_lookup(self.codes, self.meanings)
+        return self._lut
+
+    def apply(self, values):
+        """Meaning of each value of a 2D array"""
+        return kernels.calc_rule_lookup(values, self.lut)
+
+
+def register(table):
+    """Add table to the registry of this process, building its lookup array"""
+    table.lut
+    _REGISTRY[table.name] = table
+
+    return table.name
+
+
+def get(table):
+    """Return a registered table by name (tables themselves are returned as is)"""
+    if isinstance(table, RuleTable):
+        return table
+    try:
+        return _REGISTRY[table]
+    except KeyError:
+        raise KeyError(
+            f"Rule table {table} is not registered in this process. Register it with "
+            "rule_tables.register, or on dask workers with "
+            "dask_cluster.register_rule_tables"
+        ) from None
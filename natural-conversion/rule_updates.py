@@ -0,0 +1,378 @@
+"""
+Targeted recomputation of the outputs after edits to the rule tables of
+ESA_CCI_Natural_Conversion_Coding_v2.xlsx.
+
+When the threads executor computes transitions it also writes a presence index,
+recording which transition codes (initial class * 1000 + final class) occur in each
+block: one bit for each code of the transition_meaning table (1444 for the 38 classes
+of the legend) and a last bit for any other code, packed with numpy.packbits. The
+index is stored next to the transitions as a compressed numpy archive.
+
+When the coding is revised, changed_codes diffs the old and new tables. A transition
+whose meaning changed only affects the blocks where it occurs, and an initial class
+whose meaning changed only affects the blocks with a transition from that class, so
+the index gives the blocks to recompute. esa_cci_transitions.py and
+natural_conversion.py --changed-rules recompute those blocks and patch them into the
+existing outputs. Blocks missing from the index are always treated as affected.
+
+Examples:
+
+    python rule_updates.py index --in-file /data/<transitions>.tif
+    python rule_updates.py diff --old-coding old.xlsx --index /data/<index>.npz
+"""
+import argparse
+import logging
+import os
+import threading
+from pathlib import Path
+
+import kernels
+import numpy as np
+import rule_tables
+import threaded_executor
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_VERSION = 1
+
+# Coding of the current run, as read by esa_cci_transitions.py and natural_conversion.py
+CODING_FILE = "ESA_CCI_Natural_Conversion_Coding_v2.xlsx"
+
+
+class PresenceIndex:
+    """
+    Which transition codes occur in each block of a region (row_off, col_off, height,
+    width) of the transitions, split in blocks of block_size. codes are the codes with
+    a bit of their own.
+    """
+
+    def __init__(self, codes, region, block_size):
+        self.codes = np.unique(np.asarray(codes, dtype=np.int64))
+        self.region = tuple(int(n) for n in region)
+        self.block_size = int(block_size)
+        self.blocks = {}
+        self._positions = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def n_bits(self):
+        return self.codes.size + 1
+
+    @property
+    def positions(self):
+        """Dense array of the bit of each code, with the last bit for other codes"""
+        if self._positions is None:
+            positions = np.full(
+                int(self.codes.max(initial=-1)) + 1, self.codes.size, dtype=np.int32
+            )
+            positions[self.codes] = np.arange(self.codes.size, dtype=np.int32)
+            self._positions = positions
+
+        return self._positions
+
+    def presence(self, trans):
+        """Which bits occur in a 2D array of transition codes"""
+        return kernels.calc_code_presence(trans, self.positions, self.n_bits)
+
+    def set(self, window, present):
+        with self._lock:
+            self.blocks[tuple(int(n) for n in window)] = np.packbits(present)
+
+    def windows(self):
+        """Windows of all the blocks of the region, in row-major order"""
+        _, _, height, width = self.region
+
+        return list(threaded_executor.block_windows(height, width, self.block_size))
+
+    def bits(self, codes, other=False):
+        """Packed bits of codes (codes without a bit of their own set the last bit)"""
+        codes = np.asarray(codes, dtype=np.int64)
+        present = np.zeros(self.n_bits, dtype=bool)
+        known = np.isin(codes, self.codes)
+        present[np.searchsorted(self.codes, codes[known])] = True
+        present[-1] = other or not known.all()
+
+        return np.packbits(present)
+
+    def blocks_with(self, codes, other=False):
+        """
+        Windows of the blocks where any of codes (or, with other, any code without a
+        bit of its own) occur, and of the blocks missing from the index
+        """
+        mask = self.bits(codes, other)
+        affected = []
+        for window in self.windows():
+            bits = self.blocks.get(window)
+            if bits is None or (bits & mask).any():
+                affected.append(window)
+
+        return affected
+
+    def save(self, path):
+        path = Path(path)
+        windows = sorted(self.blocks)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                version=PRESENCE_VERSION,
+                codes=self.codes,
+                region=np.array(self.region, dtype=np.int64),
+                block_size=self.block_size,
+                windows=np.array(windows, dtype=np.int64).reshape(-1, 4),
+                bits=np.array(
+                    [self.blocks[window] for window in windows], dtype=np.uint8
+                ).reshape(len(windows), -(-self.n_bits // 8)),
+            )
+        tmp_path.replace(path)
+        logger.info(f"Saved transition codes of {len(windows)} blocks to {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != PRESENCE_VERSION:
+                raise ValueError(
+                    f"{path} has presence index version {int(data['version'])}, "
+                    f"expected {PRESENCE_VERSION}"
+                )
+            index = cls(data["codes"], data["region"], int(data["block_size"]))
+            for window, bits in zip(data["windows"], data["bits"]):
+                index.blocks[tuple(int(n) for n in window)] = bits
+
+        return index
+
+    @classmethod
+    def open(cls, path, codes, region, block_size):
+        """
+        Load the index at path if it has the same codes and blocks (so that it can be
+        updated by an incremental run), or return an empty one
+        """
+        index = cls(codes, region, block_size)
+        if Path(path).exists():
+            previous = cls.load(path)
+            if (
+                np.array_equal(previous.codes, index.codes)
+                and previous.region == index.region
+                and previous.block_size == index.block_size
+            ):
+                return previous
+            logger.warning(
+                f"Codes or blocks have changed since {path} was written - starting a "
+                "new presence index"
+            )
+
+        return index
+
+
+def _effective_meanings(table):
+    # As in kernels.rule_lookup: later duplicates win, and no data has no meaning
+    meanings = dict(zip(table.codes, table.meanings))
+    meanings.pop(kernels.NODATA_VALUE, None)
+
+    return meanings
+
+
+def changed_codes(old, new):
+    """Sorted codes whose meaning differs between two RuleTables"""
+    old_meanings = _effective_meanings(old)
+    new_meanings = _effective_meanings(new)
+
+    return sorted(
+        code
+        for code in set(old_meanings) | set(new_meanings)
+        if old_meanings.get(code, 0) != new_meanings.get(code, 0)
+    )
+
+
+def affected_blocks(index, changed_transitions=(), changed_initial=()):
+    """
+    Windows of the index blocks affected by changes to the meaning of the transition
+    codes changed_transitions, or of the initial classes changed_initial
+    """
+    changed_initial = set(changed_initial)
+    codes = set(changed_transitions) | {
+        int(code) for code in index.codes if code // 1000 in changed_initial
+    }
+    # Transitions from a changed class without a bit of their own set the last bit
+    windows = index.blocks_with(sorted(codes), other=bool(changed_initial))
+    logger.info(
+        f"{len(windows)} of {len(index.windows())} blocks contain one of "
+        f"{len(codes)} transitions whose meaning changed"
+    )
+
+    return windows
+
+
+def overlapping(index, windows, offset=(0, 0)):
+    """
+    Return a function of the window of a block of a run, true if the block overlaps
+    any of windows (blocks of the index). offset is the (row_off, col_off) of the
+    region of the run in the raster.
+    """
+    block_size = index.block_size
+    cells = {
+        (row_off // block_size, col_off // block_size)
+        for row_off, col_off, _, _ in windows
+    }
+    row_shift = offset[0] - index.region[0]
+    col_shift = offset[1] - index.region[1]
+
+    def select(window):
+        row_off, col_off, nrows, ncols = window
+        top = row_off + row_shift
+        left = col_off + col_shift
+        return any(
+            (cell_row, cell_col) in cells
+            for cell_row in range(
+                max(top, 0) // block_size, -(-(top + nrows) // block_size)
+            )
+            for cell_col in range(
+                max(left, 0) // block_size, -(-(left + ncols) // block_size)
+            )
+        )
+
+    return select
+
+
+def read_coding(xl_file):
+    """
+    Return the transition_meaning (Recoding sheet) and initial_natural (Legend sheet)
+    RuleTables of a version of the coding, as read by esa_cci_transitions.py and
+    natural_conversion.py
+    """
+    import esa_cci_transitions
+    import natural_conversion
+
+    trans_codes, trans_meanings = esa_cci_transitions.get_trans_codes(
+        xl_file,
+        header_column=2,
+        first_data_column=4,
+        last_data_column=41,
+        first_data_row=4,
+        last_data_row=41,
+    )
+    initial_codes, initial_meanings = natural_conversion.get_trans_codes(
+        xl_file,
+        initial_class_column=1,
+        final_class_column=3,
+        first_data_row=3,
+        last_data_row=40,
+    )
+
+    return (
+        rule_tables.RuleTable("transition_meaning", trans_codes, trans_meanings),
+        rule_tables.RuleTable("initial_natural", initial_codes, initial_meanings),
+    )
+
+
+def build_index(trans_file, codes, block_size, n_threads=None):
+    """
+    Build the presence index of codes from band 1 (transition codes) of an existing
+    transitions raster
+    """
+    import rasterio
+
+    with rasterio.open(trans_file) as ds:
+        region = (0, 0, ds.height, ds.width)
+    index = PresenceIndex(codes, region, block_size)
+    n_threads = n_threads or os.cpu_count()
+    inputs = threaded_executor.open_inputs(
+        {"trans": (trans_file, 1)},
+        None,
+        region,
+        input_mode="prefetch",
+        n_threads=n_threads,
+    )
+
+    def block_func(arrays, block_window):
+        return {"present": index.presence(arrays["trans"])}
+
+    def write_block(block_window, results):
+        index.set(block_window, results["present"])
+
+    threaded_executor.run_prefetched(
+        block_func,
+        inputs,
+        index.windows(),
+        write_block,
+        n_threads=n_threads,
+        total=len(index.windows()),
+    )
+
+    return index
+
+
+def main():
+    import uploads
+
+    parser = argparse.ArgumentParser(
+        description="Find the blocks affected by edits to the coding rules"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser(
+        "index", help="Build the presence index of an existing transitions raster"
+    )
+    index_parser.add_argument("--in-file", type=Path, required=True)
+    index_parser.add_argument("--coding", default=CODING_FILE)
+    index_parser.add_argument(
+        "--block-size", type=int, default=threaded_executor.DEFAULT_BLOCK_SIZE
+    )
+    index_parser.add_argument("--n-threads", type=int, default=None)
+    index_parser.add_argument(
+        "--out",
+        type=Path,
+        default=None,
+        help="Defaults to the transitions file name ending in _presence.npz",
+    )
+    index_parser.add_argument(
+        "--upload",
+        action="store_true",
+        help="Upload the index next to the transitions, for --changed-rules",
+    )
+
+    diff_parser = subparsers.add_parser(
+        "diff", help="List the blocks affected by a revision of the coding"
+    )
+    diff_parser.add_argument("--old-coding", required=True)
+    diff_parser.add_argument("--coding", default=CODING_FILE)
+    diff_parser.add_argument("--index", type=Path, required=True)
+
+    args = parser.parse_args()
+
+    if args.command == "index":
+        transition_rules, _ = read_coding(args.coding)
+        index = build_index(
+            args.in_file, transition_rules.codes, args.block_size, args.n_threads
+        )
+        out = args.out or args.in_file.with_name(
+            f"{args.in_file.stem}_presence.npz"
+        )
+        index.save(out)
+        if args.upload:
+            import esa_cci_transitions
+
+            with uploads.UploadPipeline(
+                esa_cci_transitions.OUT_S3_BUCKET, esa_cci_transitions.OUT_S3_PREFIX
+            ) as uploader:
+                uploader.submit(out)
+        return
+
+    old_transitions, old_initial = read_coding(args.old_coding)
+    new_transitions, new_initial = read_coding(args.coding)
+    changed_transitions = changed_codes(old_transitions, new_transitions)
+    changed_initial = changed_codes(old_initial, new_initial)
+    logger.info(f"Transitions with a new meaning: {changed_transitions}")
+    logger.info(f"Initial classes with a new meaning: {changed_initial}")
+    index = PresenceIndex.load(args.index)
+    affected_blocks(index, changed_transitions, changed_initial)
+
+
+if __name__ == "__main__":
+    main()
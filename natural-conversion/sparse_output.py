@@ -0,0 +1,347 @@
+"""
+Sparse output of the natural conversion transition layer.
+
+Pixels with a nonzero transition code (1-6, see kernels.calc_natural_conversion) are a
+small fraction of the global grid, so instead of dense global layers they can be
+stored as events: the row, column, code and area (in hectares) of each of those
+pixels. Events are grouped into square tiles of the grid, and each tile is written as
+a compressed numpy archive (.npz) with one array per column, sorted by row and column.
+Rows and columns are stored relative to the tile. Tiles without events are not
+written.
+
+An index (index.json) lists the shape, transform and tile size of the grid, and for
+each tile its file, offset, number of events and area by code. Totals over whole tiles
+are read from the index, so filtering and aggregating the events costs time in
+proportion to the number of events rather than to the area of the grid.
+
+Windows are (row_off, col_off, height, width) in pixels of the grid, as in
+threaded_executor.
+"""
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+from kernels import N_TRANSITION_CODES
+
+logger = logging.getLogger(__name__)
+
+# Tile size (in pixels) of the sparse output. 3600 pixels is 10 degrees of the 300m
+# grid, so the globe is 18 x 36 tiles (as for the cropland tiles)
+DEFAULT_TILE_SIZE = 3600
+
+INDEX_FILE = "index.json"
+FORMAT_VERSION = 1
+
+# Data types of the columns of the tile files. Rows and columns are relative to the
+# tile, so tile sizes are limited to the uint16 range
+SPARSE_COLUMNS = {
+    "row": "uint16",
+    "col": "uint16",
+    "code": "int8",
+    "area": "float64",
+}
+
+
+def tile_name(tile_row, tile_col):
+    return f"tile_{tile_row:03d}_{tile_col:03d}.npz"
+
+
+def block_events(meaning, cell_areas, row_off, col_off):
+    """
+    Return the events (as a dict of columns, with rows and columns on the grid) of the
+    pixels with a nonzero transition code in a block at row_off, col_off
+    """
+    rows, cols = np.nonzero(meaning)
+
+    return {
+        "row": rows.astype(np.int64) + row_off,
+        "col": cols.astype(np.int64) + col_off,
+        "code": meaning[rows, cols].astype(np.int8, copy=False),
+        "area": cell_areas[rows, cols].astype(np.float64, copy=False),
+    }
+
+
+def delayed_events(ds):
+    """
+    Return the windows of the chunks of a dataset with transition and area_pixel
+    variables (as written by compute_natural_conversion), and a dask.delayed
+    block_events for each
+    """
+    import dask
+
+    meaning = ds["transition"].data.to_delayed()
+    cell_areas = ds["area_pixel"].data.to_delayed()
+    row_offsets = np.cumsum((0,) + ds.chunks["y"])
+    col_offsets = np.cumsum((0,) + ds.chunks["x"])
+    windows = []
+    tasks = []
+    for i in range(meaning.shape[0]):
+        for j in range(meaning.shape[1]):
+            row_off = int(row_offsets[i])
+            col_off = int(col_offsets[j])
+            windows.append(
+                (
+                    row_off,
+                    col_off,
+                    int(row_offsets[i + 1]) - row_off,
+                    int(col_offsets[j + 1]) - col_off,
+                )
+            )
+            tasks.append(
+                dask.delayed(block_events)(
+                    meaning[i, j], cell_areas[i, j], row_off, col_off
+                )
+            )
+
+    return windows, tasks
+
+
+def _overlapping_tiles(window, tile_size, height, width):
+    """Yield (tile_row, tile_col) and the window of each tile that window overlaps"""
+    row_off, col_off, nrows, ncols = window
+    for tile_row in range(row_off // tile_size, -(-(row_off + nrows) // tile_size)):
+        for tile_col in range(col_off // tile_size, -(-(col_off + ncols) // tile_size)):
+            tile_row_off = tile_row * tile_size
+            tile_col_off = tile_col * tile_size
+            yield (tile_row, tile_col), (
+                tile_row_off,
+                tile_col_off,
+                min(tile_size, height - tile_row_off),
+                min(tile_size, width - tile_col_off),
+            )
+
+
+def _in_window(events, window):
+    """Boolean mask of the events within window"""
+    row_off, col_off, nrows, ncols = window
+
+    return (
+        (events["row"] >= row_off)
+        & (events["row"] < row_off + nrows)
+        & (events["col"] >= col_off)
+        & (events["col"] < col_off + ncols)
+    )
+
+
+def _intersection(a, b):
+    """Number of pixels in both windows a and b"""
+    nrows = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    ncols = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+
+    return max(0, nrows) * max(0, ncols)
+
+
+class SparseWriter:
+    """
+    Collect the events of blocks (in any order) into tiles, writing each tile as soon
+    as every pixel of it has been covered by a block, and the index on close.
+    on_tile(path) is called with each file written, for example to queue it for
+    upload. Not thread safe - call add_events from a single writer thread.
+    """
+
+    def __init__(
+        self,
+        out_dir,
+        height,
+        width,
+        transform,
+        tile_size=DEFAULT_TILE_SIZE,
+        on_tile=None,
+    ):
+        if tile_size > np.iinfo(SPARSE_COLUMNS["row"]).max + 1:
+            raise ValueError(f"tile_size must be at most 65536, not {tile_size}")
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.height = height
+        self.width = width
+        self.transform = transform
+        self.tile_size = tile_size
+        self.on_tile = on_tile
+        self.tiles = {}
+        self._pending = {}
+        self._windows = {}
+        self._covered = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+    def add_events(self, window, events):
+        """Add the events of the block covering window, as returned by block_events"""
+        for tile, tile_window in _overlapping_tiles(
+            window, self.tile_size, self.height, self.width
+        ):
+            inside = _in_window(events, tile_window)
+            if inside.any():
+                self._pending.setdefault(tile, []).append(
+                    {name: column[inside] for name, column in events.items()}
+                )
+                self._windows[tile] = tile_window
+            self._covered[tile] = self._covered.get(tile, 0) + _intersection(
+                window, tile_window
+            )
+            if self._covered[tile] == tile_window[2] * tile_window[3]:
+                self._write_tile(tile)
+
+    def _write_tile(self, tile):
+        parts = self._pending.pop(tile, [])
+        if not parts:
+            return
+        tile_row_off, tile_col_off, tile_height, tile_width = self._windows.pop(tile)
+        events = {
+            name: np.concatenate([part[name] for part in parts]) for name in parts[0]
+        }
+        order = np.lexsort((events["col"], events["row"]))
+        columns = {
+            "row": events["row"][order] - tile_row_off,
+            "col": events["col"][order] - tile_col_off,
+            "code": events["code"][order],
+            "area": events["area"][order],
+        }
+        out_file = self.out_dir / tile_name(*tile)
+        np.savez_compressed(
+            out_file,
+            **{
+                name: column.astype(SPARSE_COLUMNS[name])
+                for name, column in columns.items()
+            },
+        )
+        area_by_code = np.bincount(
+            columns["code"], weights=columns["area"], minlength=N_TRANSITION_CODES
+        )
+        self.tiles[tile] = {
+            "file": out_file.name,
+            "tile_row": tile[0],
+            "tile_col": tile[1],
+            "row_off": tile_row_off,
+            "col_off": tile_col_off,
+            "height": tile_height,
+            "width": tile_width,
+            "n_events": int(len(order)),
+            "area_by_code": [float(area) for area in area_by_code],
+        }
+        if self.on_tile is not None:
+            self.on_tile(out_file)
+
+    def close(self):
+        """Write any tiles not yet written, then the index. Returns the index path."""
+        for tile in list(self._pending):
+            self._write_tile(tile)
+
+        index_file = self.out_dir / INDEX_FILE
+        with open(index_file, "w") as f:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "height": self.height,
+                    "width": self.width,
+                    "transform": list(self.transform)[:6],
+                    "crs": "EPSG:4326",
+                    "tile_size": self.tile_size,
+                    "columns": SPARSE_COLUMNS,
+                    "tiles": [self.tiles[tile] for tile in sorted(self.tiles)],
+                },
+                f,
+                indent=1,
+            )
+        n_events = sum(tile["n_events"] for tile in self.tiles.values())
+        logger.info(
+            f"Wrote {n_events} events in {len(self.tiles)} tiles to {self.out_dir}"
+        )
+        if self.on_tile is not None:
+            self.on_tile(index_file)
+
+        return index_file
+
+
+def read_index(path):
+    """Read the index of the sparse output in directory path"""
+    with open(Path(path) / INDEX_FILE) as f:
+        index = json.load(f)
+    if index["version"] != FORMAT_VERSION:
+        raise ValueError(
+            f"{path} has sparse format version {index['version']}, expected "
+            f"{FORMAT_VERSION}"
+        )
+
+    return index
+
+
+def read_tile(path, tile):
+    """
+    Read the events of a tile (an entry of the index), with rows and columns on the
+    grid
+    """
+    with np.load(Path(path) / tile["file"]) as data:
+        events = {name: data[name] for name in SPARSE_COLUMNS}
+    events["row"] = events["row"].astype(np.int64) + tile["row_off"]
+    events["col"] = events["col"].astype(np.int64) + tile["col_off"]
+
+    return events
+
+
+def _tiles_in_window(index, window):
+    """Yield each tile of the index overlapping window, and whether it is inside it"""
+    for tile in index["tiles"]:
+        tile_window = (tile["row_off"], tile["col_off"], tile["height"], tile["width"])
+        overlap = _intersection(window, tile_window)
+        if overlap:
+            yield tile, overlap == tile["height"] * tile["width"]
+
+
+def iter_events(path, window=None):
+    """Yield the events of each tile of the sparse output in path, within window"""
+    index = read_index(path)
+    window = window or (0, 0, index["height"], index["width"])
+    for tile, inside in _tiles_in_window(index, window):
+        events = read_tile(path, tile)
+        if not inside:
+            keep = _in_window(events, window)
+            events = {name: column[keep] for name, column in events.items()}
+        yield events
+
+
+def read_window(path, window):
+    """
+    Rehydrate the transition codes and event areas of window as dense arrays. Pixels
+    without events have code 0 and area 0, so the area of codes 1-3 is the
+    area_natural_conversion of the dense outputs.
+    """
+    row_off, col_off, nrows, ncols = window
+    codes = np.zeros((nrows, ncols), dtype=SPARSE_COLUMNS["code"])
+    areas = np.zeros((nrows, ncols), dtype=SPARSE_COLUMNS["area"])
+    for events in iter_events(path, window):
+        rows = events["row"] - row_off
+        cols = events["col"] - col_off
+        codes[rows, cols] = events["code"]
+        areas[rows, cols] = events["area"]
+
+    return codes, areas
+
+
+def totals(path, window=None):
+    """
+    Return the area (in hectares) of each transition code within window (the whole
+    grid by default), indexed by code. Tiles entirely inside window are summed from the
+    index without reading them.
+    """
+    index = read_index(path)
+    window = window or (0, 0, index["height"], index["width"])
+    areas = np.zeros(N_TRANSITION_CODES, dtype=np.float64)
+    for tile, inside in _tiles_in_window(index, window):
+        if inside:
+            areas += tile["area_by_code"]
+            continue
+        events = read_tile(path, tile)
+        keep = _in_window(events, window)
+        areas += np.bincount(
+            events["code"][keep],
+            weights=events["area"][keep],
+            minlength=N_TRANSITION_CODES,
+        )
+
+    return areas
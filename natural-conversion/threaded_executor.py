@@ -0,0 +1,1054 @@
+"""
+Dask-free block executor for single-node runs.
+
+Inputs are staged once to memory-mapped ``.npy`` arrays, which every thread (and the
+OS page cache) shares without pickling. A thread pool walks the block grid calling
+the nogil numba kernels directly, and finished blocks are streamed to a single writer
+thread that holds the output GeoTIFF handles.
+
+Instead of staging, inputs can also be read block by block from the rasters by a
+raster_reader.PrefetchReader, which decodes the next blocks in the background while
+the current ones are computed.
+
+With a memory budget, the footprint of a block is measured before the run, and the
+block size and number of threads are chosen so that the blocks in flight fit in the
+budget. Finished blocks that do not fit while they wait for the writer are spilled
+to disk rather than held in memory.
+"""
+import logging
+import os
+import queue
+import threading
+import uuid
+from math import gcd
+from pathlib import Path
+
+import block_manifest
+import kernels
+import numpy as np
+import raster_reader
+import sparse_output
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 512
+STAGING_STRIP_ROWS = 2048
+
+NATURAL_CONVERSION_OUTPUTS = {
+    "transition": "int8",
+    "area_pixel": "float64",
+    "area_natural_conversion": "float64",
+}
+
+# Bands of the GeoTIFF written for each aggregation factor
+AGGREGATE_BANDS = ["area_natural_conversion", "area_pixel"] + [
+    f"transition_count_{code}"
+    for code in range(kernels.N_TRANSITION_CODES)
+]
+
+# GeoTIFF tiles must be a multiple of 16 pixels
+TIFF_TILE_MULTIPLE = 16
+
+# How inputs are read: staged to memory-mapped arrays before the run, or read block
+# by block from the rasters ahead of use
+INPUT_MODES = ["memmap", "prefetch"]
+
+# Smallest block size used to fit a memory budget
+MIN_BLOCK_SIZE = 128
+
+# Factor applied to the measured block footprint, for allocations that are not traced
+# (such as arrays allocated inside the numba kernels) and variation between blocks
+FOOTPRINT_MARGIN = 1.25
+
+# Size (in pixels) of the block run to compile the kernels before measuring
+WARMUP_BLOCK_SIZE = 16
+
+_DONE = object()
+
+
+def block_windows(height, width, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield (row_off, col_off, nrows, ncols) for each block, in row-major order"""
+    for row_off in range(0, height, block_size):
+        nrows = min(block_size, height - row_off)
+        for col_off in range(0, width, block_size):
+            ncols = min(block_size, width - col_off)
+            yield row_off, col_off, nrows, ncols
+
+
+def n_blocks(height, width, block_size=DEFAULT_BLOCK_SIZE):
+    return -(-height // block_size) * -(-width // block_size)
+
+
+def aligned_block_size(block_size, factors):
+    """
+    Round block_size up to a multiple of every aggregation factor (and of the GeoTIFF
+    tile multiple) so that aggregated cells never span blocks
+    """
+    multiple = TIFF_TILE_MULTIPLE
+    for factor in factors:
+        multiple = multiple * factor // gcd(multiple, factor)
+
+    return -(-block_size // multiple) * multiple
+
+
+def stage_to_memmap(in_file, band, out_file, window=None):
+    """
+    Copy one band of a raster to a memory-mapped .npy file and return it read-only
+
+    window: optional (row_off, col_off, nrows, ncols) subset of the raster to stage
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    out_file = Path(out_file)
+
+    with rasterio.open(in_file) as ds:
+        if window is None:
+            window = (0, 0, ds.height, ds.width)
+        row_off, col_off, nrows, ncols = window
+
+        if out_file.exists() and out_file.stat().st_mtime >= os.stat(in_file).st_mtime:
+            staged = np.load(out_file, mmap_mode="r")
+            if staged.shape == (nrows, ncols) and staged.dtype == ds.dtypes[band - 1]:
+                logger.info(f"Reusing staged {out_file}")
+                return staged
+
+        logger.info(f"Staging band {band} of {in_file} to {out_file}")
+        out = np.lib.format.open_memmap(
+            out_file, mode="w+", dtype=ds.dtypes[band - 1], shape=(nrows, ncols)
+        )
+        for strip_off in range(0, nrows, STAGING_STRIP_ROWS):
+            strip_rows = min(STAGING_STRIP_ROWS, nrows - strip_off)
+            out[strip_off : strip_off + strip_rows] = ds.read(
+                band, window=Window(col_off, row_off + strip_off, ncols, strip_rows)
+            )
+        out.flush()
+        del out
+
+    return np.load(out_file, mmap_mode="r")
+
+
+def _nbytes(value):
+    """Total size of the arrays in a (possibly nested) dict of block outputs"""
+    if isinstance(value, dict):
+        return sum(_nbytes(item) for item in value.values())
+
+    return getattr(value, "nbytes", 0)
+
+
+def _read_block(inputs, window):
+    """Return the input blocks of window, from arrays or a reader"""
+    if isinstance(inputs, raster_reader.PrefetchReader):
+        return inputs.read(window)
+    row_off, col_off, nrows, ncols = window
+
+    return {
+        name: np.ascontiguousarray(
+            array[row_off : row_off + nrows, col_off : col_off + ncols]
+        )
+        for name, array in inputs.items()
+    }
+
+
+class _Spilled:
+    """Placeholder for block outputs that were written to a spill file"""
+
+    def __init__(self, path, names):
+        self.path = path
+        self.names = names
+
+
+class MemoryBudget:
+    """
+    Bytes of memory available to the blocks in flight in run_blocks
+
+    Each block reserves its working footprint while it is computed, and then the size
+    of its outputs while they wait to be written. Outputs that do not fit are spilled
+    to spill_dir, and read back by the writer. The footprints per pixel are set by
+    measure. With prefetched inputs, the input blocks buffered by the PrefetchReader
+    are set aside from the budget by fit (prefetch_bytes).
+    """
+
+    def __init__(self, limit, spill_dir):
+        self.limit = int(limit)
+        self.spill_dir = Path(spill_dir)
+        self.working_per_pixel = None
+        self.result_per_pixel = None
+        self.input_per_pixel = None
+        self.prefetch_bytes = 0
+        self.used = 0
+        self.n_spilled = 0
+        self._cond = threading.Condition()
+
+    def measure(self, block_func, inputs, window):
+        """
+        Run block_func on the block at window, and set the working and output
+        footprints per pixel from it. The working footprint covers the input blocks and
+        the peak of the allocations traced while it runs (or its outputs if larger).
+        """
+        import tracemalloc
+
+        # Compile (or load) the kernels first, so compilation is not measured
+        row_off, col_off, nrows, ncols = window
+        warmup = (
+            row_off,
+            col_off,
+            min(WARMUP_BLOCK_SIZE, nrows),
+            min(WARMUP_BLOCK_SIZE, ncols),
+        )
+        block_func(_read_block(inputs, warmup), warmup)
+
+        arrays = _read_block(inputs, window)
+        tracemalloc.start()
+        try:
+            outputs = block_func(arrays, window)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result_bytes = _nbytes(outputs)
+        n_pixels = nrows * ncols
+        self.working_per_pixel = (
+            FOOTPRINT_MARGIN * (_nbytes(arrays) + max(peak, result_bytes)) / n_pixels
+        )
+        self.result_per_pixel = FOOTPRINT_MARGIN * result_bytes / n_pixels
+        self.input_per_pixel = FOOTPRINT_MARGIN * _nbytes(arrays) / n_pixels
+        logger.info(
+            f"Measured {self.working_per_pixel:.1f} bytes per pixel while computing a "
+            f"block, and {self.result_per_pixel:.1f} bytes per pixel of outputs"
+        )
+
+    def block_bytes(self, window):
+        return int(self.working_per_pixel * window[2] * window[3])
+
+    def fit(
+        self, block_size, n_threads, multiple=TIFF_TILE_MULTIPLE, io_threads=None
+    ):
+        """
+        Return the block size (a multiple of multiple) and number of threads for
+        which n_threads blocks being computed, and as many finished blocks, fit in the
+        budget. With io_threads (for prefetched inputs), the input blocks buffered by
+        the PrefetchReader (see raster_reader.prefetch_depth) must fit too, and are
+        set aside from the budget. The block size is halved first, down to
+        MIN_BLOCK_SIZE, and then fewer threads are used.
+        """
+        per_pixel = self.working_per_pixel + self.result_per_pixel
+        # Input blocks buffered for each thread, and read ahead of them
+        if io_threads:
+            per_thread_input = self.input_per_pixel
+            ahead_input = (
+                raster_reader.prefetch_depth(0, io_threads) * self.input_per_pixel
+            )
+        else:
+            per_thread_input = ahead_input = 0
+
+        def n_bytes(block_size, n_threads):
+            return (
+                n_threads * (per_pixel + per_thread_input) + ahead_input
+            ) * block_size ** 2
+
+        min_block_size = -(-max(MIN_BLOCK_SIZE, multiple) // multiple) * multiple
+        while (
+            n_bytes(block_size, n_threads) > self.limit
+            and block_size > min_block_size
+        ):
+            block_size = max(
+                min_block_size, -(-(block_size // 2) // multiple) * multiple
+            )
+        fitted_threads = min(
+            n_threads,
+            int(
+                (self.limit / block_size ** 2 - ahead_input)
+                // (per_pixel + per_thread_input)
+            ),
+        )
+        if fitted_threads < 1:
+            raise ValueError(
+                f"A memory budget of {self.limit / 1024 ** 3:.2f} GB is too small for "
+                f"one block of {block_size} x {block_size} pixels"
+            )
+        logger.info(
+            f"Using blocks of {block_size} pixels and {fitted_threads} threads to stay "
+            f"within a memory budget of {self.limit / 1024 ** 3:.2f} GB"
+        )
+        if io_threads:
+            self.prefetch_bytes = int(
+                (fitted_threads * per_thread_input + ahead_input) * block_size ** 2
+            )
+            logger.info(
+                f"Setting aside {self.prefetch_bytes / 1024 ** 3:.2f} GB of the budget "
+                "for prefetched input blocks"
+            )
+
+        return block_size, fitted_threads
+
+    def reserve(self, n_bytes):
+        """
+        Wait until n_bytes fit in the budget, and reserve them. A block larger than
+        the budget runs once nothing else is reserved.
+        """
+        with self._cond:
+            while self.used and self.used + n_bytes > self.limit - self.prefetch_bytes:
+                self._cond.wait()
+            self.used += n_bytes
+
+    def try_reserve(self, n_bytes):
+        """Reserve n_bytes if they fit in the budget now, returning whether they did"""
+        with self._cond:
+            if self.used + n_bytes > self.limit - self.prefetch_bytes:
+                return False
+            self.used += n_bytes
+            return True
+
+    def release(self, n_bytes):
+        with self._cond:
+            self.used -= n_bytes
+            self._cond.notify_all()
+
+    def spill(self, outputs):
+        """Write block outputs to an uncompressed spill file"""
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        path = self.spill_dir / f"{uuid.uuid4().hex}.npz"
+        flat = {}
+        names = {}
+        for name, value in outputs.items():
+            if isinstance(value, dict):
+                names[name] = list(value)
+                for key, item in value.items():
+                    flat[f"{name}.{key}"] = item
+            else:
+                names[name] = None
+                flat[str(name)] = value
+        np.savez(path, **flat)
+        with self._cond:
+            self.n_spilled += 1
+
+        return _Spilled(path, names)
+
+    def load(self, spilled):
+        """Read back and delete a spill file"""
+        outputs = {}
+        with np.load(spilled.path) as data:
+            for name, keys in spilled.names.items():
+                if keys is None:
+                    outputs[name] = data[str(name)]
+                else:
+                    outputs[name] = {key: data[f"{name}.{key}"] for key in keys}
+        spilled.path.unlink()
+
+        return outputs
+
+
+def plan_blocks(
+    memory_budget,
+    spill_dir,
+    block_func,
+    inputs,
+    height,
+    width,
+    block_size,
+    n_threads,
+    multiple=TIFF_TILE_MULTIPLE,
+):
+    """
+    Measure block_func on a block from the middle of the inputs and return a
+    MemoryBudget of memory_budget bytes, with the block size and number of threads
+    that fit in it. For a PrefetchReader, the blocks it buffers are counted, and its
+    depth is set for the number of threads.
+    """
+    budget = MemoryBudget(memory_budget, spill_dir)
+    row_off = (height // 2) // block_size * block_size
+    col_off = (width // 2) // block_size * block_size
+    budget.measure(
+        block_func,
+        inputs,
+        (
+            row_off,
+            col_off,
+            min(block_size, height - row_off),
+            min(block_size, width - col_off),
+        ),
+    )
+    prefetch = isinstance(inputs, raster_reader.PrefetchReader)
+    block_size, n_threads = budget.fit(
+        block_size,
+        n_threads,
+        multiple,
+        io_threads=inputs.n_threads if prefetch else None,
+    )
+    if prefetch:
+        inputs.depth = raster_reader.prefetch_depth(n_threads, inputs.n_threads)
+
+    return budget, block_size, n_threads
+
+
+def run_blocks(
+    block_func,
+    inputs,
+    windows,
+    write_block,
+    n_threads=None,
+    total=None,
+    budget=None,
+):
+    """
+    Apply block_func to every window of the input arrays using a thread pool
+
+    block_func(arrays, window) is called with a dict of contiguous input blocks and
+    must return a dict of output blocks, or None if the block does not need to be
+    written. write_block(window, outputs) is always called from the calling thread, in
+    completion order, so it can hold thread-unsafe handles. Returns the number of
+    blocks written.
+
+    With a MemoryBudget, blocks only start once their footprint fits in it, and
+    finished blocks whose outputs do not fit are spilled until they are written.
+    Otherwise at most 2 * n_threads finished blocks wait for the writer.
+    """
+    n_threads = n_threads or os.cpu_count()
+    # With a budget, waiting outputs are limited by it (and the rest are spilled)
+    results = queue.Queue(maxsize=0 if budget is not None else 2 * n_threads)
+    window_iter = iter(windows)
+    window_lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker():
+        try:
+            while not stop.is_set():
+                with window_lock:
+                    window = next(window_iter, None)
+                if window is None:
+                    return
+                if budget is None:
+                    results.put(
+                        (window, block_func(_read_block(inputs, window), window), 0)
+                    )
+                    continue
+                working = budget.block_bytes(window)
+                budget.reserve(working)
+                try:
+                    outputs = block_func(_read_block(inputs, window), window)
+                    result_bytes = _nbytes(outputs)
+                    if outputs is not None and not budget.try_reserve(result_bytes):
+                        outputs = budget.spill(outputs)
+                        result_bytes = 0
+                finally:
+                    budget.release(working)
+                results.put((window, outputs, result_bytes))
+        except BaseException as e:
+            results.put((None, e, 0))
+        finally:
+            results.put(_DONE)
+
+    threads = [
+        threading.Thread(target=worker, name=f"block-worker-{n}", daemon=True)
+        for n in range(n_threads)
+    ]
+    for thread in threads:
+        thread.start()
+
+    error = None
+    n_done = 0
+    n_written = 0
+    n_running = n_threads
+    while n_running:
+        item = results.get()
+        if item is _DONE:
+            n_running -= 1
+            continue
+        window, outputs, result_bytes = item
+        if error is not None:
+            if isinstance(outputs, _Spilled):
+                outputs.path.unlink()
+            if budget is not None:
+                budget.release(result_bytes)
+            continue
+        if window is None:
+            error = outputs
+            stop.set()
+            continue
+        if outputs is not None:
+            try:
+                if isinstance(outputs, _Spilled):
+                    outputs = budget.load(outputs)
+                write_block(window, outputs)
+            except BaseException as e:
+                error = e
+                stop.set()
+                continue
+            finally:
+                if budget is not None:
+                    budget.release(result_bytes)
+            n_written += 1
+        n_done += 1
+        if total and n_done % max(1, total // 100) == 0:
+            logger.info("Processed blocks - %.2f%%", 100 * n_done / total)
+
+    for thread in threads:
+        thread.join()
+    if budget is not None and budget.n_spilled:
+        logger.info(f"Spilled {budget.n_spilled} blocks to {budget.spill_dir}")
+    if error is not None:
+        raise error
+
+    return n_written
+
+
+def open_output(
+    out_file, dtype, transform, height, width, block_size=None, count=1, update=False
+):
+    """
+    Create a tiled, compressed GeoTIFF and return an open handle, or open an existing
+    one for update so that individual blocks can be patched
+    """
+    import rasterio
+
+    if update:
+        return rasterio.open(out_file, "r+")
+
+    if block_size is not None and block_size % TIFF_TILE_MULTIPLE == 0:
+        tiling = dict(blockxsize=block_size, blockysize=block_size)
+    else:
+        tiling = {}
+
+    return rasterio.open(
+        out_file,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=count,
+        dtype=dtype,
+        crs="EPSG:4326",
+        transform=transform,
+        tiled=True,
+        compress="LZW",
+        BIGTIFF="YES",
+        **tiling,
+    )
+
+
+def open_outputs(out_files, dtypes, transform, height, width, block_size, update=False):
+    """Open a single-band GeoTIFF for each output and return the handles"""
+    return {
+        name: open_output(
+            out_file, dtypes[name], transform, height, width, block_size, update=update
+        )
+        for name, out_file in out_files.items()
+    }
+
+
+def _open_manifest(manifest_path, params, out_files, output_bands):
+    """
+    Return the block manifest and whether the existing outputs can be updated in place
+    (which requires all of them to exist and to have been fingerprinted with the same
+    parameters). Recorded blocks whose existing outputs do not match their
+    fingerprints are dropped from the manifest, so they are recomputed.
+
+    output_bands maps the name of each output of the block function to (path, band,
+    factor): band is a band number (read as a 2D array) or a list of them (read as a
+    3D array), and factor is the number of block pixels per output pixel.
+    """
+    manifest = block_manifest.BlockManifest(manifest_path, params)
+    update = len(manifest) > 0 and all(Path(f).exists() for f in out_files)
+    if update:
+        logger.info(
+            f"Incremental run - only blocks changed since {manifest_path} was "
+            "written will be recomputed"
+        )
+        readers = {
+            (path, band): raster_reader.ThreadLocalRasterReader(
+                path, band, cache_bytes=0
+            )
+            for path, bands, _ in output_bands.values()
+            for band in np.atleast_1d(bands).tolist()
+        }
+
+        def read_outputs(window):
+            row_off, col_off, nrows, ncols = window
+            outputs = {}
+            for name, (path, bands, factor) in output_bands.items():
+                output_window = (
+                    row_off // factor,
+                    col_off // factor,
+                    -(-nrows // factor),
+                    -(-ncols // factor),
+                )
+                if np.ndim(bands) == 0:
+                    outputs[name] = readers[path, bands].read(output_window)
+                else:
+                    outputs[name] = np.stack(
+                        [readers[path, band].read(output_window) for band in bands]
+                    )
+
+            return outputs
+
+        try:
+            manifest.verify(read_outputs)
+        finally:
+            for reader in readers.values():
+                reader.close()
+    else:
+        manifest.blocks = {}
+
+    return manifest, update
+
+
+def open_inputs(
+    sources, staging_path, window, input_mode="memmap", io_threads=None, n_threads=1
+):
+    """
+    Return the inputs of a run from sources (name: (path, band)) in the region window:
+    staged to memory-mapped arrays, or a PrefetchReader (which is closed by
+    run_prefetched) keeping a block queued for each of n_threads block threads, as
+    well as those read ahead
+    """
+    if input_mode == "prefetch":
+        io_threads = io_threads or raster_reader.DEFAULT_IO_THREADS
+        return raster_reader.PrefetchReader(
+            sources,
+            n_threads=io_threads,
+            depth=raster_reader.prefetch_depth(n_threads, io_threads),
+            offset=window[:2],
+        )
+
+    return {
+        name: stage_to_memmap(path, band, staging_path / f"{name}.npy", window)
+        for name, (path, band) in sources.items()
+    }
+
+
+def run_prefetched(block_func, inputs, windows, write_block, **kwargs):
+    """
+    run_blocks, first scheduling windows to be read ahead when inputs is a
+    PrefetchReader (which is closed afterwards)
+    """
+    if not isinstance(inputs, raster_reader.PrefetchReader):
+        return run_blocks(block_func, inputs, windows, write_block, **kwargs)
+
+    windows = list(windows)
+    with inputs:
+        inputs.schedule(windows)
+        n = run_blocks(block_func, inputs, windows, write_block, **kwargs)
+        inputs.log_stats()
+
+    return n
+
+
+def _region(in_file, window):
+    """Return the window (row_off, col_off, height, width) and its transform"""
+    import rasterio
+    from rasterio.windows import Window
+    from rasterio.windows import transform as window_transform
+
+    with rasterio.open(in_file) as ds:
+        if window is None:
+            window = (0, 0, ds.height, ds.width)
+        row_off, col_off, height, width = window
+        transform = window_transform(Window(col_off, row_off, width, height), ds.transform)
+
+    return window, transform
+
+
+def _windows(height, width, block_size, select=None):
+    """Windows of the blocks of a run (those select is true for) and their number"""
+    if select is None:
+        return block_windows(height, width, block_size), n_blocks(
+            height, width, block_size
+        )
+    windows = [
+        window for window in block_windows(height, width, block_size) if select(window)
+    ]
+    logger.info(
+        f"Patching {len(windows)} of {n_blocks(height, width, block_size)} blocks"
+    )
+
+    return windows, len(windows)
+
+
+def run_natural_conversion(
+    trans_file,
+    initial_cover_file,
+    crops_initial_file,
+    crops_final_file,
+    out_files,
+    rule_table,
+    staging_path,
+    window=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    n_threads=None,
+    kernel_threads=1,
+    aggregates=None,
+    manifest_path=None,
+    sparse_dir=None,
+    on_sparse_tile=None,
+    memory_budget=None,
+    input_mode="memmap",
+    io_threads=None,
+    select=None,
+):
+    """
+    Threaded equivalent of mapping compute_natural_conversion over the inputs
+
+    out_files maps each of the NATURAL_CONVERSION_OUTPUTS to a GeoTIFF path, and
+    rule_table is the RuleTable of initial cover meanings. With
+    kernel_threads > 1 fewer blocks are run at once (n_threads defaults to the CPU
+    count divided by kernel_threads) and each uses the row-parallel kernels.
+
+    aggregates optionally maps an aggregation factor to a GeoTIFF path that will
+    receive the AGGREGATE_BANDS for cells of factor x factor pixels. block_size is
+    rounded up so that it is a multiple of each factor.
+
+    If manifest_path is given, per-block fingerprints of the inputs and outputs are
+    kept there. When it already exists (with the same rule tables and block layout)
+    only blocks whose inputs changed (or whose existing outputs do not match their
+    fingerprints) are recomputed, and they are patched into the existing outputs.
+
+    If sparse_dir is given, the pixels with a nonzero transition code are also written
+    there in the format of sparse_output, calling on_sparse_tile(path) with each file
+    written. This needs every block, so it cannot be combined with manifest_path.
+
+    With memory_budget (in bytes), block_size and n_threads are reduced as needed for
+    the blocks in flight to fit in it (see MemoryBudget).
+
+    input_mode is one of INPUT_MODES. With "prefetch" the inputs are not staged, and
+    io_threads threads read the blocks ahead of use.
+
+    If select is given, only the blocks whose window it returns true for are computed,
+    and patched into the existing outputs (see rule_updates).
+    """
+    from affine import Affine
+    from rasterio.windows import Window
+
+    if sparse_dir is not None and manifest_path is not None:
+        raise ValueError("Sparse outputs cannot be written by incremental runs")
+    if select is not None and (sparse_dir is not None or manifest_path is not None):
+        raise ValueError("Blocks cannot be selected for incremental or sparse runs")
+
+    staging_path = Path(staging_path)
+    staging_path.mkdir(parents=True, exist_ok=True)
+
+    window, transform = _region(trans_file, window)
+    _, _, height, width = window
+
+    n_threads = n_threads or max(1, os.cpu_count() // kernel_threads)
+    # for trans band 1 is transition code, band 2 is meaning
+    inputs = open_inputs(
+        {
+            "trans": (trans_file, 2),
+            "lc_initial": (initial_cover_file, 1),
+            "crops_initial": (crops_initial_file, 1),
+            "crops_final": (crops_final_file, 1),
+        },
+        staging_path,
+        window,
+        input_mode,
+        io_threads,
+        n_threads,
+    )
+
+    aggregates = aggregates or {}
+    block_size = aligned_block_size(block_size, aggregates)
+    x_res = transform.a
+    y_res = -transform.e
+    initial_lut = rule_table.lut
+
+    def block_func(arrays, block_window):
+        block_row_off, block_col_off, nrows, _ = block_window
+        y = transform.f - (block_row_off + np.arange(nrows) + 0.5) * y_res
+        meaning, cell_areas, area_natural_conversion = (
+            kernels.natural_conversion_block(
+                arrays["trans"],
+                arrays["lc_initial"],
+                arrays["crops_initial"],
+                arrays["crops_final"],
+                y,
+                initial_lut,
+                x_res,
+                y_res,
+                kernel_threads,
+            )
+        )
+        results = {
+            "transition": meaning,
+            "area_pixel": cell_areas,
+            "area_natural_conversion": area_natural_conversion,
+        }
+        for factor in aggregates:
+            area_conv_sum, area_pixel_sum, counts = (
+                kernels.calc_block_aggregates(
+                    meaning, cell_areas, area_natural_conversion, factor
+                )
+            )
+            results[factor] = np.concatenate(
+                [area_conv_sum[np.newaxis], area_pixel_sum[np.newaxis], counts]
+            )
+        if sparse_dir is not None:
+            results["events"] = sparse_output.block_events(
+                meaning, cell_areas, block_row_off, block_col_off
+            )
+
+        return results
+
+    budget = None
+    if memory_budget is not None:
+        budget, block_size, n_threads = plan_blocks(
+            memory_budget,
+            staging_path / "spill",
+            block_func,
+            inputs,
+            height,
+            width,
+            block_size,
+            n_threads,
+            multiple=aligned_block_size(1, aggregates),
+        )
+
+    update = select is not None
+    if manifest_path is not None:
+        manifest, update = _open_manifest(
+            manifest_path,
+            {
+                "kernel": "natural_conversion",
+                "trans_codes": rule_table.codes,
+                "trans_meanings": rule_table.meanings,
+                "window": window,
+                "block_size": block_size,
+                "aggregates": sorted(aggregates),
+            },
+            list(out_files.values()) + list(aggregates.values()),
+            {
+                **{name: (out_file, 1, 1) for name, out_file in out_files.items()},
+                **{
+                    factor: (out_file, list(range(1, len(AGGREGATE_BANDS) + 1)), factor)
+                    for factor, out_file in aggregates.items()
+                },
+            },
+        )
+
+        def stored(results):
+            outputs = {
+                name: results[name].astype(NATURAL_CONVERSION_OUTPUTS[name], copy=False)
+                for name in out_files
+            }
+            outputs.update((factor, results[factor]) for factor in aggregates)
+
+            return outputs
+
+        block_func = block_manifest.incremental(block_func, manifest, stored)
+
+    outputs = open_outputs(
+        out_files,
+        NATURAL_CONVERSION_OUTPUTS,
+        transform,
+        height,
+        width,
+        block_size,
+        update=update,
+    )
+    for factor, out_file in aggregates.items():
+        outputs[factor] = open_output(
+            out_file,
+            "float64",
+            transform * Affine.scale(factor),
+            -(-height // factor),
+            -(-width // factor),
+            block_size // factor,
+            count=len(AGGREGATE_BANDS),
+            update=update,
+        )
+        outputs[factor].descriptions = tuple(AGGREGATE_BANDS)
+    if sparse_dir is not None:
+        sparse = sparse_output.SparseWriter(
+            sparse_dir, height, width, transform, on_tile=on_sparse_tile
+        )
+
+    def write_block(block_window, results):
+        block_row_off, block_col_off, nrows, ncols = block_window
+        for name, ds in outputs.items():
+            if name in aggregates:
+                ds.write(
+                    results[name],
+                    window=Window(
+                        block_col_off // name,
+                        block_row_off // name,
+                        results[name].shape[2],
+                        results[name].shape[1],
+                    ),
+                )
+            else:
+                ds.write(
+                    results[name].astype(ds.dtypes[0], copy=False),
+                    1,
+                    window=Window(block_col_off, block_row_off, ncols, nrows),
+                )
+        if sparse_dir is not None:
+            sparse.add_events(block_window, results["events"])
+
+    windows, total = _windows(height, width, block_size, select)
+    try:
+        n = run_prefetched(
+            block_func,
+            inputs,
+            windows,
+            write_block,
+            n_threads=n_threads,
+            total=total,
+            budget=budget,
+        )
+    finally:
+        for ds in outputs.values():
+            ds.close()
+    logger.info(f"Wrote {n} blocks to {', '.join(str(f) for f in out_files.values())}")
+    if manifest_path is not None:
+        manifest.save()
+    if sparse_dir is not None:
+        sparse.close()
+
+    return out_files, aggregates
+
+
+def run_transitions(
+    lc_initial_file,
+    lc_final_file,
+    out_file,
+    rule_table,
+    staging_path,
+    window=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    n_threads=None,
+    kernel_threads=1,
+    manifest_path=None,
+    memory_budget=None,
+    input_mode="memmap",
+    io_threads=None,
+    presence_path=None,
+    select=None,
+):
+    """
+    Threaded equivalent of mapping compute_transitions over the inputs, writing the
+    transition code and its meaning (from the RuleTable rule_table) as bands 1 and 2
+    of out_file. manifest_path enables incremental reruns, memory_budget limits the
+    blocks in flight, input_mode selects how inputs are read and select patches only
+    some blocks, as in run_natural_conversion.
+
+    If presence_path is given, the transition codes that occur in each block are
+    recorded there (see rule_updates.PresenceIndex). An existing index with the same
+    codes and blocks is updated.
+    """
+    from rasterio.windows import Window
+
+    if select is not None and manifest_path is not None:
+        raise ValueError("Blocks cannot be selected for incremental runs")
+
+    staging_path = Path(staging_path)
+    staging_path.mkdir(parents=True, exist_ok=True)
+
+    window, transform = _region(lc_initial_file, window)
+    _, _, height, width = window
+
+    n_threads = n_threads or max(1, os.cpu_count() // kernel_threads)
+    inputs = open_inputs(
+        {"lc_initial": (lc_initial_file, 1), "lc_final": (lc_final_file, 1)},
+        staging_path,
+        window,
+        input_mode,
+        io_threads,
+        n_threads,
+    )
+
+    presence = None
+
+    def block_func(arrays, block_window):
+        if kernel_threads > 1:
+            kernels.set_kernel_threads(kernel_threads)
+            trans = kernels.calc_lc_trans_parallel(
+                arrays["lc_initial"],
+                arrays["lc_final"],
+                1000,
+                np.empty(arrays["lc_initial"].shape, dtype=np.int32),
+            )
+        else:
+            trans = kernels.calc_lc_trans(
+                arrays["lc_initial"], arrays["lc_final"], 1000
+            )
+        meaning = rule_table.apply(trans)
+        results = {"transition": trans, "meaning": meaning}
+        if presence is not None:
+            results["presence"] = presence.presence(trans)
+
+        return results
+
+    budget = None
+    if memory_budget is not None:
+        budget, block_size, n_threads = plan_blocks(
+            memory_budget,
+            staging_path / "spill",
+            block_func,
+            inputs,
+            height,
+            width,
+            block_size,
+            n_threads,
+        )
+
+    if presence_path is not None:
+        import rule_updates
+
+        presence = rule_updates.PresenceIndex.open(
+            presence_path, rule_table.codes, window, block_size
+        )
+
+    update = select is not None
+    if manifest_path is not None:
+        manifest, update = _open_manifest(
+            manifest_path,
+            {
+                "kernel": "transitions",
+                "trans_codes": rule_table.codes,
+                "trans_meanings": rule_table.meanings,
+                "window": window,
+                "block_size": block_size,
+            },
+            [out_file],
+            {"transition": (out_file, 1, 1), "meaning": (out_file, 2, 1)},
+        )
+
+        def stored(results):
+            return {
+                name: results[name].astype(np.int32, copy=False)
+                for name in ("transition", "meaning")
+            }
+
+        block_func = block_manifest.incremental(block_func, manifest, stored)
+
+    out = open_output(
+        out_file, "int32", transform, height, width, block_size, count=2, update=update
+    )
+
+    def write_block(block_window, results):
+        block_row_off, block_col_off, nrows, ncols = block_window
+        block = Window(block_col_off, block_row_off, ncols, nrows)
+        out.write(results["transition"].astype(np.int32, copy=False), 1, window=block)
+        out.write(results["meaning"].astype(np.int32, copy=False), 2, window=block)
+        if presence is not None:
+            presence.set(block_window, results["presence"])
+
+    windows, total = _windows(height, width, block_size, select)
+    try:
+        n = run_prefetched(
+            block_func,
+            inputs,
+            windows,
+            write_block,
+            n_threads=n_threads,
+            total=total,
+            budget=budget,
+        )
+    finally:
+        out.close()
+    logger.info(f"Wrote {n} blocks to {out_file}")
+    if manifest_path is not None:
+        manifest.save()
+    if presence is not None:
+        presence.save(presence_path)
+
+    return out_file
@@ -0,0 +1,193 @@
+"""
+Background uploads of finished output files to S3, so that computing the next output
+overlaps with uploading the last one.
+
+Files are queued with UploadPipeline.submit as soon as they are closed, and uploaded by
+a small pool of threads, each using boto3 managed transfers to send the parts of large
+files concurrently. The queue is bounded, so when outputs are produced faster than they
+can be uploaded submit blocks rather than filling the local disk. wait() is a barrier
+that returns once everything submitted so far has been uploaded, and raises the first
+upload error.
+
+Set S3_ENDPOINT_URL (for example to a local MinIO server) to upload to an
+S3-compatible stand-in instead of AWS.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+
+# Number of files uploaded at once, and parts uploaded at once within each file
+DEFAULT_N_FILES = 2
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_PART_SIZE = 64 * MB
+
+# Maximum number of files waiting to be uploaded before submit blocks
+DEFAULT_MAX_QUEUED = 4
+
+# Log upload progress every this fraction of each file
+PROGRESS_STEP = 0.1
+
+_DONE = object()
+
+
+def s3_client(endpoint_url=None):
+    """Return an S3 client, for endpoint_url or S3_ENDPOINT_URL if either is set"""
+    import boto3
+
+    return boto3.client("s3", endpoint_url=endpoint_url or os.getenv("S3_ENDPOINT_URL"))
+
+
+class _Progress:
+    """boto3 transfer callback that logs every PROGRESS_STEP of a file"""
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self.transferred = 0
+        self._next = PROGRESS_STEP
+        self._lock = threading.Lock()
+
+    def __call__(self, n_bytes):
+        with self._lock:
+            self.transferred += n_bytes
+            if self.size and self.transferred / self.size >= self._next:
+                logger.info(
+                    "Uploading %s - %.0f%%",
+                    self.filename.name,
+                    100 * self.transferred / self.size,
+                )
+                while self._next <= self.transferred / self.size:
+                    self._next += PROGRESS_STEP
+
+
+class UploadPipeline:
+    """Upload files to S3 in background threads. Use as a context manager."""
+
+    def __init__(
+        self,
+        bucket,
+        prefix,
+        n_files=DEFAULT_N_FILES,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        part_size=DEFAULT_PART_SIZE,
+        max_queued=DEFAULT_MAX_QUEUED,
+        endpoint_url=None,
+    ):
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = s3_client(endpoint_url)
+        self.config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=max_concurrency,
+            use_threads=True,
+        )
+        self.n_uploaded = 0
+        self.bytes_uploaded = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._errors = []
+        self._threads = [
+            threading.Thread(target=self._run, name=f"upload-{n}", daemon=True)
+            for n in range(n_files)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(wait=exc_type is None)
+
+    def submit(self, filename, bucket=None, prefix=None, unlink=False):
+        """
+        Queue filename for upload to bucket/prefix (defaulting to those of the
+        pipeline), deleting the local file once uploaded if unlink is True. Blocks
+        while the queue is full.
+        """
+        self._raise_errors()
+        filename = Path(filename)
+        logger.info(f"Queueing {filename} for upload")
+        self._queue.put(
+            (filename, bucket or self.bucket, prefix or self.prefix, unlink)
+        )
+
+    def wait(self):
+        """Block until every submitted file has been uploaded"""
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self, wait=True):
+        """Stop the upload threads, after uploading queued files if wait is True"""
+        if wait:
+            self._queue.join()
+        else:
+            try:
+                while True:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+            except queue.Empty:
+                pass
+        for _ in self._threads:
+            self._queue.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+        logger.info(
+            f"Uploaded {self.n_uploaded} files "
+            f"({round(self.bytes_uploaded / 1024 ** 3, 2)} GB)"
+        )
+        if wait:
+            self._raise_errors()
+
+    def _raise_errors(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                self._queue.task_done()
+                return
+            try:
+                self._upload(*item)
+            except Exception as e:
+                logger.exception(f"Upload of {item[0]} failed")
+                with self._lock:
+                    self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, filename, bucket, prefix, unlink):
+        key = f"{prefix}/{filename.name}"
+        size = filename.stat().st_size
+        logger.info(f"Uploading {filename} to s3 at {key}")
+        start = time.perf_counter()
+        self.client.upload_file(
+            str(filename),
+            bucket,
+            key,
+            Config=self.config,
+            Callback=_Progress(filename, size),
+        )
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Uploaded {filename.name} in {elapsed:.1f} s "
+            f"({size / MB / max(elapsed, 1e-6):.1f} MB/s)"
+        )
+        with self._lock:
+            self.n_uploaded += 1
+            self.bytes_uploaded += size
+        if unlink:
+            filename.unlink()
@@ -0,0 +1,908 @@
+"""
+Render the transition and area_natural_conversion layers written by
+natural_conversion.py as web map tiles (256 x 256 pixel PNGs in Web Mercator), for
+review in a browser without a GIS server. Tiles are written to a single-file PMTiles
+(v3) archive per layer, which can be served as a static file, or to a directory of
+{z}/{x}/{y}.png files.
+
+The transition layer uses a fixed palette for the six transition codes. Where a tile
+pixel covers several pixels of the layer, the code shown is chosen by priority:
+natural conversion (codes 2, 1 then 3) before the other codes, so that conversion
+remains visible when zoomed out. The area_natural_conversion layer shows the share of
+the area of each tile pixel that was converted, in classes.
+
+Tiles are rendered in groups: a tile at an intermediate zoom and all of its
+descendants down to the maximum zoom, from one window of the layers. Groups are
+rendered in parallel by a pool of threads, and the tiles above the groups are built by
+merging the tiles of each four sibling groups as soon as they are done. Empty tiles
+are not written.
+
+Example:
+
+    python web_tiles.py --max-zoom 10 --format pmtiles
+"""
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import struct
+import zlib
+from collections import deque
+from pathlib import Path
+
+import kernels
+import numba
+import numpy as np
+import raster_reader
+import uploads
+
+DATA_PATH = Path("/data")
+OUT_S3_BUCKET = "trends.earth-private"
+OUT_S3_PREFIX = "esa-cci/transitions/tiles"
+
+INITIAL_YEAR = 2011
+FINAL_YEAR = 2019
+
+TILE_SIZE = 256
+DEFAULT_MIN_ZOOM = 0
+DEFAULT_MAX_ZOOM = 10
+
+# Latitude limit of Web Mercator
+MAX_LATITUDE = 85.0511287798066
+
+# Groups are rendered down to at most this many zoom levels below their top tile, and
+# read windows of at most MAX_GROUP_SOURCE pixels of the layers across
+GROUP_LEVELS = 3
+MAX_GROUP_SOURCE = 4096
+
+# Colors (RGB) of the transition codes, with 0 transparent. Labels as in
+# kernels.calc_natural_conversion
+TRANSITION_LEGEND = [
+    (1, (228, 26, 28), "Natural conversion in ESA CCI"),
+    (2, (128, 0, 38), "Natural conversion in ESA CCI, with cropland increase"),
+    (3, (255, 127, 0), "Cropland increase on natural land"),
+    (4, (77, 146, 33), "Cropland increase on forest"),
+    (5, (120, 120, 120), "Cropland increase on urban"),
+    (6, (191, 166, 112), "Cropland increase on other land"),
+]
+
+# Codes by decreasing priority when a tile pixel covers several codes
+TRANSITION_PRIORITY = [2, 1, 3, 4, 5, 6]
+
+# Upper limits of the classes of the converted share of each tile pixel (above 0),
+# and their colors
+CONVERSION_BREAKS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0]
+CONVERSION_COLORS = [
+    (255, 255, 178),
+    (254, 217, 118),
+    (254, 178, 76),
+    (253, 141, 60),
+    (240, 59, 32),
+    (189, 0, 38),
+]
+
+LAYERS = ["transition", "area_natural_conversion"]
+
+# PMTiles v3 constants
+PMTILES_HEADER_LENGTH = 127
+PMTILES_ROOT_LENGTH = 16384 - PMTILES_HEADER_LENGTH
+PMTILES_GZIP = 2
+PMTILES_NO_COMPRESSION = 1
+PMTILES_PNG = 2
+
+formatter = "[%(levelname)s] %(asctime)s - %(message)s [%(funcName)s %(lineno)d]"
+logging.basicConfig(level=logging.INFO, format=formatter)
+
+logging.getLogger("botocore").setLevel(logging.WARNING)
+logging.getLogger("s3transfer").setLevel(logging.WARNING)
+logging.getLogger("boto3").setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+
+###############################################################################
+# PNG and PMTiles encoding
+
+
+def _png_chunk(kind, data):
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    )
+
+
+def encode_png(indexes, colors):
+    """
+    Encode a 2D uint8 array of palette indexes as an indexed PNG, where colors are the
+    RGB colors of indexes 1 and up, and index 0 is transparent
+    """
+    height, width = indexes.shape
+    palette = [(0, 0, 0)] + list(colors)
+    # Filter type 0 (none) at the start of each row
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = indexes
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)),
+            _png_chunk(b"PLTE", bytes(value for color in palette for value in color)),
+            _png_chunk(b"tRNS", bytes([0] + [255] * len(colors))),
+            _png_chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def zxy_to_tile_id(z, x, y):
+    """PMTiles tile id: tiles of the lower zooms, then the Hilbert index of x, y"""
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    for level in range(z - 1, -1, -1):
+        s = 1 << level
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+
+    return tile_id
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+    return bytes(out)
+
+
+def serialize_directory(entries):
+    """gzipped PMTiles directory of (tile_id, offset, length, run_length) entries"""
+    out = [_varint(len(entries))]
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        out.append(_varint(tile_id - last_id))
+        last_id = tile_id
+    out.extend(_varint(run_length) for _, _, _, run_length in entries)
+    out.extend(_varint(length) for _, _, length, _ in entries)
+    for i, (_, offset, _, _) in enumerate(entries):
+        _, last_offset, last_length, _ = entries[i - 1] if i else (0, None, 0, 0)
+        if i and offset == last_offset + last_length:
+            out.append(_varint(0))
+        else:
+            out.append(_varint(offset + 1))
+
+    return gzip.compress(b"".join(out), mtime=0)
+
+
+def _directories(entries):
+    """
+    Return the root directory and the leaf directories, splitting the entries into
+    leaves when they do not fit in the root
+    """
+    root = serialize_directory(entries)
+    leaf_size = 4096
+    leaves = b""
+    while len(root) > PMTILES_ROOT_LENGTH:
+        root_entries = []
+        parts = []
+        offset = 0
+        for i in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[i : i + leaf_size])
+            # Entries with a run length of 0 point to leaf directories
+            root_entries.append((entries[i][0], offset, len(leaf), 0))
+            parts.append(leaf)
+            offset += len(leaf)
+        root = serialize_directory(root_entries)
+        leaves = b"".join(parts)
+        leaf_size *= 2
+
+    return root, leaves
+
+
+class PMTilesWriter:
+    """
+    Write tiles (added in any order) to a PMTiles v3 archive. Tile data is kept in a
+    temporary file until close, which writes the archive with the tiles in tile id
+    order and identical tiles stored once.
+    """
+
+    def __init__(self, path, metadata, bounds, min_zoom, max_zoom):
+        self.path = Path(path)
+        self.metadata = metadata
+        self.bounds = bounds
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self._tmp_path = self.path.with_suffix(".tiles.tmp")
+        self._data = open(self._tmp_path, "w+b")
+        self._tiles = {}
+        self._contents = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._data.close()
+            self._tmp_path.unlink()
+
+    def add(self, z, x, y, data):
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest not in self._contents:
+            self._contents[digest] = (self._data.tell(), len(data))
+            self._data.write(data)
+        self._tiles[zxy_to_tile_id(z, x, y)] = digest
+
+    def _header(self, sections, n_entries, n_contents):
+        west, south, east, north = self.bounds
+        values = [
+            b"PMTiles",
+            3,
+            *sections,
+            len(self._tiles),
+            n_entries,
+            n_contents,
+            1,  # clustered
+            PMTILES_GZIP,
+            PMTILES_NO_COMPRESSION,
+            PMTILES_PNG,
+            self.min_zoom,
+            self.max_zoom,
+            *(round(value * 1e7) for value in (west, south, east, north)),
+            self.min_zoom,
+            round((west + east) / 2 * 1e7),
+            round((south + north) / 2 * 1e7),
+        ]
+
+        return struct.pack("<7sB11Q4B2B4iB2i", *values)
+
+    def close(self):
+        """Write the archive, and return its path"""
+        entries = []
+        placed = {}
+        order = []
+        offset = 0
+        for tile_id in sorted(self._tiles):
+            digest = self._tiles[tile_id]
+            if digest not in placed:
+                placed[digest] = offset
+                order.append(digest)
+                offset += self._contents[digest][1]
+            tile_offset = placed[digest]
+            length = self._contents[digest][1]
+            last = entries[-1] if entries else None
+            if (
+                last is not None
+                and last[1] == tile_offset
+                and last[0] + last[3] == tile_id
+            ):
+                entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+            else:
+                entries.append((tile_id, tile_offset, length, 1))
+
+        root, leaves = _directories(entries)
+        metadata = gzip.compress(json.dumps(self.metadata).encode(), mtime=0)
+        root_offset = PMTILES_HEADER_LENGTH
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        data_offset = leaves_offset + len(leaves)
+        sections = [
+            root_offset,
+            len(root),
+            metadata_offset,
+            len(metadata),
+            leaves_offset,
+            len(leaves),
+            data_offset,
+            offset,
+        ]
+        with open(self.path, "wb") as f:
+            f.write(self._header(sections, len(entries), len(order)))
+            f.write(root)
+            f.write(metadata)
+            f.write(leaves)
+            for digest in order:
+                tmp_offset, length = self._contents[digest]
+                self._data.seek(tmp_offset)
+                f.write(self._data.read(length))
+        self._data.close()
+        self._tmp_path.unlink()
+        logger.info(
+            f"Wrote {len(self._tiles)} tiles ({len(order)} distinct) to {self.path}"
+        )
+
+        return self.path
+
+
+class XYZWriter:
+    """Write tiles to a directory of {z}/{x}/{y}.png files, with metadata.json"""
+
+    def __init__(self, path, metadata, bounds, min_zoom, max_zoom):
+        self.path = Path(path)
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.metadata = dict(
+            metadata, bounds=list(bounds), minzoom=min_zoom, maxzoom=max_zoom
+        )
+        self.n_tiles = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+    def add(self, z, x, y, data):
+        out_file = self.path / str(z) / str(x) / f"{y}.png"
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        out_file.write_bytes(data)
+        self.n_tiles += 1
+
+    def close(self):
+        with open(self.path / "metadata.json", "w") as f:
+            json.dump(self.metadata, f, indent=1)
+        logger.info(f"Wrote {self.n_tiles} tiles to {self.path}")
+
+        return self.path
+
+
+WRITERS = {"pmtiles": PMTilesWriter, "xyz": XYZWriter}
+
+
+###############################################################################
+# Sampling and rendering
+
+
+def _priority_lookups():
+    """Rank of each code (higher is shown first), and the code of each rank"""
+    rank = np.zeros(kernels.N_TRANSITION_CODES, dtype=np.uint8)
+    for i, code in enumerate(reversed(TRANSITION_PRIORITY)):
+        rank[code] = i + 1
+    codes = np.zeros(len(TRANSITION_PRIORITY) + 1, dtype=np.uint8)
+    codes[rank] = np.arange(kernels.N_TRANSITION_CODES, dtype=np.uint8)
+
+    return rank, codes
+
+
+PRIORITY_RANK, RANK_CODES = _priority_lookups()
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def sample_ranks(codes, rank, row_start, row_end, col_start, col_end):
+    """
+    Highest rank of the codes of the pixels of a block covered by each tile pixel (rows
+    row_start[i]:row_end[i] and columns col_start[j]:col_end[j])
+    """
+    out = np.zeros((row_start.size, col_start.size), dtype=np.uint8)
+    for i in range(row_start.size):
+        for j in range(col_start.size):
+            best = 0
+            for r in range(row_start[i], row_end[i]):
+                for c in range(col_start[j], col_end[j]):
+                    code = codes[r, c]
+                    if code >= 0 and code < rank.size and rank[code] > best:
+                        best = rank[code]
+            out[i, j] = best
+
+    return out
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def sample_areas(areas, row_areas, row_start, row_end, col_start, col_end):
+    """
+    Sums of the natural conversion area and of the pixel area of the pixels of a block
+    covered by each tile pixel (as in sample_ranks). NaN areas are skipped.
+    """
+    converted = np.zeros((row_start.size, col_start.size), dtype=np.float32)
+    total = np.zeros((row_start.size, col_start.size), dtype=np.float32)
+    for i in range(row_start.size):
+        for j in range(col_start.size):
+            area_sum = 0.0
+            total_sum = 0.0
+            for r in range(row_start[i], row_end[i]):
+                for c in range(col_start[j], col_end[j]):
+                    area = areas[r, c]
+                    if area == area:
+                        area_sum += area
+                    total_sum += row_areas[r]
+            converted[i, j] = area_sum
+            total[i, j] = total_sum
+
+    return converted, total
+
+
+def _lon(z, pixels):
+    return pixels / (TILE_SIZE << z) * 360.0 - 180.0
+
+
+def _lat(z, pixels):
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * pixels / (TILE_SIZE << z)))))
+
+
+def _tile_x(z, lon):
+    return int(np.clip((lon + 180.0) / 360.0 * (1 << z), 0, (1 << z) - 1))
+
+
+def _tile_y(z, lat):
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * (1 << z)
+
+    return int(np.clip(y, 0, (1 << z) - 1))
+
+
+def _source_ranges(positions, size):
+    """
+    Start and end (along one axis of the layers) of the pixels whose centers are
+    covered by each tile pixel, where positions are the tile pixel edges in pixels of
+    the layers. Tile pixels covering no pixel center take the nearest pixel.
+    """
+    start = np.ceil(positions[:-1] - 0.5)
+    end = np.ceil(positions[1:] - 0.5)
+    nearest = np.floor((positions[:-1] + positions[1:]) / 2)
+    empty = end <= start
+    start[empty] = nearest[empty]
+    end[empty] = nearest[empty] + 1
+
+    return (
+        np.clip(start, 0, size).astype(np.int64),
+        np.clip(end, 0, size).astype(np.int64),
+    )
+
+
+class TileSource:
+    """The layers to render, read with per-thread handles"""
+
+    def __init__(self, layers):
+        self.readers = {
+            name: raster_reader.ThreadLocalRasterReader(path, cache_bytes=0)
+            for name, path in layers.items()
+        }
+        reader = next(iter(self.readers.values()))
+        self.height, self.width = reader.shape
+        self.transform = reader.transform
+        for name, other in self.readers.items():
+            if other.shape != reader.shape or other.transform != reader.transform:
+                raise ValueError(f"Layer {name} is not on the grid of the other layers")
+
+    @property
+    def bounds(self):
+        """west, south, east, north, limited to the latitudes of Web Mercator"""
+        west, north = self.transform * (0, 0)
+        east, south = self.transform * (self.width, self.height)
+
+        return (
+            west,
+            max(south, -MAX_LATITUDE),
+            east,
+            min(north, MAX_LATITUDE),
+        )
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+
+    def sample(self, z, x_pixel, y_pixel, size):
+        """
+        Sample the layers for size x size tile pixels from (x_pixel, y_pixel) at zoom
+        z, returning a dict of arrays (ranks for the transition layer, converted and
+        total area for area_natural_conversion), or None if they are empty there
+        """
+        pixels = np.arange(size + 1, dtype=np.float64)
+        col_start, col_end = _source_ranges(
+            (_lon(z, x_pixel + pixels) - self.transform.c) / self.transform.a,
+            self.width,
+        )
+        row_start, row_end = _source_ranges(
+            (_lat(z, y_pixel + pixels) - self.transform.f) / self.transform.e,
+            self.height,
+        )
+        rows = row_end > row_start
+        cols = col_end > col_start
+        if not rows.any() or not cols.any():
+            return None
+        row_off = int(row_start[rows].min())
+        col_off = int(col_start[cols].min())
+        window = (
+            row_off,
+            col_off,
+            int(row_end.max()) - row_off,
+            int(col_end.max()) - col_off,
+        )
+        # Empty ranges (outside of the layers) stay empty once shifted
+        ranges = (
+            np.maximum(row_start - row_off, 0),
+            np.maximum(row_end - row_off, 0),
+            np.maximum(col_start - col_off, 0),
+            np.maximum(col_end - col_off, 0),
+        )
+
+        arrays = {}
+        if "transition" in self.readers:
+            codes = self.readers["transition"].read(window)
+            if codes.any():
+                arrays["transition"] = (sample_ranks(codes, PRIORITY_RANK, *ranges),)
+        if "area_natural_conversion" in self.readers:
+            areas = self.readers["area_natural_conversion"].read(window)
+            if np.nansum(areas) > 0:
+                y = self.transform.f + (
+                    row_off + np.arange(window[2]) + 0.5
+                ) * self.transform.e
+                row_areas = kernels.calc_cell_area(
+                    y, self.transform.a, -self.transform.e
+                ).astype(np.float32)
+                arrays["area_natural_conversion"] = sample_areas(
+                    areas, row_areas, *ranges
+                )
+
+        return arrays or None
+
+
+def _empty(name, size):
+    """Arrays of a layer for size x size tile pixels, with nothing to show"""
+    if name == "transition":
+        return (np.zeros((size, size), dtype=np.uint8),)
+
+    return tuple(np.zeros((size, size), dtype=np.float32) for _ in range(2))
+
+
+def _downsample(name, arrays):
+    """Halve the resolution of the arrays of a layer"""
+    height, width = arrays[0].shape
+    if name == "transition":
+        (ranks,) = arrays
+        return (ranks.reshape(height // 2, 2, width // 2, 2).max(axis=(1, 3)),)
+
+    return tuple(
+        array.reshape(height // 2, 2, width // 2, 2).sum(axis=(1, 3))
+        for array in arrays
+    )
+
+
+def render_tile(name, arrays):
+    """PNG of a tile of a layer, or None if it is empty"""
+    if name == "transition":
+        (ranks,) = arrays
+        if not ranks.any():
+            return None
+        return encode_png(
+            RANK_CODES[ranks], [color for _, color, _ in TRANSITION_LEGEND]
+        )
+
+    converted, total = arrays
+    if not (converted > 0).any():
+        return None
+    share = np.divide(converted, total, out=np.zeros_like(converted), where=total > 0)
+    classes = np.where(
+        share > 0,
+        np.searchsorted(CONVERSION_BREAKS[:-1], share, side="left") + 1,
+        0,
+    ).astype(np.uint8)
+
+    return encode_png(classes, CONVERSION_COLORS)
+
+
+def _tiles_of(arrays, z, x, y, n):
+    """Yield z, x, y and the arrays of each of the n x n tiles of a group level"""
+    for j in range(n):
+        for i in range(n):
+            rows = slice(j * TILE_SIZE, (j + 1) * TILE_SIZE)
+            cols = slice(i * TILE_SIZE, (i + 1) * TILE_SIZE)
+            yield z, x * n + i, y * n + j, {
+                name: tuple(array[rows, cols] for array in layer)
+                for name, layer in arrays.items()
+            }
+
+
+def render_group(source, z, x, y, max_zoom):
+    """
+    Render the tile z, x, y and its descendants down to max_zoom. Returns a list of
+    (layer, z, x, y, png) and the arrays of the tile z, x, y (or None if empty).
+    """
+    n = 1 << (max_zoom - z)
+    size = n * TILE_SIZE
+    # Sample in parts of at most about MAX_GROUP_SOURCE pixels of the layers across,
+    # which only splits groups when max_zoom is coarser than the group zoom would be
+    span = 360.0 / (1 << z) / source.transform.a
+    parts = min(size, 1 << max(0, math.ceil(math.log2(span / MAX_GROUP_SOURCE))))
+    part_size = size // parts
+    arrays = {}
+    for j in range(parts):
+        for i in range(parts):
+            part = source.sample(
+                max_zoom,
+                x * size + i * part_size,
+                y * size + j * part_size,
+                part_size,
+            )
+            if parts == 1:
+                arrays = part or {}
+                continue
+            for name, layer in (part or {}).items():
+                if name not in arrays:
+                    arrays[name] = _empty(name, size)
+                for array, part_array in zip(arrays[name], layer):
+                    array[
+                        j * part_size : (j + 1) * part_size,
+                        i * part_size : (i + 1) * part_size,
+                    ] = part_array
+    if not arrays:
+        return [], None
+
+    tiles = []
+    for level in range(max_zoom, z - 1, -1):
+        n = 1 << (level - z)
+        for tile_z, tile_x, tile_y, tile_arrays in _tiles_of(arrays, level, x, y, n):
+            for name, layer in tile_arrays.items():
+                png = render_tile(name, layer)
+                if png is not None:
+                    tiles.append((name, tile_z, tile_x, tile_y, png))
+        if level > z:
+            arrays = {name: _downsample(name, layer) for name, layer in arrays.items()}
+
+    return tiles, arrays
+
+
+class _Pyramid:
+    """
+    Build the tiles above the groups, merging the arrays of each four siblings once all
+    of those within the tile ranges have been added
+    """
+
+    def __init__(self, min_zoom, top_zoom, tile_ranges, emit):
+        self.min_zoom = min_zoom
+        self.top_zoom = top_zoom
+        self.tile_ranges = tile_ranges
+        self.emit = emit
+        self._children = {}
+
+    def _expected(self, z, x, y):
+        (x_min, x_max), (y_min, y_max) = self.tile_ranges[z + 1]
+
+        return sum(
+            1
+            for child_x in (2 * x, 2 * x + 1)
+            for child_y in (2 * y, 2 * y + 1)
+            if x_min <= child_x <= x_max and y_min <= child_y <= y_max
+        )
+
+    def add(self, z, x, y, arrays):
+        if z <= self.min_zoom:
+            return
+        parent = (z - 1, x // 2, y // 2)
+        children = self._children.setdefault(parent, {})
+        children[(x % 2, y % 2)] = arrays
+        if len(children) < self._expected(*parent):
+            return
+        del self._children[parent]
+
+        merged = {}
+        for name in {name for child in children.values() if child for name in child}:
+            layer = _empty(name, 2 * TILE_SIZE)
+            for (i, j), child in children.items():
+                if child and name in child:
+                    for array, child_array in zip(layer, child[name]):
+                        array[
+                            j * TILE_SIZE : (j + 1) * TILE_SIZE,
+                            i * TILE_SIZE : (i + 1) * TILE_SIZE,
+                        ] = child_array
+            merged[name] = _downsample(name, layer)
+        for name, layer in merged.items():
+            png = render_tile(name, layer)
+            if png is not None:
+                self.emit(name, *parent, png)
+        self.add(*parent, merged or None)
+
+
+def group_zoom(min_zoom, max_zoom, x_res):
+    """
+    Zoom of the top tiles of the groups: at most GROUP_LEVELS above max_zoom, and
+    covering at most MAX_GROUP_SOURCE pixels of the layers across
+    """
+    smallest = math.ceil(math.log2(360.0 / (x_res * MAX_GROUP_SOURCE)))
+
+    return min(max_zoom, max(min_zoom, max_zoom - GROUP_LEVELS, smallest))
+
+
+def _morton(x, y):
+    key = 0
+    for bit in range(32):
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+
+    return key
+
+
+def layer_metadata(name, description):
+    if name == "transition":
+        legend = [
+            {"value": code, "color": "#%02x%02x%02x" % color, "label": label}
+            for code, color, label in TRANSITION_LEGEND
+        ]
+    else:
+        lower = [0.0] + CONVERSION_BREAKS[:-1]
+        legend = [
+            {
+                "color": "#%02x%02x%02x" % color,
+                "label": f"{100 * low:g}-{100 * high:g}% converted",
+            }
+            for low, high, color in zip(lower, CONVERSION_BREAKS, CONVERSION_COLORS)
+        ]
+
+    return {
+        "name": f"natural-conversion_{name}_{INITIAL_YEAR}-{FINAL_YEAR}",
+        "description": description,
+        "type": "overlay",
+        "format": "png",
+        "legend": legend,
+    }
+
+
+def write_tiles(
+    layers,
+    out_paths,
+    min_zoom=DEFAULT_MIN_ZOOM,
+    max_zoom=DEFAULT_MAX_ZOOM,
+    out_format="pmtiles",
+    n_threads=None,
+):
+    """
+    Render layers (a dict of layer name: raster path) to out_paths (layer name: path of
+    the archive or directory) at zooms min_zoom to max_zoom
+    """
+    source = TileSource(layers)
+    west, south, east, north = source.bounds
+    top_zoom = group_zoom(min_zoom, max_zoom, source.transform.a)
+    # Tiles intersecting the layers at each zoom, as (x_min, x_max), (y_min, y_max)
+    tile_ranges = {
+        z: (
+            (_tile_x(z, west), _tile_x(z, east - 1e-9)),
+            (_tile_y(z, north), _tile_y(z, south + 1e-9)),
+        )
+        for z in range(min_zoom, max_zoom + 1)
+    }
+    (x_min, x_max), (y_min, y_max) = tile_ranges[top_zoom]
+    groups = sorted(
+        ((x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)),
+        key=lambda tile: _morton(*tile),
+    )
+    n_threads = n_threads or os.cpu_count()
+    logger.info(
+        f"Rendering {len(groups)} groups of tiles from zoom {top_zoom} to {max_zoom} "
+        f"with {n_threads} threads"
+    )
+
+    descriptions = {
+        "transition": "Natural conversion transition codes",
+        "area_natural_conversion": "Share of the area converted from natural land",
+    }
+    writers = {
+        name: WRITERS[out_format](
+            out_paths[name],
+            layer_metadata(name, descriptions[name]),
+            source.bounds,
+            min_zoom,
+            max_zoom,
+        )
+        for name in layers
+    }
+
+    def emit(name, z, x, y, png):
+        writers[name].add(z, x, y, png)
+
+    pyramid = _Pyramid(min_zoom, top_zoom, tile_ranges, emit)
+
+    def handle(pending):
+        x, y, future = pending.popleft()
+        tiles, arrays = future.result()
+        for tile in tiles:
+            emit(*tile)
+        pyramid.add(top_zoom, x, y, arrays)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            # Results are handled in submission (Morton) order, so that siblings are
+            # merged into their parent soon after they are rendered, and at most
+            # 2 * n_threads groups are held in memory
+            pending = deque()
+            for x, y in groups:
+                future = executor.submit(render_group, source, top_zoom, x, y, max_zoom)
+                pending.append((x, y, future))
+                if len(pending) > 2 * n_threads:
+                    handle(pending)
+            while pending:
+                handle(pending)
+    finally:
+        source.close()
+
+    return {name: writer.close() for name, writer in writers.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render natural conversion layers as web map tiles"
+    )
+    years = f"{INITIAL_YEAR}-{FINAL_YEAR}"
+    parser.add_argument(
+        "--transition",
+        default=str(DATA_PATH / f"natural-conversion_300m_{years}_transition.tif"),
+        help="Transition raster (codes 0-6), for example the transition output of "
+        "natural_conversion.py --executor threads, or NETCDF:<file>.nc:transition",
+    )
+    parser.add_argument(
+        "--area-natural-conversion",
+        default=str(
+            DATA_PATH / f"natural-conversion_300m_{years}_area_natural_conversion.tif"
+        ),
+        help="Natural conversion area raster, or NETCDF:<file>.nc:"
+        "area_natural_conversion",
+    )
+    parser.add_argument("--layers", nargs="+", choices=LAYERS, default=LAYERS)
+    parser.add_argument("--min-zoom", type=int, default=DEFAULT_MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=DEFAULT_MAX_ZOOM)
+    parser.add_argument(
+        "--format",
+        choices=list(WRITERS),
+        default="pmtiles",
+        help="A single-file PMTiles archive, or a directory of {z}/{x}/{y}.png tiles, "
+        "for each layer",
+    )
+    parser.add_argument("--n-threads", type=int, default=None)
+    parser.add_argument("--no-upload", action="store_true")
+    args = parser.parse_args()
+    if not 0 <= args.min_zoom <= args.max_zoom:
+        parser.error("--min-zoom must be between 0 and --max-zoom")
+
+    layers = {}
+    for name in args.layers:
+        in_file = getattr(args, name)
+        if not Path(in_file).exists() and not in_file.startswith(("/vsi", "NETCDF:")):
+            logger.info(f"Downloading {Path(in_file).name} from s3")
+            Path(in_file).parent.mkdir(parents=True, exist_ok=True)
+            uploads.s3_client().download_file(
+                OUT_S3_BUCKET, f"esa-cci/transitions/{Path(in_file).name}", in_file
+            )
+        layers[name] = in_file
+
+    suffix = ".pmtiles" if args.format == "pmtiles" else "_tiles"
+    out_paths = {
+        name: DATA_PATH / f"natural-conversion_300m_{years}_{name}{suffix}"
+        for name in layers
+    }
+    out_paths = write_tiles(
+        layers,
+        out_paths,
+        min_zoom=args.min_zoom,
+        max_zoom=args.max_zoom,
+        out_format=args.format,
+        n_threads=args.n_threads,
+    )
+
+    if not args.no_upload:
+        with uploads.UploadPipeline(OUT_S3_BUCKET, OUT_S3_PREFIX) as uploader:
+            for out_path in out_paths.values():
+                if out_path.is_file():
+                    uploader.submit(out_path)
+                    continue
+                for tile_file in sorted(out_path.rglob("*")):
+                    if tile_file.is_file():
+                        prefix = tile_file.parent.relative_to(out_path.parent)
+                        uploader.submit(tile_file, prefix=f"{OUT_S3_PREFIX}/{prefix}")
+
+
+if __name__ == "__main__":
+    main()